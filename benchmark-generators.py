@@ -0,0 +1,297 @@
+import argparse
+import contextlib
+import io
+import json
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+from generator_loader import load_generator
+
+# Benchmarks every generation stage of data-generator.py against an in-process
+# stand-in for ClickHouse, so throughput and memory can be tracked without any
+# services running. Inserts are counted; only the columns later stages query
+# back are kept. Stages run in-process (workers=1) and their progress output is
+# discarded, so the numbers cover generation, serialization and the pool.
+
+# Columns kept per table; dimension tables are kept whole
+KEPT_COLUMNS = {
+    'Fact_Sales': ['sale_id', 'date_id', 'product_id', 'customer_id', 'channel_id', 'status'],
+    'Dim_Loan': ['loan_id', 'customer_id', 'loan_amount', 'interest_rate', 'term_months', 'start_date',
+                 'loan_status', 'risk_rating'],
+    'Fact_Loan_Repayment': [],
+    'Generation_Checkpoints': [],
+}
+REPAYING_STATUSES = ['Active', 'Delinquent', 'Defaulted']
+
+
+class FakeDatabase:
+    # Tables shared by every FakeClient the connection pool opens
+    def __init__(self, generator):
+        self.generator = generator
+        self.tables = {}
+        self.queries = 0
+        self.inserted = 0
+        self._arrays = {}
+        self._lock = threading.Lock()
+        self.handlers = {
+            generator.APPROVED_SALES_SHARDS_QUERY: self._approved_sales_shards,
+            generator.APPROVED_SALES_QUERY: self._approved_sales,
+            generator.REPAYMENT_SHARDS_QUERY: self._repayment_shards,
+            generator.REPAYMENT_LOANS_QUERY: self._repayment_loans,
+        }
+
+    def insert(self, table, names, data, columnar):
+        columns = data if columnar else list(zip(*data))
+        rows = len(columns[0]) if columns else 0
+        kept = KEPT_COLUMNS.get(table, names)
+        with self._lock:
+            self.queries += 1
+            if table != self.generator.CHECKPOINT_TABLE:
+                self.inserted += rows
+            stored = self.tables.setdefault(table, {name: [] for name in kept})
+            for name, values in zip(names, columns):
+                if name in stored:
+                    stored[name].extend(values)
+            for key in [key for key in self._arrays if key[0] == table]:
+                del self._arrays[key]
+        return rows
+
+    def column(self, table, name):
+        # numpy copy of a stored column, rebuilt after the next insert into its table
+        with self._lock:
+            if (table, name) not in self._arrays:
+                values = self.tables.get(table, {}).get(name, [])
+                numeric = not values or isinstance(values[0], (int, float))
+                self._arrays[table, name] = np.array(values, dtype=None if numeric else object)
+            return self._arrays[table, name]
+
+    def arrays(self, table):
+        return TableColumns(self, table)
+
+    def select(self, query, params, columnar):
+        with self._lock:
+            self.queries += 1
+        if query in self.handlers:
+            return self.handlers[query](params)
+        names, table = self.generator.SIMPLE_SELECT_PATTERN.match(' '.join(query.split())).groups()
+        stored = self.tables.get(table, {})
+        columns = [stored.get(name.strip(), []) for name in names.split(',')]
+        return [list(values) for values in columns] if columnar else list(zip(*columns))
+
+    def _lookup(self, table, key, column):
+        # Dense key -> value array for a dimension column
+        arrays = self.arrays(table)
+        values = np.empty(int(arrays[key].max()) + 1, dtype=object)
+        values[arrays[key]] = arrays[column]
+        return values
+
+    def _approved_sales_mask(self, sales, first_id, last_id=None):
+        mask = (sales['status'] == 'Approved') & (sales['sale_id'] >= first_id)
+        return mask if last_id is None else mask & (sales['sale_id'] <= last_id)
+
+    def _approved_sales_shards(self, params):
+        sales = self.arrays('Fact_Sales')
+        sale_ids = sales['sale_id'][self._approved_sales_mask(sales, params['first_id'])]
+        shards, counts = np.unique((sale_ids - 1) // params['shard_size'], return_counts=True)
+        return list(zip(shards.tolist(), counts.tolist()))
+
+    def _approved_sales(self, params):
+        sales = self.arrays('Fact_Sales')
+        rows = np.flatnonzero(self._approved_sales_mask(sales, params['first_id'], params['last_id']))
+        rows = rows[np.argsort(sales['sale_id'][rows], kind='stable')]
+        customer_ids = sales['customer_id'][rows]
+        return list(zip(
+            sales['sale_id'][rows].tolist(), customer_ids.tolist(), sales['product_id'][rows].tolist(),
+            self._lookup('Dim_Time', 'date_id', 'date')[sales['date_id'][rows]].tolist(),
+            self._lookup('Dim_Customer', 'customer_id', 'risk_profile')[customer_ids].tolist(),
+            sales['channel_id'][rows].tolist()
+        ))
+
+    def _repaying_loans(self, loans, first_id, last_id=None):
+        mask = np.isin(loans['loan_status'], REPAYING_STATUSES) & (loans['loan_id'] >= first_id)
+        return mask if last_id is None else mask & (loans['loan_id'] <= last_id)
+
+    def _repayment_shards(self, params):
+        loans = self.arrays('Dim_Loan')
+        mask = self._repaying_loans(loans, params['first_id'])
+        start_date = np.array(loans['start_date'][mask].tolist(), dtype='datetime64[D]')
+        elapsed = (np.datetime64(params['today'], 'D') - start_date).astype(np.int64)
+        installments = np.minimum(loans['term_months'][mask], np.maximum(0, elapsed // 30))
+        shards = (loans['loan_id'][mask] - 1) // params['shard_size']
+        totals = np.bincount(shards, weights=installments) if len(shards) else np.array([])
+        return [(shard, int(totals[shard])) for shard in np.unique(shards).tolist()]
+
+    def _repayment_loans(self, params):
+        loans = self.arrays('Dim_Loan')
+        rows = np.flatnonzero(self._repaying_loans(loans, params['first_id'], params['last_id']))
+        rows = rows[np.argsort(loans['loan_id'][rows], kind='stable')]
+        return list(zip(*[loans[name][rows].tolist() for name in KEPT_COLUMNS['Dim_Loan']]))
+
+
+class TableColumns:
+    # table['column'] access to FakeDatabase.column
+    def __init__(self, database, table):
+        self.database = database
+        self.table = table
+
+    def __getitem__(self, name):
+        return self.database.column(self.table, name)
+
+
+class FakeClient:
+    # The parts of clickhouse_driver.Client the generators use
+    database = None
+
+    def __init__(self, **config):
+        pass
+
+    def execute(self, query, params=None, columnar=False, settings=None, **kwargs):
+        statement = query.strip()
+        if statement.startswith('INSERT INTO'):
+            table = statement.split()[2]
+            names = statement[statement.index('(') + 1:statement.index(')')].replace(' ', '').split(',')
+            return self.database.insert(table, names, params, columnar)
+        if statement.startswith('SELECT'):
+            return self.database.select(query, params, columnar)
+        with self.database._lock:
+            self.database.queries += 1
+        return []
+
+    def execute_iter(self, query, params=None, settings=None, **kwargs):
+        return iter(self.execute(query, params))
+
+    def disconnect(self):
+        pass
+
+    class connection:
+        @staticmethod
+        def ping():
+            return True
+
+
+def stage_runs(generator, scale, engine, seed):
+    # (stage, call) in pipeline order; each stage reads what the previous one wrote
+    return [
+        ('dimensions', generator.generate_dimension_data),
+        ('sales', lambda: generator.generate_fact_sales(num_records=scale, engine=engine, seed=seed)),
+        ('loans', lambda: generator.generate_dim_loan(seed=seed)),
+        ('repayments', lambda: generator.generate_loan_repayments(engine=engine, seed=seed)),
+    ]
+
+
+class AllocationTracer:
+    # Bytes each batch allocates: from the end of the previous insert to the end of
+    # its own, the high-water mark above the memory held when the batch started.
+    # Memory the batch leaves behind (e.g. the kept columns) is not counted again.
+    def __init__(self, generator):
+        self.insert_columns = generator.insert_columns
+        generator.insert_columns = self.traced_insert_columns
+
+    def start(self):
+        tracemalloc.start()
+        self.allocated = 0
+        self.peak = 0
+        self.base = tracemalloc.get_traced_memory()[0]
+
+    def traced_insert_columns(self, *args, **kwargs):
+        rows = self.insert_columns(*args, **kwargs)
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            self.allocated += peak - self.base
+            self.peak = max(self.peak, peak)
+            tracemalloc.reset_peak()
+            self.base = current
+        return rows
+
+    def stop(self):
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+
+def run_pipeline(scale, engine, seed, stages, trace_memory):
+    generator = load_generator()
+    database = FakeDatabase(generator)
+    FakeClient.database = database
+    generator.metered_client = FakeClient
+    generator.ch_pool = generator.ClickHousePool(generator.CLICKHOUSE_CONFIG)
+    generator.random.seed(seed)
+    tracer = AllocationTracer(generator)
+
+    # Earlier stages always run, since later ones read their output; only the requested ones are reported
+    runs = stage_runs(generator, scale, engine, seed)
+    last = max(index for index, (stage, _) in enumerate(runs) if stage in stages)
+    results = []
+    for stage, call in runs[:last + 1]:
+        if stage not in stages:
+            with contextlib.redirect_stdout(io.StringIO()):
+                call()
+            continue
+        queries, inserted = database.queries, database.inserted
+        if trace_memory:
+            tracer.start()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            call()
+        seconds = time.perf_counter() - started
+        if trace_memory:
+            tracer.stop()
+        results.append({
+            'scale': scale, 'engine': engine, 'stage': stage, 'rows': database.inserted - inserted,
+            'seconds': seconds, 'queries': database.queries - queries,
+            'peak_bytes': tracer.peak if trace_memory else None,
+            'allocated_bytes': tracer.allocated if trace_memory else None
+        })
+    return results
+
+
+def benchmark(scales, engines, seed, stages, trace_memory=True):
+    results = []
+    for scale in scales:
+        for engine in engines:
+            timed = run_pipeline(scale, engine, seed, stages, trace_memory=False)
+            # tracemalloc slows allocation-heavy code down, so memory gets its own pass
+            traced = run_pipeline(scale, engine, seed, stages, trace_memory=True) if trace_memory else timed
+            for result, memory in zip(timed, traced):
+                result['peak_bytes'] = memory['peak_bytes']
+                result['allocated_bytes'] = memory['allocated_bytes']
+                result['rows_per_second'] = result['rows'] / result['seconds'] if result['seconds'] else 0.0
+                result['allocated_bytes_per_row'] = (
+                    result['allocated_bytes'] / result['rows']
+                    if result['allocated_bytes'] is not None and result['rows'] else None
+                )
+                results.append(result)
+                print(format_result(result), flush=True)
+    return results
+
+
+def format_result(result):
+    peak = '-' if result['peak_bytes'] is None else f"{result['peak_bytes'] / 2**20:.1f}"
+    per_row = '-' if result['allocated_bytes_per_row'] is None else f"{result['allocated_bytes_per_row']:.0f}"
+    return (
+        f"{result['scale']:>9} {result['engine']:<7} {result['stage']:<11} {result['rows']:>10} "
+        f"{result['seconds']:>9.2f} {result['rows_per_second']:>11.0f} {result['queries']:>8} {peak:>9} {per_row:>11}"
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the data-generator.py stages without ClickHouse')
+    parser.add_argument('--scales', default='10000,100000,1000000', help='comma-separated Fact_Sales row counts')
+    parser.add_argument('--engines', default='python,numpy', help='comma-separated engines (python, numpy)')
+    parser.add_argument('--stages', default='dimensions,sales,loans,repayments', help='comma-separated stages')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    print(f"{'scale':>9} {'engine':<7} {'stage':<11} {'rows':>10} {'seconds':>9} {'rows/s':>11} "
+          f"{'queries':>8} {'peak MiB':>9} {'alloc B/row':>11}")
+    results = benchmark(
+        [int(scale) for scale in args.scales.split(',')], args.engines.split(','), args.seed,
+        args.stages.split(','), trace_memory=not args.no_memory
+    )
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
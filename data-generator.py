@@ -1,203 +1,2214 @@
+import argparse
+import asyncio
 import os
-from datetime import datetime, timedelta
-from faker import Faker
-from clickhouse_driver import Client
-from dotenv import load_dotenv
+from datetime import date, datetime
+import bisect
+import csv
+import gzip
+import itertools
+import math
+import mmap
+import json
+from contextlib import contextmanager
+import functools
+import queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 import random
+import re
+import shutil
+import socket
+import sys
+import threading
+import time
 import uuid
+import numpy as np
 
-load_dotenv()
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
-fake = Faker()
+# Importing this module has no side effects: Faker and clickhouse_driver are
+# imported where they are first used, clients connect on their first query and
+# settings come from the environment once load_settings() runs (the CLI calls it).
 
 CLICKHOUSE_CONFIG = {
     'host': 'localhost',
     'port': 9000,
     'user': 'mysql_user',
-    'password': os.getenv("PASSWORD"),
+    'password': None,
     'database': 'default'
 }
 
-ch_client = Client(**CLICKHOUSE_CONFIG)
-
-def create_tables():
-    # Get list of all tables
-    tables = ch_client.execute(
-                "SELECT name FROM system.tables WHERE database = 'default'"
-            )
+def retryable_errors():
+    # Network failures worth retrying an insert for; anything else is a real error
+    from clickhouse_driver import errors
+    return (errors.NetworkError, errors.SocketTimeoutError, EOFError, ConnectionError, socket.timeout)
+
+# Time blocked on driver sockets and bytes sent, per thread, so every insert can
+# split its own time into serialization (in the driver) and network
+_socket_io = threading.local()
+
+def socket_io():
+    return getattr(_socket_io, 'seconds', 0.0), getattr(_socket_io, 'bytes', 0)
+
+def _count_socket_io(seconds, sent=0):
+    _socket_io.seconds = getattr(_socket_io, 'seconds', 0.0) + seconds
+    _socket_io.bytes = getattr(_socket_io, 'bytes', 0) + sent
+
+class _MeteredSocket:
+    # Wraps a driver connection's socket; the driver only sends and receives through these two calls
+    def __init__(self, sock):
+        self._sock = sock
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+    def sendall(self, data):
+        started = time.perf_counter()
+        self._sock.sendall(data)
+        _count_socket_io(time.perf_counter() - started, len(data))
+
+    def recv_into(self, buffer, size=0):
+        started = time.perf_counter()
+        received = self._sock.recv_into(buffer, size)
+        _count_socket_io(time.perf_counter() - started)
+        return received
+
+def metered_client(**config):
+    from clickhouse_driver import Client
+
+    client = Client(**config)
+    # client.connection is in use; alternative hosts wait in client.connections
+    for connection in [client.connection, *client.connections]:
+        create_socket = connection._create_socket
+        connection._create_socket = lambda host, port, create=create_socket: _MeteredSocket(create(host, port))
+    return client
+
+def _reset_peak_rss():
+    # Linux lets a process reset its RSS high-water mark, so each stage (and shard) gets its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as refs:
+            refs.write('5')
+    except OSError:
+        pass
+
+def peak_rss():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # Peak since the process started; kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+class StackSampler:
+    # Samples the stacks of every thread in this process each interval seconds and
+    # writes the counts as folded stacks, the input of flamegraph.pl and speedscope
+    def __init__(self, path, interval=0.005):
+        self.path = path
+        self.interval = interval
+        self.counts = {}
+
+    def __enter__(self):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'w') as folded:
+            for stack, count in sorted(self.counts.items()):
+                folded.write(f'{stack} {count}\n')
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                key = ';'.join([names.get(ident, str(ident))] + stack[::-1])
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+def _write_atomically(path, text):
+    # Readers (node_exporter's textfile collector, dashboards) never see a half-written file
+    with open(path + '.tmp', 'w') as output:
+        output.write(text)
+    os.replace(path + '.tmp', path)
+
+METRICS_PREFIX = 'bank_loan_generator'
+
+# Prometheus gauge name suffix -> (stage summary field, help text)
+PROMETHEUS_GAUGES = {
+    'stage_duration_seconds': ('seconds', 'Wall time of the last run of the stage'),
+    'stage_rows': ('rows', 'Rows the stage inserted'),
+    'stage_rows_per_second': ('rows_per_second', 'Rows inserted per second of wall time'),
+    'stage_batches': ('batches', 'Batches the stage inserted'),
+    'stage_queries': ('queries', 'ClickHouse queries the stage issued'),
+    'stage_bytes_sent': ('bytes_sent', 'Bytes sent to ClickHouse (file sinks: bytes written)'),
+    'stage_peak_rss_bytes': ('peak_rss_bytes', 'Peak resident memory of any process running the stage'),
+    'stage_slowest_batch_seconds': ('slowest_batch_seconds', 'Serialize plus network time of the slowest batch'),
+    'stage_success': ('success', '1 if the stage finished, 0 if it raised'),
+    'stage_finished_timestamp_seconds': ('finished_at', 'Unix time the stage finished'),
+}
+BATCH_PHASES = ['generate', 'serialize', 'network']
+
+class Metrics:
+    # Counters for this process, summarized per stage by stage(). Worker processes
+    # hand theirs back with every shard result (see run_shards). Batch time is split
+    # into generate (building the batch), serialize (sink time outside the socket)
+    # and network (blocked on the socket, including waiting for the server's reply).
+    COUNTERS = ['rows', 'batches', 'queries', 'bytes_sent'] + [f'{phase}_seconds' for phase in BATCH_PHASES]
+
+    def __init__(self):
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.batch_timings = []
+        self.stages = []
+        self.json_path = None
+        self.prometheus_path = None
+        self.profiler = None
+        self._worker_peak = 0
+        self._lock = threading.Lock()
+
+    def configure(self, json_path=None, prometheus_path=None, profiler=None):
+        # Both files are rewritten after every stage. profiler is a directory to write
+        # StackSampler's <stage>.folded into, or a callable taking the stage name and
+        # returning a context manager to run around the stage (e.g. to start py-spy).
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.profiler = profiler
+
+    def add(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self.counters[name] += amount
+
+    def record_batch(self, table, rows, generate_seconds, serialize_seconds, network_seconds, bytes_sent):
+        timing = {
+            'table': table, 'rows': rows, 'generate_seconds': generate_seconds,
+            'serialize_seconds': serialize_seconds, 'network_seconds': network_seconds, 'bytes_sent': bytes_sent
+        }
+        with self._lock:
+            self.batch_timings.append(timing)
+            self.counters['batches'] += 1
+            for name in ['rows', 'bytes_sent', 'generate_seconds', 'serialize_seconds', 'network_seconds']:
+                self.counters[name] += timing[name]
+
+    def take(self):
+        # Everything counted since the last take, for a worker to return to the parent
+        with self._lock:
+            counters, batch_timings = self.counters, self.batch_timings
+            self.counters, self.batch_timings = dict.fromkeys(self.COUNTERS, 0), []
+        return counters, batch_timings, peak_rss() or 0
+
+    def merge(self, taken):
+        counters, batch_timings, peak = taken
+        with self._lock:
+            for name, amount in counters.items():
+                self.counters[name] += amount
+            self.batch_timings.extend(batch_timings)
+            self._worker_peak = max(self._worker_peak, peak)
+
+    @contextmanager
+    def _profile(self, stage):
+        if self.profiler is None:
+            yield None
+        elif callable(self.profiler):
+            with self.profiler(stage):
+                yield None
+        else:
+            path = os.path.join(self.profiler, f'{stage}.folded')
+            with StackSampler(path):
+                yield path
+
+    @contextmanager
+    def stage(self, name):
+        # Stages nest (generate_dimension_data runs generate_dim_customer), and
+        # resetting the high-water mark would hide the enclosing stage's peak so
+        # far: it is kept aside and handed back with this stage's peak at the end
+        with self._lock:
+            before, first_batch = dict(self.counters), len(self.batch_timings)
+            outer_peak, self._worker_peak = self._worker_peak, 0
+        outer_peak = max(outer_peak, peak_rss() or 0)
+        _reset_peak_rss()
+        started_at = time.time()
+        started = time.perf_counter()
+        success, profile = False, None
+        try:
+            with self._profile(name) as profile:
+                yield
+            success = True
+        finally:
+            seconds = time.perf_counter() - started
+            with self._lock:
+                summary = {name: self.counters[name] - before[name] for name in self.COUNTERS}
+                batch_timings = self.batch_timings[first_batch:]
+                worker_peak = self._worker_peak
+            summary.update({
+                'stage': name, 'success': int(success), 'started_at': started_at, 'finished_at': time.time(),
+                'seconds': seconds, 'rows_per_second': summary['rows'] / seconds if seconds else 0.0,
+                'peak_rss_bytes': max(peak_rss() or 0, worker_peak),
+                'slowest_batch_seconds': max(
+                    (timing['serialize_seconds'] + timing['network_seconds'] for timing in batch_timings), default=0.0
+                ),
+                'profile': profile, 'batch_timings': batch_timings
+            })
+            with self._lock:
+                self._worker_peak = max(outer_peak, summary['peak_rss_bytes'])
+            self.stages.append(summary)
+            print(self.report(summary))
+            self.export()
+
+    def report(self, summary):
+        return (
+            f"{summary['stage']}: {summary['rows']} rows in {summary['seconds']:.2f}s "
+            f"({summary['rows_per_second']:.0f} rows/s); generate {summary['generate_seconds']:.2f}s, "
+            f"serialize {summary['serialize_seconds']:.2f}s, network {summary['network_seconds']:.2f}s; "
+            f"{summary['queries']} queries, {summary['bytes_sent'] / 2**20:.1f} MiB sent, "
+            f"peak RSS {summary['peak_rss_bytes'] / 2**20:.0f} MiB"
+        )
+
+    def summary(self):
+        return {'generated_at': time.time(), 'stages': self.stages}
+
+    def prometheus(self):
+        # The last run of every stage, in the text format node_exporter's textfile collector reads
+        latest = {summary['stage']: summary for summary in self.stages}
+        lines = []
+        for suffix, (field, description) in PROMETHEUS_GAUGES.items():
+            lines += [f'# HELP {METRICS_PREFIX}_{suffix} {description}', f'# TYPE {METRICS_PREFIX}_{suffix} gauge']
+            lines += [f'{METRICS_PREFIX}_{suffix}{{stage="{stage}"}} {summary[field]}' for stage, summary in latest.items()]
+        lines += [
+            f'# HELP {METRICS_PREFIX}_stage_phase_seconds Batch time spent generating, serializing and on the network',
+            f'# TYPE {METRICS_PREFIX}_stage_phase_seconds gauge'
+        ]
+        for stage, summary in latest.items():
+            lines += [
+                f'{METRICS_PREFIX}_stage_phase_seconds{{stage="{stage}",phase="{phase}"}} {summary[f"{phase}_seconds"]}'
+                for phase in BATCH_PHASES
+            ]
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        if self.json_path:
+            _write_atomically(self.json_path, json.dumps(self.summary(), indent=2))
+        if self.prometheus_path:
+            _write_atomically(self.prometheus_path, self.prometheus())
+
+# Exports are configured by load_settings, from METRICS_JSON_FILE, METRICS_PROMETHEUS_FILE and METRICS_PROFILE_DIR
+metrics = Metrics()
+
+def measured_stage(function):
+    # Runs every call of a stage function inside metrics.stage, named after the function
+    @functools.wraps(function)
+    def run(*args, **kwargs):
+        with metrics.stage(function.__name__):
+            return function(*args, **kwargs)
+    return run
+
+class ClickHousePool:
+    # Hands out one client per caller (thread, writer, streaming read).
+    # Clients connect lazily on first use, idle ones are health-checked
+    # before reuse, and a client that raised mid-use is thrown away.
+    def __init__(self, config, max_idle=8, health_check_interval=30, retries=3, retry_backoff=1.0):
+        self.config = config
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return metered_client(**self.config)
+                client, idle_since = self._idle.pop()
+            if time.monotonic() - idle_since < self.health_check_interval:
+                return client
+            try:
+                if client.connection.ping():
+                    return client
+            except Exception:
+                pass
+            client.disconnect()
+
+    def _checkin(self, client):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append((client, time.monotonic()))
+                return
+        client.disconnect()
+
+    @contextmanager
+    def connection(self):
+        # One checkout per query: execute, each insert attempt and each streaming read
+        metrics.add(queries=1)
+        client = self._checkout()
+        try:
+            yield client
+        except BaseException:
+            # Covers abandoned streaming reads too: the socket may be mid-result
+            client.disconnect()
+            raise
+        self._checkin(client)
+
+    def execute(self, query, params=None, **kwargs):
+        with self.connection() as client:
+            return client.execute(query, params, **kwargs)
+
+    def insert(self, query, data, token, settings=None, **kwargs):
+        # Retried batches carry the same insert_deduplication_token, so a batch
+        # the server committed before the connection dropped is not written twice
+        settings = dict(settings or {}, insert_deduplication_token=token)
+        for attempt in range(self.retries + 1):
+            try:
+                with self.connection() as client:
+                    return client.execute(query, data, settings=settings, **kwargs)
+            except retryable_errors() as error:
+                if attempt == self.retries:
+                    raise
+                delay = self.retry_backoff * 2 ** attempt
+                print(f"Insert {token} failed ({error}); retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for client, _ in idle:
+            client.disconnect()
+
+ch_pool = ClickHousePool(CLICKHOUSE_CONFIG)
+
+RISK_PROFILES = ['Low', 'Medium', 'High']
+
+# Every categorical choice the generators make: name -> {value: weight}, or
+# {condition: {value: weight}} for a choice that depends on another column.
+# Edit the weights here, or call register_distribution before a run.
+DISTRIBUTION_WEIGHTS = {
+    # Dim_Customer
+    'age_group': dict.fromkeys(['18-24', '25-34', '35-44', '45-54', '55+'], 1),
+    'gender': dict.fromkeys(['M', 'F', 'O'], 1),
+    'membership_status': dict.fromkeys(['Gold', 'Silver', 'Bronze', 'None'], 1),
+    'business_risk_class': dict.fromkeys(['High Risk', 'Medium Risk', 'Low Risk', 'Not Classified'], 1),
+    'is_pep': {True: 0.1, False: 0.9},
+    'is_cash_intensive': {True: 0.2, False: 0.8},
+    'tpr_threshold_exceeded': {True: 0.3, False: 0.7},
+    'transacts_hr_jurisdictions': {True: 0.1, False: 0.9},
+    'preferred_channel': dict.fromkeys(['Email', 'SMS', 'App Notification', 'Post'], 1),
+    'lifecycle_stage': dict.fromkeys(['Prospect', 'First-Time', 'Regular', 'VIP'], 1),
+    'consent_marketing': {True: 1, False: 1},
+    'consent_data_share': {True: 1, False: 1},
+    'risk_profile': {'Low': 0.7, 'Medium': 0.2, 'High': 0.1},
+    # Dim_Product
+    'product_category': {'Auto Loan': 0.3, 'Mortgage': 0.25, 'Business Loan': 0.2, 'Personal Loan': 0.15, 'Credit Card': 0.1},
+    # Fact_Sales: approval by the customer's risk_profile
+    'sale_approval': {
+        'Low': {True: 0.9, False: 0.1},
+        'Medium': {True: 0.6, False: 0.4},
+        'High': {True: 0.2, False: 0.8}
+    },
+    # Dim_Loan
+    'loan_term': dict.fromkeys([12, 24, 36, 60, 84, 120, 180, 240, 360], 1),
+    'loan_status': {'Active': 0.7, 'Closed': 0.2, 'Defaulted': 0.05, 'Delinquent': 0.05},
+    # Fact_Loan_Repayment: payment status by (loan_status, risk_rating), see payment_status_condition
+    'payment_status': {
+        ('Active', 'High'): {'Paid': 0.7, 'Bounced': 0.2, 'Partial': 0.1},
+        ('Active', 'Medium'): {'Paid': 0.8, 'Bounced': 0.15, 'Partial': 0.05},
+        ('Active', 'Low'): {'Paid': 0.9, 'Bounced': 0.08, 'Partial': 0.02},
+        ('Delinquent', None): {'Partial': 0.3, 'Overdue': 0.7},
+        ('Defaulted', None): {'Defaulted': 1}
+    },
+    'payment_mode': dict.fromkeys(['UPI', 'NEFT', 'Auto-Debit', 'Cash', 'Cheque'], 1),
+    'bounce_reason': dict.fromkeys(['Insufficient Funds', 'Account Closed', 'Payment Stopped', 'Technical Error'], 1)
+}
 
-    # Drop each table
-    for table in tables:
-        table_name = table[0]  # Extract table name
-        ch_client.execute(f"DROP TABLE IF EXISTS default.{table_name}")
-
-    print("All tables dropped successfully!")
-
-    print("Creating new tables...")
-    ch_client.execute('''
-        CREATE TABLE IF NOT EXISTS Dim_Time (
-            date_id         Int32,
-            date            Date,
-            month           Int8,
-            year           Int16
-        ) ENGINE = MergeTree()
-        ORDER BY date_id
-    ''')
+class Categorical:
+    # A weighted choice prepared once. Scalar draws follow random.choices (one
+    # random() and a bisect over the cumulative weights) without re-validating
+    # and re-summing the weights per call; batched draws search the normalized
+    # cumulative weights with one uniform per row, like Generator.choice(p=...).
+    def __init__(self, values, weights=None):
+        self.values = list(values)
+        self.weights = [1.0] * len(self.values) if weights is None else [float(weight) for weight in weights]
+        if len(self.weights) != len(self.values) or min(self.weights) < 0 or sum(self.weights) <= 0:
+            raise ValueError(f"Invalid weights {self.weights} for {self.values}")
+        self.cum_weights = list(itertools.accumulate(self.weights))
+        self.total = self.cum_weights[-1]
+        self.cdf = np.array(self.cum_weights) / self.total
+        self.array = np.array(self.values, dtype=object if isinstance(self.values[0], str) else None)
+
+    def draw(self):
+        return self.values[bisect.bisect(self.cum_weights, random.random() * self.total, 0, len(self.values) - 1)]
+
+    def indices(self, rng, size):
+        return np.minimum(np.searchsorted(self.cdf, rng.random(size), side='right'), len(self.values) - 1)
+
+    def sample(self, rng, size):
+        return self.array[self.indices(rng, size)]
+
+    def probability(self, value):
+        return self.weights[self.values.index(value)] / self.total
+
+class CategoricalTable:
+    # One Categorical per condition over a shared list of values. Batched draws
+    # take every row's condition as an index into .conditions and return indices into .values.
+    def __init__(self, weights):
+        self.conditions = list(weights)
+        self.values = []
+        for choice in weights.values():
+            self.values.extend(value for value in choice if value not in self.values)
+        self.choices = {
+            condition: Categorical(self.values, [choice.get(value, 0.0) for value in self.values])
+            for condition, choice in weights.items()
+        }
+        self.cdf = np.array([self.choices[condition].cdf for condition in self.conditions])
+        self.array = np.array(self.values, dtype=object if isinstance(self.values[0], str) else None)
+
+    def __getitem__(self, condition):
+        return self.choices[condition]
+
+    def draw(self, condition):
+        return self.choices[condition].draw()
+
+    def condition_indices(self, conditions):
+        return np.array([self.conditions.index(condition) for condition in conditions], dtype=np.intp)
+
+    def indices(self, rng, condition_indices, shape=None):
+        # shape lets one row of conditions drive several draws, e.g. (loans, installments)
+        shape = shape or (len(condition_indices),)
+        draws = rng.random(shape)
+        cdf = self.cdf[condition_indices].reshape((shape[0],) + (1,) * (len(shape) - 1) + (-1,))
+        return np.minimum((draws[..., None] >= cdf).sum(axis=-1), len(self.values) - 1)
+
+    def sample(self, rng, condition_indices):
+        return self.array[self.indices(rng, condition_indices)]
+
+DISTRIBUTIONS = {}
+
+def register_distribution(name, weights):
+    DISTRIBUTIONS[name] = (
+        CategoricalTable(weights) if isinstance(next(iter(weights.values())), dict)
+        else Categorical(list(weights), list(weights.values()))
+    )
+
+for _name, _weights in DISTRIBUTION_WEIGHTS.items():
+    register_distribution(_name, _weights)
+
+def distribution(name):
+    return DISTRIBUTIONS[name]
+
+# Dimension columns kept in memory by DimensionCache: table -> (key column, {column: kind}).
+# 'category' columns are stored as small integer codes plus a vocabulary.
+DIMENSION_CACHE_SPEC = {
+    'Dim_Time': ('date_id', {'date': 'date', 'month': 'int8', 'year': 'int16'}),
+    'Dim_Product': ('product_id', {'price': 'float64', 'category': 'category'}),
+    'Dim_Region': ('region_id', {'region_name': 'category'}),
+    'Dim_Sales_Channel': ('channel_id', {'channel_name': 'category'}),
+    'Dim_Customer': ('customer_id', {'risk_profile': 'category'}),
+}
 
-    ch_client.execute('''
-        CREATE TABLE IF NOT EXISTS Dim_Product (
-            product_id      Int32,
-            product_name    String,
-            category        String,
-            price          Float64,
-            supplier_id     Int32
-        ) ENGINE = MergeTree()
-        ORDER BY product_id
-    ''')
+class DimTable:
+    # Dimension ids are small dense integers, so a flat id -> position array
+    # replaces both the per-row SELECT and a Python dict lookup.
+    def __init__(self, name, ids, columns, vocabularies):
+        self.name = name
+        self.ids = np.asarray(ids, dtype=np.int32)
+        size = int(self.ids.max()) + 1 if len(self.ids) else 1
+        self.index = np.full(size, -1, dtype=np.int32)
+        self.index[self.ids] = np.arange(len(self.ids), dtype=np.int32)
+        self.columns = columns
+        self.vocabularies = vocabularies
+        self.hits = 0
+        self.misses = 0
+
+    def positions(self, keys):
+        keys = np.asarray(keys, dtype=np.int64)
+        in_range = (keys >= 0) & (keys < len(self.index))
+        positions = np.full(len(keys), -1, dtype=np.int32)
+        positions[in_range] = self.index[keys[in_range]]
+        found = int(np.count_nonzero(positions >= 0))
+        self.hits += found
+        self.misses += len(keys) - found
+        return positions
+
+    def get(self, column, key, default=None):
+        position = self.index[key] if 0 <= key < len(self.index) else -1
+        if position < 0:
+            self.misses += 1
+            return default
+        self.hits += 1
+        value = self.columns[column][position]
+        if column in self.vocabularies:
+            return self.vocabularies[column][value]
+        return value.item()
+
+    def take(self, column, keys, default=None):
+        # Vectorized lookup; categorical columns are decoded to an object array
+        positions = self.positions(keys)
+        missing = positions < 0
+        values = self.columns[column][positions]
+        if column in self.vocabularies:
+            decoded = np.array(self.vocabularies[column] + [default], dtype=object)
+            values = np.where(missing, len(decoded) - 1, values)
+            return decoded[values]
+        if missing.any():
+            values = values.astype(object) if default is None else values.copy()
+            values[missing] = default
+        return values
+
+    def codes(self, column, keys):
+        # Raw category codes (-1 for unknown keys) for callers that map codes themselves
+        positions = self.positions(keys)
+        return np.where(positions >= 0, self.columns[column][positions], -1)
+
+    def nbytes(self):
+        total = self.ids.nbytes + self.index.nbytes + sum(col.nbytes for col in self.columns.values())
+        for vocabulary in self.vocabularies.values():
+            total += sum(sys.getsizeof(value) for value in vocabulary)
+        return total
+
+class DimensionCache:
+    # Loads every dimension table once so fact generators never go back to
+    # ClickHouse for per-row lookups. Tables are read in blocks and kept as NumPy
+    # arrays only: a 50M-row Dim_Customer ends up as its ids plus one int8
+    # risk_profile code per customer, never as Python lists or dicts.
+    def __init__(self, client, tables=None, block_size=1000000):
+        self.client = client
+        self.table_names = list(tables or DIMENSION_CACHE_SPEC)
+        self.block_size = block_size
+        self.tables = {}
+
+    def load(self):
+        for table in self.table_names:
+            key, spec = DIMENSION_CACHE_SPEC[table]
+            names = [key] + list(spec)
+            blocks = {name: [] for name in names}
+            # Category codes in first-seen order while streaming, sorted at the end
+            lookups = {column: {} for column, kind in spec.items() if kind == 'category'}
+            for rows in self.client.stream(f"SELECT {', '.join(names)} FROM {table}", self.block_size):
+                block = dict(zip(names, zip(*rows)))
+                blocks[key].append(np.array(block[key], dtype=np.int32))
+                for column, kind in spec.items():
+                    values = block[column]
+                    if kind == 'category':
+                        lookup = lookups[column]
+                        blocks[column].append(np.array([lookup.setdefault(v, len(lookup)) for v in values], np.int32))
+                    else:
+                        blocks[column].append(np.array(values, dtype='datetime64[D]' if kind == 'date' else kind))
+
+            def concatenate(name, dtype):
+                return np.concatenate(blocks[name]) if blocks[name] else np.array([], dtype=dtype)
+
+            columns, vocabularies = {}, {}
+            for column, kind in spec.items():
+                if kind == 'category':
+                    vocabulary = sorted(lookups[column])
+                    position = {value: code for code, value in enumerate(vocabulary)}
+                    code_type = np.int8 if len(vocabulary) < 128 else np.int32
+                    recode = np.array([position[value] for value in lookups[column]], dtype=code_type)
+                    columns[column] = recode[concatenate(column, np.int32)]
+                    vocabularies[column] = vocabulary
+                else:
+                    columns[column] = concatenate(column, 'datetime64[D]' if kind == 'date' else kind)
+            # Rows come back from a many-part MergeTree in no fixed order, and seeded
+            # draws index into the ids, so every worker keeps them sorted by key
+            ids = concatenate(key, np.int32)
+            order = np.argsort(ids, kind='stable')
+            columns = {column: values[order] for column, values in columns.items()}
+            self.tables[table] = DimTable(table, ids[order], columns, vocabularies)
+        return self
+
+    def __getitem__(self, table):
+        return self.tables[table]
+
+    def keys(self, table):
+        return self.tables[table].ids.tolist()
+
+    def get(self, table, column, key, default=None):
+        return self.tables[table].get(column, key, default)
+
+    def take(self, table, column, keys, default=None):
+        return self.tables[table].take(column, keys, default)
+
+    def count_picks(self, table, picks):
+        # Keys drawn straight from a table's ids never miss; counted so report() covers them
+        self.tables[table].hits += picks
+
+    def report(self):
+        lines = []
+        for table in self.tables.values():
+            lookups = table.hits + table.misses
+            hit_rate = table.hits / lookups * 100 if lookups else 100.0
+            lines.append(
+                f"{table.name}: {len(table.ids)} rows, {table.nbytes() / 1024:.1f} KiB, "
+                f"{lookups} lookups, hit rate {hit_rate:.2f}%"
+            )
+        return '\n'.join(lines)
+
+# Fixed per-stage keys mixed into shard seeds so stages never share a random stream
+STAGE_SEED_KEYS = {'Fact_Sales': 1, 'Dim_Loan': 2, 'Fact_Loan_Repayment': 3, 'Dim_Customer': 4}
+
+# Rows (or source ids) per shard. Shard boundaries and seeds depend only on
+# this value and the master seed, never on the worker count.
+DEFAULT_SHARD_SIZE = 100000
+
+_worker_cache = None
+
+def resolve_seed(seed):
+    # A run without an explicit seed still gets one, printed so it can be replayed
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy % (2**63))
+        print(f"Using random seed {seed}")
+    return seed
+
+# The date the data is generated "as of": loan schedules, due repayments and deletion
+# dates are relative to it. Fixing it (AS_OF_DATE=2025-06-30 in .env, or as_of=... on
+# a stage) makes a seeded run produce the same rows whatever day it runs on.
+AS_OF_DATE = None
+
+def resolve_as_of(as_of=None):
+    as_of = as_of or AS_OF_DATE
+    if as_of is None:
+        return datetime.now().date()
+    if isinstance(as_of, datetime):
+        return as_of.date()
+    return as_of if isinstance(as_of, date) else date.fromisoformat(as_of)
+
+def shard_rng(seed, stage, shard_index):
+    # Reseed the python engine's `random` and return the numpy engine's generator
+    sequence = np.random.SeedSequence([seed, STAGE_SEED_KEYS[stage], shard_index])
+    random.seed(int(sequence.generate_state(1, np.uint64)[0]))
+    return np.random.default_rng(sequence)
+
+def plan_shards(first_id, count, shard_size):
+    # Split [first_id, first_id + count) into (shard_index, first_id, size) on fixed boundaries
+    shards = []
+    next_id, last_id = first_id, first_id + count - 1
+    while next_id <= last_id:
+        shard_index = (next_id - 1) // shard_size
+        shard_end = min((shard_index + 1) * shard_size, last_id)
+        shards.append((shard_index, next_id, shard_end - next_id + 1))
+        next_id = shard_end + 1
+    return shards
+
+def _init_worker(parent_sink, parent_distributions, parent_config, parent_pool_dir):
+    # Each worker process gets its own pool (never the parent's forked sockets),
+    # writes to the parent's sink and loads its own dimension cache on demand.
+    # Settings come from the parent, since a spawned worker never ran load_settings.
+    global ch_pool, sink, _worker_cache, metrics, FAKER_POOL_CACHE_DIR
+    CLICKHOUSE_CONFIG.update(parent_config)
+    FAKER_POOL_CACHE_DIR = parent_pool_dir
+    ch_pool = ClickHousePool(CLICKHOUSE_CONFIG)
+    sink = parent_sink
+    _worker_cache = None
+    metrics = Metrics()
+    DISTRIBUTIONS.update(parent_distributions)
+
+def worker_cache():
+    global _worker_cache
+    if _worker_cache is None:
+        _worker_cache = DimensionCache(sink).load()
+    return _worker_cache
+
+def run_shards(task, shards, workers=1, cache=None):
+    # Run task(*shard) for every shard, in-process or on a process pool; returns results in shard order
+    if workers <= 1:
+        return [task(*shard, cache=cache) for shard in shards]
+
+    initargs = (sink, DISTRIBUTIONS, CLICKHOUSE_CONFIG, FAKER_POOL_CACHE_DIR)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as pool:
+        futures = [pool.submit(_measured_shard, task, *shard) for shard in shards]
+        results = []
+        for future in futures:
+            result, taken = future.result()
+            metrics.merge(taken)
+            results.append(result)
+        return results
+
+def _measured_shard(task, *shard):
+    # Runs in a worker: returns the shard's metrics along with its result
+    _reset_peak_rss()
+    return task(*shard), metrics.take()
+
+# Hand NumPy columns to the driver as arrays instead of Python lists.
+# Needs clickhouse-driver's NumPy extras (numpy + pandas) installed.
+USE_NUMPY_INSERTS = False
+
+def columns_from_rows(names, rows):
+    # Transpose row tuples into one sequence per column
+    if not rows:
+        return {name: [] for name in names}
+    return dict(zip(names, zip(*rows)))
+
+class ClickHouseSink:
+    # Default sink: batches are inserted into ClickHouse through the connection pool
+    checkpoints = True
+
+    def execute(self, query, params=None, **kwargs):
+        return ch_pool.execute(query, params, **kwargs)
+
+    def stream(self, query, block_size, params=None):
+        # Row lists of at most block_size rows, read without holding the whole result
+        return batched(stream_query(query, params, block_size=block_size), block_size)
+
+    def write(self, table, columns, use_numpy=False, scope=None):
+        # Column-oriented insert: the driver serializes each column straight into
+        # a Native block instead of walking a list of per-row dicts. The batch is
+        # identified by its scope (the stage run, so a resumed run redoes batches
+        # under the same tokens), table, first key and size for idempotent retries.
+        # Without a scope every call gets its own, and only ClickHousePool.insert's
+        # retries of this batch are deduplicated.
+        names = list(columns)
+        settings = None
+        if use_numpy:
+            data = [np.asarray(values) for values in columns.values()]
+            settings = {'use_numpy': True}
+        else:
+            data = [values.tolist() if hasattr(values, 'tolist') else values for values in columns.values()]
+        rows = len(data[0]) if data else 0
+        token = f"{scope or uuid.uuid4().hex}:{table}:{data[0][0] if rows else 0}:{rows}"
+        ch_pool.insert(
+            f"INSERT INTO {table} ({', '.join(names)}) VALUES", data, token, settings=settings, columnar=True
+        )
+        return rows
+
+CREATE_TABLE_PATTERN = re.compile(r'CREATE TABLE (?:IF NOT EXISTS )?(\w+) \((.*)\)\s*ENGINE', re.S)
+SIMPLE_SELECT_PATTERN = re.compile(r'SELECT ([\w, ]+) FROM (\w+)$')
+AGGREGATE_SELECT_PATTERN = re.compile(r'SELECT (max|count)\((\w*)\) FROM (\w+)$')
+
+def _split_top_level(text, separator):
+    # Split on separator outside parentheses, e.g. column definitions of a CREATE TABLE
+    parts, depth, start = [], 0, 0
+    for i, char in enumerate(text):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+def parse_table_schema(ddl):
+    # (table, [(column, type)]) from one of the CREATE TABLE statements in create_tables
+    match = CREATE_TABLE_PATTERN.search(ddl)
+    columns = []
+    for definition in _split_top_level(match.group(2), ','):
+        name, _, rest = definition.strip().partition(' ')
+        if name.upper() in ('INDEX', 'PROJECTION', 'CONSTRAINT'):
+            continue
+        # The type ends at the first space outside parentheses (before DEFAULT, CODEC, ...)
+        columns.append((name, _split_top_level(rest.strip(), ' ')[0]))
+    return match.group(1), columns
+
+class FileSink:
+    # Writes every batch to its own file under root/<table>/, named after the
+    # batch's first key and size like the ClickHouse deduplication token, so a
+    # retried or resumed batch overwrites its file. Worker processes and writer
+    # threads each write their own files. Column types come from the DDL that
+    # create_tables runs through the sink, kept as root/<table>/schema.sql.
+    # Generators read back what earlier stages wrote from these files: plain
+    # column selects, max()/count() for append runs and the named queries the
+    # Dim_Loan and repayment stages stream (see FileSink.queries).
+    checkpoints = False
+    extension = None
+
+    def __init__(self, root, compression=None):
+        self.root = root
+        self.compression = compression
+        self.schemas = {}
+        self._lookups = None
+        os.makedirs(root, exist_ok=True)
+        for table in self._tables():
+            with open(os.path.join(root, table, 'schema.sql')) as schema:
+                self._add_schema(schema.read())
+
+    def _tables(self):
+        return sorted(
+            name for name in os.listdir(self.root) if os.path.exists(os.path.join(self.root, name, 'schema.sql'))
+        )
+
+    def _add_schema(self, ddl):
+        table, columns = parse_table_schema(ddl)
+        self.schemas[table] = dict(columns)
+        return table
+
+    def __getstate__(self):
+        # Worker processes load their own lookups
+        return dict(self.__dict__, _lookups=None)
+
+    def _files(self, table):
+        directory = os.path.join(self.root, table)
+        if not os.path.isdir(directory):
+            raise ValueError(f"{self.root} has no {table} table; run the stage that creates it first")
+        return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(self.extension))
+
+    def queries(self):
+        # The generators' named reads, answered from the batch files: query -> handler(params) returning blocks
+        return {
+            APPROVED_SALES_SHARDS_QUERY: self._approved_sales_shards,
+            APPROVED_SALES_QUERY: self._approved_sales,
+            LOAN_SALES_WATERMARK_QUERY: self._loan_sales_watermark,
+            REPAYMENT_SHARDS_QUERY: self._repayment_shards,
+            REPAYMENT_LOANS_QUERY: self._repayment_loans,
+        }
+
+    def execute(self, query, params=None, columnar=False, **kwargs):
+        # Just enough of ClickHouse for create_tables, DimensionCache, next_id and the named queries
+        if query in self.queries():
+            rows = [row for block in self.queries()[query](params) for row in block]
+            return [list(values) for values in zip(*rows)] if columnar else rows
+        query = ' '.join(query.split())
+        if query.startswith('SELECT name FROM system.tables'):
+            return [(table,) for table in self._tables()]
+        if query.startswith('DROP TABLE IF EXISTS'):
+            table = query.split('.')[-1].split()[-1]
+            shutil.rmtree(os.path.join(self.root, table), ignore_errors=True)
+            self.schemas.pop(table, None)
+            return []
+        if query.startswith('CREATE TABLE'):
+            table = self._add_schema(query)
+            os.makedirs(os.path.join(self.root, table), exist_ok=True)
+            with open(os.path.join(self.root, table, 'schema.sql'), 'w') as schema:
+                schema.write(query + '\n')
+            return []
+        aggregate = AGGREGATE_SELECT_PATTERN.match(query)
+        if aggregate:
+            return [(self._aggregate(*aggregate.groups()),)]
+        names, files = self._select(query)
+        data = {name: [] for name in names}
+        for path in files:
+            for name, values in zip(names, self._read_file(path, names)):
+                data[name].extend(values)
+        columns = [data[name] for name in names]
+        return columns if columnar else list(zip(*columns))
+
+    def stream(self, query, block_size, params=None):
+        # One block per batch file
+        if query in self.queries():
+            yield from self.queries()[query](params)
+            return
+        names, files = self._select(query)
+        for path in files:
+            yield list(zip(*self._read_file(path, names)))
+
+    def _aggregate(self, function, column, table):
+        # max(column) is 0 for an empty table, as in ClickHouse
+        if function == 'count':
+            return sum(self._key_range(path)[2] for path in self._files(table))
+        return max((max(self._read_file(path, [column])[0], default=0) for path in self._files(table)), default=0)
+
+    def _key_range(self, path):
+        # (first key, last key, rows) of a batch file, from its name (see write)
+        first, rows = os.path.basename(path)[:-len(self.extension)].rsplit('-', 2)[1:]
+        return int(first), int(first) + int(rows) - 1, int(rows)
+
+    def _batches(self, table, names, first_id, last_id=None):
+        # NumPy columns of the rows whose key (the first name) is in [first_id, last_id],
+        # in key order. Fact_Sales and Dim_Loan batches hold consecutive keys, so
+        # files outside the range are skipped by name.
+        for path in self._files(table):
+            first, last, _ = self._key_range(path)
+            if last < first_id or (last_id is not None and first > last_id):
+                continue
+            columns = dict(zip(names, (np.asarray(values) for values in self._read_file(path, names))))
+            keep = columns[names[0]] >= first_id
+            if last_id is not None:
+                keep &= columns[names[0]] <= last_id
+            yield {name: values[keep] for name, values in columns.items()}
+
+    def _approved_sales_shards(self, params):
+        counts = {}
+        for batch in self._batches('Fact_Sales', ['sale_id', 'status'], params['first_id']):
+            sale_ids = batch['sale_id'][batch['status'] == 'Approved']
+            for shard, approved in zip(*np.unique((sale_ids - 1) // params['shard_size'], return_counts=True)):
+                counts[int(shard)] = counts.get(int(shard), 0) + int(approved)
+        yield sorted(counts.items())
+
+    def _approved_sales(self, params):
+        # Application dates and risk profiles come from the dimension files, like the JOINs
+        if self._lookups is None:
+            self._lookups = DimensionCache(self, tables=['Dim_Time', 'Dim_Customer']).load()
+        names = ['sale_id', 'customer_id', 'product_id', 'date_id', 'channel_id', 'status']
+        for batch in self._batches('Fact_Sales', names, params['first_id'], params['last_id']):
+            approved = batch['status'] == 'Approved'
+            customer_ids = batch['customer_id'][approved]
+            yield list(zip(
+                batch['sale_id'][approved].tolist(), customer_ids.tolist(), batch['product_id'][approved].tolist(),
+                self._lookups.take('Dim_Time', 'date', batch['date_id'][approved]).tolist(),
+                self._lookups.take('Dim_Customer', 'risk_profile', customer_ids).tolist(),
+                batch['channel_id'][approved].tolist()
+            ))
+
+    def _loan_sales_watermark(self, params):
+        # sale_id of the params['loans']-th approved sale (0 for none)
+        remaining, watermark = params['loans'], 0
+        for batch in self._batches('Fact_Sales', ['sale_id', 'status'], 1):
+            if remaining <= 0:
+                break
+            sale_ids = batch['sale_id'][batch['status'] == 'Approved'][:remaining]
+            if len(sale_ids):
+                watermark = int(sale_ids[-1])
+            remaining -= len(sale_ids)
+        yield [(watermark,)]
+
+    def _repaying_loans(self, names, first_id, last_id=None):
+        for batch in self._batches('Dim_Loan', names, first_id, last_id):
+            repaying = np.isin(batch['loan_status'], ['Active', 'Delinquent', 'Defaulted'])
+            yield {name: values[repaying] for name, values in batch.items()}
+
+    def _repayment_shards(self, params):
+        installments = {}
+        today = np.datetime64(params['today'], 'D')
+        for loans in self._repaying_loans(['loan_id', 'term_months', 'start_date', 'loan_status'], params['first_id']):
+            elapsed = (today - loans['start_date'].astype('datetime64[D]')).astype(np.int64)
+            due = np.minimum(loans['term_months'], np.maximum(0, elapsed // 30))
+            shards = (loans['loan_id'] - 1) // params['shard_size']
+            for shard in np.unique(shards).tolist():
+                installments[shard] = installments.get(shard, 0) + int(due[shards == shard].sum())
+        yield sorted(installments.items())
+
+    def _repayment_loans(self, params):
+        names = [
+            'loan_id', 'customer_id', 'loan_amount', 'interest_rate', 'term_months', 'start_date', 'loan_status',
+            'risk_rating'
+        ]
+        for loans in self._repaying_loans(names, params['first_id'], params['last_id']):
+            yield list(zip(*[loans[name].tolist() for name in names]))
+
+    def _select(self, query):
+        match = SIMPLE_SELECT_PATTERN.match(' '.join(query.split()))
+        if match is None:
+            raise NotImplementedError(f"{type(self).__name__} cannot run: {query}")
+        return [name.strip() for name in match.group(1).split(',')], self._files(match.group(2))
+
+    def write(self, table, columns, use_numpy=False, scope=None):
+        names = list(columns)
+        data = [values.tolist() if hasattr(values, 'tolist') else list(values) for values in columns.values()]
+        rows = len(data[0]) if data else 0
+        path = os.path.join(self.root, table, f"{table}-{data[0][0] if rows else 0:012d}-{rows}{self.extension}")
+        # Written under a temporary name so a crash never leaves a truncated file behind
+        self._write_file(path + '.tmp', table, names, data)
+        # No network here: the file's size counts as bytes sent, writing it as serialization
+        _count_socket_io(0.0, os.path.getsize(path + '.tmp'))
+        os.replace(path + '.tmp', path)
+        if table in ('Dim_Time', 'Dim_Customer'):
+            self._lookups = None
+        return rows
+
+class NativeSink(FileSink):
+    # ClickHouse Native format, serialized by clickhouse_driver itself, optionally
+    # gzip-compressed. Load with: clickhouse-client --query "INSERT INTO <table> FORMAT Native" < file,
+    # or read the files directly with file('<root>/<table>/*.native.gz', Native).
+    def __init__(self, root, compression='gzip'):
+        if compression not in (None, 'gzip'):
+            raise ValueError(f"Unknown Native compression: {compression}")
+        self.extension = '.native.gz' if compression == 'gzip' else '.native'
+        super().__init__(root, compression)
+        self._context = None
+
+    def __getstate__(self):
+        return dict(super().__getstate__(), _context=None)
+
+    def context(self):
+        # Revision 0 selects the plain Native format: no block info, no custom serialization
+        if self._context is None:
+            from clickhouse_driver import Client
+            from clickhouse_driver.connection import ServerInfo
+
+            self._context = Client(host='localhost').connection.context
+            self._context.server_info = ServerInfo('file', 0, 0, 0, 0, 'UTC', '', 0)
+        return self._context
+
+    def _open(self, path, mode):
+        if self.compression == 'gzip':
+            return gzip.open(path, mode, compresslevel=1)
+        return open(path, mode)
+
+    def _write_file(self, path, table, names, data):
+        from clickhouse_driver.block import ColumnOrientedBlock
+        from clickhouse_driver.bufferedwriter import BufferedSocketWriter
+        from clickhouse_driver.streams.native import BlockOutputStream
+
+        schema = self.schemas[table]
+        block = ColumnOrientedBlock([(name, schema[name]) for name in names], data)
+        with self._open(path, 'wb') as fileobj:
+            BlockOutputStream(BufferedSocketWriter(_FileSocket(fileobj), 1 << 20), self.context()).write(block)
+
+    def _read_file(self, path, names):
+        from clickhouse_driver.bufferedreader import BufferedSocketReader
+        from clickhouse_driver.streams.native import BlockInputStream
+
+        with self._open(path, 'rb') as fileobj:
+            block = BlockInputStream(BufferedSocketReader(_FileSocket(fileobj), 1 << 20), self.context()).read()
+        columns = dict(zip([name for name, _ in block.columns_with_types], block.get_columns()))
+        return [columns[name] for name in names]
+
+class _FileSocket:
+    # The socket interface clickhouse_driver's buffered reader and writer expect, over a file
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def sendall(self, data):
+        self.fileobj.write(data)
+
+    def recv_into(self, buffer, size=0):
+        data = self.fileobj.read(size or len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+class ParquetSink(FileSink):
+    # One Parquet file per batch (needs pyarrow), readable with file('<root>/<table>/*.parquet', Parquet)
+    extension = '.parquet'
+
+    def __init__(self, root, compression='zstd'):
+        import pyarrow  # noqa: F401  fail early rather than on the first batch
+        super().__init__(root, compression)
+
+    def _write_file(self, path, table, names, data):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = self.schemas[table]
+        arrays = [pa.array(values, type=_arrow_type(schema[name])) for name, values in zip(names, data)]
+        pq.write_table(pa.Table.from_arrays(arrays, names=names), path, compression=self.compression)
+
+    def _read_file(self, path, names):
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, columns=names)
+        return [table.column(name).to_pylist() for name in names]
+
+def _arrow_type(column_type):
+    import pyarrow as pa
+
+    wrapper = re.fullmatch(r'(Nullable|LowCardinality|Array)\((.*)\)', column_type)
+    if wrapper:
+        inner = _arrow_type(wrapper.group(2))
+        return pa.list_(inner) if wrapper.group(1) == 'Array' else inner
+    return {
+        'Int8': pa.int8(), 'Int16': pa.int16(), 'Int32': pa.int32(), 'Int64': pa.int64(),
+        'UInt8': pa.uint8(), 'UInt16': pa.uint16(), 'UInt32': pa.uint32(), 'UInt64': pa.uint64(),
+        'Float32': pa.float32(), 'Float64': pa.float64(), 'Bool': pa.bool_(), 'String': pa.string(),
+        'Date': pa.date32(), 'DateTime': pa.timestamp('s')
+    }[column_type]
+
+# Where generated batches go: ClickHouse by default, or files (see set_sink)
+sink = ClickHouseSink()
+
+def set_sink(new_sink):
+    # e.g. set_sink(NativeSink('out')) before create_tables() to generate into files
+    global sink
+    sink = new_sink
+
+def insert_columns(table, columns, use_numpy=False, generate_seconds=0.0, scope=None):
+    # Records the batch in metrics; sink time outside the socket counts as serialization
+    io_seconds, io_bytes = socket_io()
+    started = time.perf_counter()
+    rows = sink.write(table, columns, use_numpy, scope)
+    seconds = time.perf_counter() - started
+    network_seconds, bytes_sent = socket_io()
+    network_seconds -= io_seconds
+    metrics.record_batch(
+        table, rows, generate_seconds, seconds - network_seconds, network_seconds, bytes_sent - io_bytes
+    )
+    return rows
+
+def insert_rows(table, rows):
+    # Lists of row dicts, as built by generate_dimension_data, go through the sink column-wise
+    return insert_columns(table, {name: [row[name] for row in rows] for name in rows[0]})
+
+class BatchWriter:
+    # Inserts every batch inline on the current connection. Time between
+    # write() calls is the caller generating the next batch.
+    def __init__(self, scope=None):
+        # scope: what deduplication tokens are unique to, e.g. the StageRun id (see ClickHouseSink.write)
+        self.scope = scope
+        self.stats = {'batches': 0, 'rows': 0, 'generate_seconds': 0.0, 'wait_seconds': 0.0, 'insert_seconds': 0.0}
+        self._started = self._mark = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(exc)
+
+    def _generated(self):
+        now = time.perf_counter()
+        generate_seconds = now - self._mark
+        self.stats['generate_seconds'] += generate_seconds
+        return now, generate_seconds
+
+    def write(self, table, columns, use_numpy=False, on_commit=None):
+        # on_commit runs once the batch's insert has succeeded (see StageRun.checkpoint)
+        started, generate_seconds = self._generated()
+        rows = insert_columns(table, columns, use_numpy, generate_seconds, self.scope)
+        if on_commit is not None:
+            on_commit()
+        self._mark = time.perf_counter()
+        self.stats['insert_seconds'] += self._mark - started
+        self.stats['batches'] += 1
+        self.stats['rows'] += rows
+
+    def close(self, active=None):
+        # active: the exception the caller is already raising, if any (see _raise_error)
+        self._elapsed = time.perf_counter() - self._started
+
+    def _raise_error(self, active=None):
+        # An insert thread's error, unless the caller is already raising one: then
+        # the caller's exception propagates, with the insert error as its cause
+        error = getattr(self, '_error', None)
+        if error is None or error is active:
+            return
+        if active is None:
+            raise error
+        raise active from error
+
+    def report(self, label):
+        stats = self.stats
+        elapsed = getattr(self, '_elapsed', time.perf_counter() - self._started)
+        rate = stats['rows'] / elapsed if elapsed else 0.0
+        return (
+            f"{label}: {stats['rows']} rows in {stats['batches']} batches, {elapsed:.2f}s ({rate:.0f} rows/s); "
+            f"generate {stats['generate_seconds']:.2f}s, backpressure {stats['wait_seconds']:.2f}s, "
+            f"insert {stats['insert_seconds']:.2f}s"
+        )
+
+class PipelinedWriter(BatchWriter):
+    # The calling thread keeps generating while writer threads drain a
+    # bounded queue. A full queue blocks write(), so
+    # at most max_in_flight batches are buffered at any time.
+    def __init__(self, writers=2, max_in_flight=4, scope=None):
+        super().__init__(scope)
+        self._queue = queue.Queue(maxsize=max_in_flight)
+        self._lock = threading.Lock()
+        self._error = None
+        self._threads = [threading.Thread(target=self._drain, daemon=True) for _ in range(writers)]
+        for thread in self._threads:
+            thread.start()
+
+    def _drain(self):
+        # Concurrent inserts each check out their own pooled connection
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue  # keep draining so the producer never blocks on a dead pipeline
+            table, columns, use_numpy, generate_seconds, on_commit = item
+            try:
+                started = time.perf_counter()
+                rows = insert_columns(table, columns, use_numpy, generate_seconds, self.scope)
+                if on_commit is not None:
+                    on_commit()
+                with self._lock:
+                    self.stats['insert_seconds'] += time.perf_counter() - started
+                    self.stats['batches'] += 1
+                    self.stats['rows'] += rows
+            except Exception as error:
+                self._error = error
+
+    def write(self, table, columns, use_numpy=False, on_commit=None):
+        started, generate_seconds = self._generated()
+        while True:
+            if self._error is not None:
+                raise self._error
+            try:
+                self._queue.put((table, columns, use_numpy, generate_seconds, on_commit), timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self._mark = time.perf_counter()
+        self.stats['wait_seconds'] += self._mark - started
+
+    def close(self, active=None):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        super().close()
+        self._raise_error(active)
+
+class AsyncWriter(BatchWriter):
+    # Submits batches to an asyncio event loop on a background thread, which
+    # keeps up to concurrency inserts running at once, each on its own pooled
+    # connection (clickhouse_driver blocks, so they run on the loop's executor).
+    # write() blocks only once max_in_flight batches are submitted but not yet
+    # committed. on_commit callbacks run in submission order, when a batch and
+    # every batch before it have committed, so checkpoints never skip a gap.
+    # The first failed insert stops the batches still waiting and is raised
+    # from the next write() or from close().
+    def __init__(self, concurrency=4, max_in_flight=8, scope=None):
+        super().__init__(scope)
+        self._lock = threading.Lock()
+        self._error = None
+        self._slots = threading.BoundedSemaphore(max(max_in_flight, concurrency))
+        self._submitted = 0
+        self._next_commit = 0
+        self._committed = {}
+        self._futures = []
+        self._loop = asyncio.new_event_loop()
+        self._loop.set_default_executor(ThreadPoolExecutor(concurrency, thread_name_prefix='insert'))
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    async def _insert(self, sequence, table, columns, use_numpy, generate_seconds, on_commit):
+        try:
+            if self._error is None:
+                started = time.perf_counter()
+                rows = await self._loop.run_in_executor(
+                    None, insert_columns, table, columns, use_numpy, generate_seconds, self.scope
+                )
+                with self._lock:
+                    self.stats['insert_seconds'] += time.perf_counter() - started
+                    self.stats['batches'] += 1
+                    self.stats['rows'] += rows
+                self._commit(sequence, on_commit)
+        except Exception as error:
+            if self._error is None:
+                self._error = error
+        finally:
+            self._slots.release()
+
+    def _commit(self, sequence, on_commit):
+        # Runs on the loop thread, so callbacks never overlap
+        self._committed[sequence] = on_commit
+        while self._next_commit in self._committed:
+            callback = self._committed.pop(self._next_commit)
+            if callback is not None:
+                callback()
+            self._next_commit += 1
+
+    def write(self, table, columns, use_numpy=False, on_commit=None):
+        started, generate_seconds = self._generated()
+        while not self._slots.acquire(timeout=0.1):
+            if self._error is not None:
+                raise self._error
+        if self._error is not None:
+            self._slots.release()
+            raise self._error
+        self._futures.append(asyncio.run_coroutine_threadsafe(
+            self._insert(self._submitted, table, columns, use_numpy, generate_seconds, on_commit), self._loop
+        ))
+        self._submitted += 1
+        self._mark = time.perf_counter()
+        with self._lock:
+            self.stats['wait_seconds'] += self._mark - started
+
+    def close(self, active=None):
+        wait(self._futures)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.run_until_complete(self._loop.shutdown_default_executor())
+        self._loop.close()
+        super().close()
+        self._raise_error(active)
+
+WRITER_BACKENDS = ['threads', 'asyncio']
+
+def open_writer(pipeline=None, scope=None):
+    # pipeline: None to insert inline, or {'writers': n, 'max_in_flight': m} to overlap
+    # generation and inserts, with 'backend': 'asyncio' for AsyncWriter (see WRITER_BACKENDS).
+    # scope: the StageRun id the batches' deduplication tokens belong to
+    if not pipeline:
+        return BatchWriter(scope)
+    if pipeline.get('backend') == 'asyncio':
+        writers = pipeline.get('writers', 4)
+        return AsyncWriter(writers, pipeline.get('max_in_flight', 2 * writers), scope)
+    return PipelinedWriter(pipeline.get('writers', 2), pipeline.get('max_in_flight', 4), scope)
+
+CHECKPOINT_TABLE = 'Generation_Checkpoints'
+
+def _rng_state(rng):
+    # Both generators a shard draws from: numpy's for the numpy engines, `random` for the python ones
+    version, internal, gauss_next = random.getstate()
+    return json.dumps({'numpy': rng.bit_generator.state, 'random': [version, internal, gauss_next]})
+
+def _restore_rng(rng, state):
+    state = json.loads(state)
+    rng.bit_generator.state = state['numpy']
+    version, internal, gauss_next = state['random']
+    random.setstate((version, tuple(internal), gauss_next))
+
+class StageRun:
+    # One run of a generation stage. Every committed batch leaves a checkpoint
+    # row in Generation_Checkpoints (source id watermark, next output id, rows
+    # so far and RNG state), so resume() can continue a crashed run after its
+    # last committed batch. A header row (shard -1) keeps the run's arguments.
+    def __init__(self, stage, run_id, params, progress=None):
+        self.stage = stage
+        self.run_id = run_id
+        self.params = params
+        self.resumed = progress is not None
+        self.progress = progress or {}
+
+    @classmethod
+    def start(cls, stage, **params):
+        if not sink.checkpoints:
+            return cls(stage, None, params)
+        ch_pool.execute(f'''
+            CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+                run_id      String,
+                stage       String,
+                shard       Int32,
+                batch       Int32,
+                watermark   Int64,
+                next_id     Int64,
+                rows        UInt64,
+                state       String,
+                done        Bool,
+                created_at  DateTime64(3)
+            ) ENGINE = MergeTree()
+            ORDER BY (stage, run_id, shard, batch)
+        ''')
+        run = cls(stage, uuid.uuid4().hex, params)
+        run._record(-1, 0, 0, 0, 0, json.dumps(params, default=str))
+        return run
+
+    @classmethod
+    def resume(cls, stage):
+        if not sink.checkpoints:
+            raise ValueError(f"{type(sink).__name__} keeps no checkpoints to resume {stage} from")
+        header = ch_pool.execute(
+            f"SELECT run_id, state FROM {CHECKPOINT_TABLE} WHERE stage = %(stage)s AND shard = -1 "
+            "ORDER BY created_at DESC LIMIT 1",
+            {'stage': stage}
+        )
+        if not header:
+            raise ValueError(f"No {stage} run to resume")
+        run_id, params = header[0]
+
+        # A shard resumes from the last resumable checkpoint before its first
+        # missing batch; pipelined batches that committed after a gap are redone
+        # (same rows and deduplication token, so the server skips them)
+        progress, expected = {}, {}
+        for shard, batch, watermark, next_id, rows, state, done in ch_pool.execute(
+            f"SELECT shard, batch, watermark, next_id, rows, state, done FROM {CHECKPOINT_TABLE} "
+            "WHERE run_id = %(run_id)s AND shard >= 0 ORDER BY shard, batch, created_at",
+            {'run_id': run_id}
+        ):
+            if batch != expected.get(shard, 0):
+                continue
+            expected[shard] = batch + 1
+            if done:
+                progress[shard] = 'done'
+            elif state:
+                progress[shard] = {'batch': batch, 'watermark': watermark, 'next_id': next_id, 'rows': rows,
+                                   'state': state}
+
+        finished = sum(1 for checkpoint in progress.values() if checkpoint == 'done')
+        print(f"Resuming {stage} run {run_id}: {finished} shards done, {len(progress) - finished} partly done")
+        return cls(stage, run_id, json.loads(params), progress)
+
+    def get(self, *names):
+        return tuple(self.params[name] for name in names)
+
+    def _record(self, shard, batch, watermark, next_id, rows, state='', done=False):
+        if self.run_id is None:
+            return
+        ch_pool.execute(
+            f'INSERT INTO {CHECKPOINT_TABLE} '
+            '(run_id, stage, shard, batch, watermark, next_id, rows, state, done, created_at) VALUES',
+            [(self.run_id, self.stage, shard, batch, watermark, next_id, rows, state, done, datetime.now())]
+        )
+
+    def checkpoint(self, shard, batch, watermark, next_id, rows, rng=None):
+        # Called right after a batch is generated, so the RNG state is the one to resume from;
+        # the returned callback records it once the batch's insert has committed.
+        # Without rng the batch is not a resume point (it ends mid-way through a chunk).
+        state = _rng_state(rng) if rng is not None else ''
+        return lambda: self._record(shard, batch, watermark, next_id, rows, state)
+
+    def finish_shard(self, shard, batch, rows):
+        self._record(shard, batch, 0, 0, rows, done=True)
+
+def next_id(table, column):
+    # First id after the rows already in table, for append runs
+    return (sink.execute(f'SELECT max({column}) FROM {table}')[0][0] or 0) + 1
+
+# The star schema in its baseline layout. Bulk-loaded tables keep a deduplication
+# window so a retried batch with the same insert_deduplication_token is not stored
+# twice (see ClickHousePool.insert).
+TABLE_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS Dim_Time (
+        date_id         Int32,
+        date            Date,
+        month           Int8,
+        year           Int16
+    ) ENGINE = MergeTree()
+    ORDER BY date_id
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS Dim_Product (
+        product_id      Int32,
+        product_name    String,
+        category        String,
+        price          Float64,
+        supplier_id     Int32
+    ) ENGINE = MergeTree()
+    ORDER BY product_id
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS Dim_Region (
+        region_id       Int32,
+        region_name     String,
+        country        String,
+        sales_manager   String
+    ) ENGINE = MergeTree()
+    ORDER BY region_id
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS Dim_Sales_Channel (
+        channel_id      Int32,
+        channel_name    String,
+        platform       String
+    ) ENGINE = MergeTree()
+    ORDER BY channel_id
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS Dim_Customer (
+        customer_id         Int32,
+        name                String,
+        region_id           Int32,
+        age_group           Nullable(String),
+        gender              Nullable(String),
+        membership_status   Nullable(String),
+        average_balance     Nullable(Float64),
+        average_income      Nullable(Float64),
+        business_risk_class Nullable(String),
+        is_pep              Bool,
+        account_balance     Nullable(Float64),
+        is_cash_intensive   Bool,
+        tpr_threshold_exceeded Bool,
+        transacts_hr_jurisdictions Bool,
+        preferred_channel   Nullable(String),
+        interests           Array(String),
+        occupation          Nullable(String),
+        lifecycle_stage     Nullable(String),
+        churn_risk_score    Nullable(Float64),
+        predicted_clv       Nullable(Float64),
+        consent_marketing   Bool,
+        consent_data_share  Bool,
+        data_deletion_date  Nullable(Date),
+        risk_profile        String
+    ) ENGINE = MergeTree()
+    ORDER BY customer_id
+    SETTINGS non_replicated_deduplication_window = 1000
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS Dim_Loan (
+        loan_id             Int32,
+        customer_id         Int32,
+        loan_amount         Float64,
+        interest_rate       Float64,
+        term_months         Int32,
+        start_date          Date,
+        end_date            Date,
+        loan_status         String,
+        loan_type           String,
+        risk_rating         String,
+        collateral_value    Float64,
+        application_channel String,
+        application_date    Date,
+        last_payment_date   Nullable(Date),
+        next_payment_due_date Nullable(Date),
+        outstanding_balance Float64
+    ) ENGINE = MergeTree()
+    ORDER BY loan_id
+    SETTINGS non_replicated_deduplication_window = 1000
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS Fact_Sales (
+        sale_id          Int32,
+        date_id         Int32,
+        product_id      Int32,
+        customer_id     Int32,
+        region_id       Int32,
+        channel_id      Int32,
+        units_sold      Int32,
+        revenue         Float64,
+        discount_amount Float64,
+        processing_fees Float64,
+        documentation_fees Float64,
+        insurance_fees  Float64,
+        customer_acquisition_cost Float64,
+        emi_bounce_charges Float64,
+        npa_loss_amount Float64,
+        total_revenue   Float64,
+        status          String
+    ) ENGINE = MergeTree()
+    ORDER BY sale_id
+    SETTINGS non_replicated_deduplication_window = 1000
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS Fact_Loan_Repayment (
+        repayment_id    Int32,
+        loan_id        Int32,
+        customer_id    Int32,
+        emi_number     Int32,
+        due_date       Date,
+        payment_date   Nullable(Date),
+        emi_amount     Float64,
+        principal_amount Float64,
+        interest_amount Float64,
+        penalties      Float64,
+        payment_status String,
+        payment_mode   String,
+        pending_principal Float64,
+        pending_interest Float64,
+        days_overdue   Int32,
+        bounce_reason  Nullable(String),
+        collection_agent_id Nullable(Int32)
+    ) ENGINE = MergeTree()
+    ORDER BY (loan_id, emi_number)
+    SETTINGS non_replicated_deduplication_window = 1000
+    '''
+]
+
+# Physical layouts create_tables can give the schema, each adding to the one
+# before: 'baseline' is the plain MergeTree ORDER BY <id> above; 'compressed'
+# makes repeated strings LowCardinality and gives every column a Delta/ZSTD codec;
+# 'partitioned' also partitions facts and loans by date, sorts them date first
+# and adds data-skipping indexes for customer and status filters.
+# compare_schema_profiles loads and queries each so they can be compared.
+SCHEMA_PROFILES = ['baseline', 'compressed', 'partitioned']
+
+LOW_CARDINALITY_COLUMNS = {
+    'Dim_Product': ['category'],
+    'Dim_Region': ['region_name', 'country'],
+    'Dim_Sales_Channel': ['channel_name', 'platform'],
+    'Dim_Customer': ['age_group', 'gender', 'membership_status', 'business_risk_class', 'preferred_channel',
+                     'occupation', 'lifecycle_stage', 'risk_profile'],
+    'Dim_Loan': ['loan_status', 'loan_type', 'risk_rating', 'application_channel'],
+    'Fact_Sales': ['status'],
+    'Fact_Loan_Repayment': ['payment_status', 'payment_mode', 'bounce_reason'],
+}
 
-    ch_client.execute('''
-        CREATE TABLE IF NOT EXISTS Dim_Region (
-            region_id       Int32,
-            region_name     String,
-            country        String,
-            sales_manager   String
-        ) ENGINE = MergeTree()
-        ORDER BY region_id
-    ''')
+# Ids and dates that are sorted or close together within a part compress best as deltas
+DELTA_COLUMNS = {
+    'Dim_Time': ['date_id', 'date'],
+    'Dim_Product': ['product_id'],
+    'Dim_Region': ['region_id'],
+    'Dim_Sales_Channel': ['channel_id'],
+    'Dim_Customer': ['customer_id'],
+    'Dim_Loan': ['loan_id', 'start_date', 'end_date', 'application_date'],
+    'Fact_Sales': ['sale_id', 'date_id'],
+    'Fact_Loan_Repayment': ['repayment_id', 'loan_id', 'emi_number', 'due_date', 'payment_date'],
+}
 
-    ch_client.execute('''
-        CREATE TABLE IF NOT EXISTS Dim_Sales_Channel (
-            channel_id      Int32,
-            channel_name    String,
-            platform       String
-        ) ENGINE = MergeTree()
-        ORDER BY channel_id
-    ''')
+# Dim_Time's first day: date_id n is that day plus n - 1 (see generate_dimension_data)
+DIM_TIME_START = '2021-01-01'
+DIM_TIME_END = '2024-01-01'
+# A sale's date without joining Dim_Time
+SALE_DATE_EXPRESSION = f"toDate('{DIM_TIME_START}') + (date_id - 1)"
+
+# 'partitioned' layouts. Sales have no date column, so they are partitioned on the
+# day their date_id stands for. Repayment due dates run up to the as-of date, so
+# yearly partitions keep an insert block under max_partitions_per_insert_block.
+# Ids are not sorted within these parts, so the loans and repayments stages, which
+# read sales and loans by id range, scan more; compare_schema_profiles' load times show it.
+DATE_LAYOUTS = {
+    'Fact_Sales': {
+        'partition_by': f'toYYYYMM({SALE_DATE_EXPRESSION})',
+        'order_by': '(date_id, sale_id)',
+        'indexes': ['customer_id_bloom customer_id TYPE bloom_filter GRANULARITY 4',
+                    'status_set status TYPE set(8) GRANULARITY 4'],
+    },
+    'Dim_Loan': {
+        'partition_by': 'toYear(start_date)',
+        'order_by': '(start_date, loan_id)',
+        'indexes': ['customer_id_bloom customer_id TYPE bloom_filter GRANULARITY 4',
+                    'loan_status_set loan_status TYPE set(8) GRANULARITY 4'],
+    },
+    'Fact_Loan_Repayment': {
+        'partition_by': 'toYear(due_date)',
+        'order_by': '(due_date, loan_id, emi_number)',
+        'indexes': ['loan_id_minmax loan_id TYPE minmax GRANULARITY 4',
+                    'customer_id_bloom customer_id TYPE bloom_filter GRANULARITY 4',
+                    'payment_status_set payment_status TYPE set(8) GRANULARITY 4'],
+    },
+}
 
-    ch_client.execute('''
-        CREATE TABLE IF NOT EXISTS Dim_Customer (
-            customer_id         Int32,
-            name                String,
-            region_id           Int32,
-            age_group           Nullable(String),
-            gender              Nullable(String),
-            membership_status   Nullable(String),
-            average_balance     Nullable(Float64),
-            average_income      Nullable(Float64),
-            business_risk_class Nullable(String),
-            is_pep              Bool,
-            account_balance     Nullable(Float64),
-            is_cash_intensive   Bool,
-            tpr_threshold_exceeded Bool,
-            transacts_hr_jurisdictions Bool,
-            preferred_channel   Nullable(String),
-            interests           Array(String),
-            occupation          Nullable(String),
-            lifecycle_stage     Nullable(String),
-            churn_risk_score    Nullable(Float64),
-            predicted_clv       Nullable(Float64),
-            consent_marketing   Bool,
-            consent_data_share  Bool,
-            data_deletion_date  Nullable(Date),
-            risk_profile        String
-        ) ENGINE = MergeTree()
-        ORDER BY customer_id
-    ''')
+def table_ddl(ddl, profile='baseline'):
+    # One of the TABLE_DDL statements rewritten for a schema profile
+    if profile not in SCHEMA_PROFILES:
+        raise ValueError(f"Unknown schema profile: {profile}")
+    if profile == 'baseline':
+        return ddl
+
+    table, columns = parse_table_schema(ddl)
+    layout = DATE_LAYOUTS.get(table, {}) if profile == 'partitioned' else {}
+    definitions = []
+    for name, column_type in columns:
+        if name in LOW_CARDINALITY_COLUMNS.get(table, []):
+            column_type = f'LowCardinality({column_type})'
+        codec = 'Delta, ZSTD(1)' if name in DELTA_COLUMNS.get(table, []) else 'ZSTD(1)'
+        definitions.append(f'{name} {column_type} CODEC({codec})')
+    definitions += [f'INDEX {index}' for index in layout.get('indexes', [])]
+
+    lines = [f'CREATE TABLE IF NOT EXISTS {table} (', ',\n'.join(f'    {line}' for line in definitions)]
+    lines.append(') ENGINE = MergeTree()')
+    if 'partition_by' in layout:
+        lines.append(f"PARTITION BY {layout['partition_by']}")
+    lines.append(f"ORDER BY {layout.get('order_by') or re.search(r'ORDER BY (.+)', ddl).group(1).strip()}")
+    settings = re.search(r'SETTINGS (.+)', ddl)
+    if settings:
+        lines.append(f'SETTINGS {settings.group(1).strip()}')
+    return '\n'.join(lines)
+
+# Portfolio rollups: AggregatingMergeTree tables that materialized views fill as
+# the generators insert into their source tables, so dashboards read a few
+# thousand pre-aggregated rows instead of scanning the facts. Every metric is
+# (column type, aggregate over the inserted block, function that merges it);
+# metric names differ from source columns, since ClickHouse would substitute
+# such an alias inside the other aggregates. Views see inserts only: after an
+# ALTER UPDATE or rebuild of a source table (update_region_ids) the rollup is
+# refreshed by backfill_rollups.
+ROLLUPS = {
+    'Rollup_Sales_Monthly': {
+        'source': 'Fact_Sales',
+        'keys': {'month': f'toStartOfMonth({SALE_DATE_EXPRESSION})', 'region_id': 'region_id',
+                 'product_id': 'product_id'},
+        'metrics': {
+            'sales': ('SimpleAggregateFunction(sum, UInt64)', 'count()', 'sum'),
+            'approved': ('SimpleAggregateFunction(sum, UInt64)', "countIf(status = 'Approved')", 'sum'),
+            'net_revenue': ('SimpleAggregateFunction(sum, Float64)', 'sum(revenue)', 'sum'),
+            'gross_revenue': ('SimpleAggregateFunction(sum, Float64)', 'sum(total_revenue)', 'sum'),
+            'npa_loss': ('SimpleAggregateFunction(sum, Float64)', 'sum(npa_loss_amount)', 'sum'),
+            'npa_count': ('SimpleAggregateFunction(sum, UInt64)', 'countIf(npa_loss_amount > 0)', 'sum'),
+            'bounce_charges': ('SimpleAggregateFunction(sum, Float64)', 'sum(emi_bounce_charges)', 'sum'),
+            'bounce_count': ('SimpleAggregateFunction(sum, UInt64)', 'countIf(emi_bounce_charges > 0)', 'sum'),
+            'customers': ('AggregateFunction(uniq, Int32)', 'uniqState(customer_id)', 'uniqMerge'),
+        },
+    },
+    'Rollup_Loans_Monthly': {
+        'source': 'Dim_Loan',
+        'keys': {'month': 'toStartOfMonth(start_date)', 'risk_rating': 'risk_rating', 'loan_type': 'loan_type',
+                 'loan_status': 'loan_status'},
+        'metrics': {
+            'loans': ('SimpleAggregateFunction(sum, UInt64)', 'count()', 'sum'),
+            'disbursed': ('SimpleAggregateFunction(sum, Float64)', 'sum(loan_amount)', 'sum'),
+            'outstanding': ('SimpleAggregateFunction(sum, Float64)', 'sum(outstanding_balance)', 'sum'),
+            'overdue_exposure': (
+                'SimpleAggregateFunction(sum, Float64)',
+                "sumIf(outstanding_balance, loan_status IN ('Delinquent', 'Defaulted'))", 'sum'
+            ),
+            'collateral': ('SimpleAggregateFunction(sum, Float64)', 'sum(collateral_value)', 'sum'),
+            'avg_interest_rate': ('AggregateFunction(avg, Float64)', 'avgState(interest_rate)', 'avgMerge'),
+        },
+    },
+    'Rollup_Repayments_Monthly': {
+        'source': 'Fact_Loan_Repayment',
+        'keys': {'month': 'toStartOfMonth(due_date)', 'payment_status': 'payment_status',
+                 'payment_mode': 'payment_mode'},
+        'metrics': {
+            'installments': ('SimpleAggregateFunction(sum, UInt64)', 'count()', 'sum'),
+            'emi_due': ('SimpleAggregateFunction(sum, Float64)', 'sum(emi_amount)', 'sum'),
+            'penalty_amount': ('SimpleAggregateFunction(sum, Float64)', 'sum(penalties)', 'sum'),
+            'bounced': ('SimpleAggregateFunction(sum, UInt64)', "countIf(payment_status = 'Bounced')", 'sum'),
+            'overdue': ('SimpleAggregateFunction(sum, UInt64)', 'countIf(days_overdue > 0)', 'sum'),
+            'overdue_principal': (
+                'SimpleAggregateFunction(sum, Float64)', 'sumIf(pending_principal, days_overdue > 0)', 'sum'
+            ),
+            'max_days_overdue': ('SimpleAggregateFunction(max, Int32)', 'max(days_overdue)', 'max'),
+        },
+    },
+}
 
-    ch_client.execute('''
-        CREATE TABLE IF NOT EXISTS Dim_Loan (
-            loan_id             Int32,
-            customer_id         Int32,
-            loan_amount         Float64,
-            interest_rate       Float64,
-            term_months         Int32,
-            start_date          Date,
-            end_date            Date,
-            loan_status         String,
-            loan_type           String,
-            risk_rating         String,
-            collateral_value    Float64,
-            application_channel String,
-            application_date    Date,
-            last_payment_date   Nullable(Date),
-            next_payment_due_date Nullable(Date),
-            outstanding_balance Float64
-        ) ENGINE = MergeTree()
-        ORDER BY loan_id
-    ''')
+# Dashboard queries over the rollups: name -> (rollup, group by keys, metrics)
+PORTFOLIO_QUERIES = {
+    'revenue_by_month': ('Rollup_Sales_Monthly', ['month'], ['sales', 'approved', 'gross_revenue', 'customers']),
+    'npa_loss_by_region': ('Rollup_Sales_Monthly', ['region_id'], ['approved', 'npa_count', 'npa_loss']),
+    'revenue_by_product': (
+        'Rollup_Sales_Monthly', ['product_id'], ['approved', 'net_revenue', 'bounce_count', 'bounce_charges']
+    ),
+    'exposure_by_risk': (
+        'Rollup_Loans_Monthly', ['risk_rating'],
+        ['loans', 'disbursed', 'outstanding', 'overdue_exposure', 'avg_interest_rate']
+    ),
+    'loans_by_month_and_risk': ('Rollup_Loans_Monthly', ['month', 'risk_rating'], ['loans', 'overdue_exposure']),
+    'bounces_by_month': ('Rollup_Repayments_Monthly', ['month'], ['installments', 'bounced', 'penalty_amount']),
+    'overdue_by_mode': (
+        'Rollup_Repayments_Monthly', ['payment_mode'], ['overdue', 'overdue_principal', 'max_days_overdue']
+    ),
+}
 
-    ch_client.execute('''
-        CREATE TABLE IF NOT EXISTS Fact_Sales (
-            sale_id          Int32,
-            date_id         Int32,
-            product_id      Int32,
-            customer_id     Int32,
-            region_id       Int32,
-            channel_id      Int32,
-            units_sold      Int32,
-            revenue         Float64,
-            discount_amount Float64,
-            processing_fees Float64,
-            documentation_fees Float64,
-            insurance_fees  Float64,
-            customer_acquisition_cost Float64,
-            emi_bounce_charges Float64,
-            npa_loss_amount Float64,
-            total_revenue   Float64,
-            status          String
-        ) ENGINE = MergeTree()
-        ORDER BY sale_id
-    ''')
+def _rollup_select(rollup):
+    # The aggregation the view runs on every inserted block (and backfill on the whole source)
+    spec = ROLLUPS[rollup]
+    columns = [expression if expression == key else f'{expression} AS {key}' for key, expression in spec['keys'].items()]
+    columns += [f'{aggregate} AS {name}' for name, (_, aggregate, _) in spec['metrics'].items()]
+    return f"SELECT {', '.join(columns)} FROM {spec['source']} GROUP BY {', '.join(spec['keys'])}"
+
+def create_rollups():
+    if not isinstance(sink, ClickHouseSink):
+        raise ValueError("Rollups are materialized views and need the ClickHouse sink")
+    for rollup, spec in ROLLUPS.items():
+        source_types = dict(parse_table_schema(next(
+            ddl for ddl in TABLE_DDL if parse_table_schema(ddl)[0] == spec['source']
+        ))[1])
+        # Keys that are plain source columns keep their type; the rest are months
+        key_types = [f"{key} {source_types.get(expression, 'Date')}" for key, expression in spec['keys'].items()]
+        metric_types = [f'{name} {column_type}' for name, (column_type, _, _) in spec['metrics'].items()]
+        ch_pool.execute(f'''
+            CREATE TABLE IF NOT EXISTS {rollup} ({', '.join(key_types + metric_types)})
+            ENGINE = AggregatingMergeTree()
+            ORDER BY ({', '.join(spec['keys'])})
+        ''')
+        ch_pool.execute(f'CREATE MATERIALIZED VIEW IF NOT EXISTS {rollup}_mv TO {rollup} AS {_rollup_select(rollup)}')
+    print(f"Created {len(ROLLUPS)} rollups")
+
+def existing_rollups():
+    tables = {name for name, in ch_pool.execute("SELECT name FROM system.tables WHERE database = currentDatabase()")}
+    return [rollup for rollup in ROLLUPS if rollup in tables and f'{rollup}_mv' in tables]
+
+@measured_stage
+def backfill_rollups(rollups=None):
+    # Recomputes rollups from their source tables, e.g. for data loaded before the
+    # views existed or changed by a mutation since. Run it while nothing inserts
+    # into the sources: rows inserted during the backfill would be counted twice.
+    for rollup in rollups or existing_rollups():
+        started = time.perf_counter()
+        ch_pool.execute(f'TRUNCATE TABLE {rollup}')
+        ch_pool.execute(f'INSERT INTO {rollup} {_rollup_select(rollup)}')
+        print(f"Backfilled {rollup} from {ROLLUPS[rollup]['source']} in {time.perf_counter() - started:.1f}s")
+
+def query_rollup(rollup, group_by=(), metrics=None, where=None, params=None):
+    # Rollup metrics merged over group_by (a subset of the rollup's keys) as a list of dicts, e.g.
+    # query_rollup('Rollup_Loans_Monthly', ['risk_rating'], where="month >= %(since)s", params={'since': ...})
+    spec = ROLLUPS[rollup]
+    unknown = (set(group_by) - set(spec['keys'])) | (set(metrics or []) - set(spec['metrics']))
+    if unknown:
+        raise ValueError(f"{rollup} has no {', '.join(sorted(unknown))}")
+    columns = list(group_by) + [
+        f"{spec['metrics'][name][2]}({name}) AS {name}" for name in metrics or spec['metrics']
+    ]
+    query = f"SELECT {', '.join(columns)} FROM {rollup}"
+    if where:
+        query += f' WHERE {where}'
+    if group_by:
+        query += f" GROUP BY {', '.join(group_by)} ORDER BY {', '.join(group_by)}"
+    rows, types = ch_pool.execute(query, params, with_column_types=True)
+    names = [name for name, _ in types]
+    return [dict(zip(names, row)) for row in rows]
+
+def portfolio_query(name, since=None, until=None):
+    # One of PORTFOLIO_QUERIES over the months [since, until] (dates or 'YYYY-MM-DD')
+    rollup, group_by, metrics = PORTFOLIO_QUERIES[name]
+    bounds = {'since': since, 'until': until}
+    conditions = [
+        f'month {operator} toStartOfMonth(toDate(%({bound})s))'
+        for bound, operator in [('since', '>='), ('until', '<=')] if bounds[bound]
+    ]
+    params = {bound: str(value) for bound, value in bounds.items() if value}
+    return query_rollup(rollup, group_by, metrics, ' AND '.join(conditions) or None, params)
+
+@measured_stage
+def create_tables(drop_existing=True, profile='baseline', rollups=False):
+    # drop_existing=False keeps existing tables and data, e.g. before an append run.
+    # profile picks the physical layout (see SCHEMA_PROFILES); rollups=True also
+    # creates the materialized rollups (see ROLLUPS).
+    if not drop_existing:
+        print("Keeping existing tables")
+    else:
+        # Get list of all tables
+        tables = sink.execute(
+                    "SELECT name FROM system.tables WHERE database = 'default'"
+                )
+
+        # Drop each table
+        for table in tables:
+            table_name = table[0]  # Extract table name
+            sink.execute(f"DROP TABLE IF EXISTS default.{table_name}")
+
+        print("All tables dropped successfully!")
+
+    print(f"Creating new tables ({profile} layout)...")
+    for ddl in TABLE_DDL:
+        sink.execute(table_ddl(ddl, profile))
+    if rollups:
+        create_rollups()
+
+# Faker is slow per call, so the dimension generators draw each field from a pool of
+# Faker values built once and cached on disk, sampling it by index in bulk. A pool
+# holds draws with repeats, so sampling it keeps the provider's distribution.
+FAKER_POOL_SIZES = dict.fromkeys(['name', 'first_name', 'last_name', 'job', 'state', 'country'], 20000)
+FAKER_POOL_SEED = 0
+FAKER_POOL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'bank-loan-dataset')
+
+class FakerPool:
+    def __init__(self, locale='en_US', sizes=None, cache_dir=None):
+        self.locale = locale
+        self.sizes = sizes or FAKER_POOL_SIZES
+        self.cache_dir = cache_dir or FAKER_POOL_CACHE_DIR
+        self.values = {}
+
+    def cache_path(self):
+        from faker import VERSION as faker_version
+
+        sizes = '-'.join(f'{field}{size}' for field, size in sorted(self.sizes.items()))
+        return os.path.join(self.cache_dir, f'faker-pool-{faker_version}-{self.locale}-{sizes}.json.gz')
+
+    def load(self):
+        path = self.cache_path()
+        if os.path.exists(path):
+            with gzip.open(path, 'rt') as cached:
+                vocabularies = json.load(cached)
+        else:
+            # A dedicated, fixed-seed Faker: a rebuilt pool is identical to the cached one
+            from faker import Faker
+
+            pool_fake = Faker(self.locale)
+            pool_fake.seed_instance(FAKER_POOL_SEED)
+            started = time.perf_counter()
+            vocabularies = {
+                field: [getattr(pool_fake, field)() for _ in range(size)] for field, size in self.sizes.items()
+            }
+            print(f"Built Faker pool in {time.perf_counter() - started:.1f}s")
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with gzip.open(path + '.tmp', 'wt') as cache:
+                    json.dump(vocabularies, cache)
+                os.replace(path + '.tmp', path)
+            except OSError as error:
+                print(f"Could not cache the Faker pool at {path}: {error}")
+        self.values = {field: np.array(values, dtype=object) for field, values in vocabularies.items()}
+        return self
+
+    def sample(self, field, size, rng):
+        values = self.values[field]
+        return values[rng.integers(0, len(values), size)]
+
+    def names(self, size, rng, unique=False):
+        if not unique:
+            return self.sample('name', size, rng)
+        space = self.name_space(size)
+        return space.compose(rng.choice(space.combinations, size, replace=False))
+
+    def unique_names(self, customer_ids, count, seed):
+        # Distinct names for ids 1..count however they are split into batches, shards
+        # or workers: the affine permutation (a * id + b) mod combinations, keyed by seed
+        space = self.name_space(count)
+        key = np.random.default_rng(seed)
+        multiplier = int(key.integers(1, space.combinations))
+        while math.gcd(multiplier, space.combinations) != 1:
+            multiplier = multiplier % (space.combinations - 1) + 1
+        offset = int(key.integers(0, space.combinations))
+        return space.compose((np.asarray(customer_ids, dtype=np.int64) * multiplier + offset) % space.combinations)
+
+    def name_space(self, count):
+        # Distinct "First Last" pairs, then "First M. Last" and "First M. N. Last" as count outgrows them
+        first_names = np.unique(self.values['first_name'])
+        last_names = np.unique(self.values['last_name'])
+        letters = [f' {letter}.' for letter in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ']
+        initials = ['']
+        while count > len(first_names) * len(last_names) * len(initials) and len(initials) < len(letters) ** 2:
+            initials = [initial + letter for initial in initials for letter in letters]
+        space = NameSpace(first_names, np.array(initials, dtype=object), last_names)
+        if count > space.combinations:
+            raise ValueError(f"Only {space.combinations} unique names available from the Faker pool, {count} requested")
+        return space
+
+    def dates_this_decade(self, size, rng, as_of=None):
+        # Uniform dates from the start of the decade up to the as-of date, like Faker's date_this_decade()
+        today = np.datetime64(resolve_as_of(as_of), 'D')
+        decade_start = np.datetime64(f'{today.astype(object).year // 10 * 10}-01-01', 'D')
+        days = (today - decade_start).astype(np.int64)
+        return decade_start + rng.integers(0, days + 1, size)
+
+class NameSpace:
+    # Every name made of one first name, middle initial and last name, numbered 0..combinations-1
+    def __init__(self, first_names, initials, last_names):
+        self.first_names = first_names
+        self.initials = initials
+        self.last_names = last_names
+        self.pairs = len(first_names) * len(last_names)
+        self.combinations = self.pairs * len(initials)
+
+    def compose(self, codes):
+        pair, initial = codes % self.pairs, codes // self.pairs
+        last = len(self.last_names)
+        return self.first_names[pair // last] + self.initials[initial] + ' ' + self.last_names[pair % last]
+
+_faker_pool = None
+
+def faker_pool():
+    global _faker_pool
+    if _faker_pool is None:
+        _faker_pool = FakerPool().load()
+    return _faker_pool
+
+def faker_rng():
+    # Pool sampling follows the `random` module, so random.seed() still fixes the dimensions
+    return np.random.default_rng(random.getrandbits(64))
+
+def _uniform(rng, low, high, size):
+    return np.round(rng.uniform(low, high, size), 2)
+
+class ArrayColumn:
+    # An Array(T) column the way ClickHouse stores it: every row's items in one
+    # flat values array plus each row's end offset. Rows only become Python
+    # lists when a sink serializes the batch (tolist), like the NumPy columns.
+    def __init__(self, offsets, values):
+        self.offsets = offsets
+        self.values = values
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def tolist(self):
+        values = self.values.tolist()
+        starts = [0] + self.offsets[:-1].tolist()
+        return [values[start:end] for start, end in zip(starts, self.offsets.tolist())]
+
+CUSTOMER_INTERESTS = ['Sports', 'Tech', 'Fashion', 'Books']
+
+def _interests(rng, size):
+    # 1-3 distinct interests per customer: each row keeps the first few of a random permutation
+    counts = rng.integers(1, 4, size)
+    order = np.argsort(rng.random((size, len(CUSTOMER_INTERESTS))), axis=1)
+    kept = np.arange(len(CUSTOMER_INTERESTS)) < counts[:, None]
+    return ArrayColumn(np.cumsum(counts), np.array(CUSTOMER_INTERESTS, dtype=object)[order[kept]])
+
+def _nullable(values, present):
+    # Nullable column: values plus a validity mask; masked rows serialize as NULL
+    return np.ma.MaskedArray(values, mask=~present)
+
+# BankCustomerData.csv (the Kaggle bank marketing data the Go scripts load) and the
+# columns customers are resampled from, parsed like DIMENSION_CACHE_SPEC kinds
+BANK_CUSTOMER_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'BankCustomerData.csv')
+BANK_CUSTOMER_COLUMNS = {'age': 'int16', 'job': 'category', 'balance': 'float64'}
+
+# The first age of every 'age_group' value after '18-24'
+AGE_GROUP_STARTS = [25, 35, 45, 55]
+
+# CSV job -> Dim_Customer occupation; 'unknown' becomes NULL
+BANK_JOB_OCCUPATIONS = {
+    'admin.': 'Administrative assistant', 'blue-collar': 'Blue-collar worker', 'entrepreneur': 'Entrepreneur',
+    'housemaid': 'Housekeeper', 'management': 'Manager', 'retired': 'Retired', 'self-employed': 'Self-employed',
+    'services': 'Service worker', 'student': 'Student', 'technician': 'Technician', 'unemployed': 'Unemployed'
+}
 
-    ch_client.execute('''
-        CREATE TABLE IF NOT EXISTS Fact_Loan_Repayment (
-            repayment_id    Int32,
-            loan_id        Int32,
-            customer_id    Int32,
-            emi_number     Int32,
-            due_date       Date,
-            payment_date   Nullable(Date),
-            emi_amount     Float64,
-            principal_amount Float64,
-            interest_amount Float64,
-            penalties      Float64,
-            payment_status String,
-            payment_mode   String,
-            pending_principal Float64,
-            pending_interest Float64,
-            days_overdue   Int32,
-            bounce_reason  Nullable(String),
-            collection_agent_id Nullable(Int32)
-        ) ENGINE = MergeTree()
-        ORDER BY (loan_id, emi_number)
-    ''')
+def read_csv_chunks(path, columns, chunk_bytes=1 << 22):
+    # Typed columns of a CSV file, one chunk at a time: every chunk is a slice of a
+    # memory map ending at a line break, so memory stays around chunk_bytes however
+    # large the file is. columns maps names to kinds: 'category' (str) or a dtype.
+    # Quoted fields may contain commas but not line breaks.
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = data.find(b'\n') + 1
+        header = next(csv.reader([data[:start].decode()]))
+        positions = [header.index(name) for name in columns]
+        while start < len(data):
+            end = data.find(b'\n', start + chunk_bytes)
+            end = len(data) if end == -1 else end + 1
+            rows = [row for row in csv.reader(data[start:end].decode().splitlines()) if row]
+            start = end
+            chunk = {}
+            for (name, kind), position in zip(columns.items(), positions):
+                values = [row[position] for row in rows]
+                chunk[name] = np.array(values, dtype=object) if kind == 'category' else np.array(values).astype(kind)
+            yield chunk
+
+class BankCustomerSource:
+    # The CSV's customer columns as NumPy arrays (category codes for strings).
+    # Customer batches resample whole rows, so every customer keeps one real
+    # row's age, job and balance together, for any number of customers.
+    def __init__(self, path=BANK_CUSTOMER_CSV, chunk_bytes=1 << 22):
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        self.columns = {}
+        self.vocabularies = {}
+
+    def load(self):
+        blocks = {name: [] for name in BANK_CUSTOMER_COLUMNS}
+        lookups = {name: {} for name, kind in BANK_CUSTOMER_COLUMNS.items() if kind == 'category'}
+        for chunk in read_csv_chunks(self.path, BANK_CUSTOMER_COLUMNS, self.chunk_bytes):
+            for name, values in chunk.items():
+                if name in lookups:
+                    lookup = lookups[name]
+                    values = np.array([lookup.setdefault(value, len(lookup)) for value in values], dtype=np.int16)
+                blocks[name].append(values)
+        for name, kind in BANK_CUSTOMER_COLUMNS.items():
+            dtype = np.int16 if kind == 'category' else kind
+            self.columns[name] = np.concatenate(blocks[name]) if blocks[name] else np.array([], dtype=dtype)
+        self.vocabularies = {name: list(lookup) for name, lookup in lookups.items()}
+        if not len(self):
+            raise ValueError(f"No customer rows in {self.path}")
+        print(f"Loaded {len(self)} customer rows from {self.path}")
+        return self
+
+    def __len__(self):
+        return len(self.columns['age'])
+
+    def customer_columns(self, rng, size):
+        # Dim_Customer columns for size customers drawn (with replacement) from the CSV rows
+        rows = rng.integers(0, len(self), size)
+        jobs = self.vocabularies['job']
+        occupations = np.array([BANK_JOB_OCCUPATIONS.get(job) for job in jobs], dtype=object)
+        known = np.array([job in BANK_JOB_OCCUPATIONS for job in jobs])
+        job_codes = self.columns['job'][rows]
+        age_groups = distribution('age_group').array
+        return {
+            'age_group': age_groups[np.searchsorted(AGE_GROUP_STARTS, self.columns['age'][rows], side='right')],
+            'average_balance': self.columns['balance'][rows],
+            'occupation': _nullable(occupations[job_codes], known[job_codes])
+        }
+
+_bank_customer_sources = {}
+
+def bank_customer_source(path=BANK_CUSTOMER_CSV):
+    if path not in _bank_customer_sources:
+        _bank_customer_sources[path] = BankCustomerSource(path).load()
+    return _bank_customer_sources[path]
+
+def _dim_customer_batch(rng, pool, regions, first_customer_id, size, names, as_of, source=None):
+    # regions: the weighted branch region ids (see branch_regions)
+    customer_ids = np.arange(first_customer_id, first_customer_id + size, dtype=np.int32)
+
+    def sample(name):
+        return distribution(name).sample(rng, size)
+
+    columns = {
+        'customer_id': customer_ids,
+        'name': pool.sample('name', size, rng) if names is None else names(customer_ids),
+        'region_id': regions.sample(rng, size).astype(np.int32),
+        'age_group': sample('age_group'),
+        'gender': sample('gender'),
+        'membership_status': sample('membership_status'),
+        'average_balance': _uniform(rng, 1000, 100000, size),
+        'average_income': _uniform(rng, 20000, 150000, size),
+        'business_risk_class': sample('business_risk_class'),
+        'is_pep': sample('is_pep'),
+        'account_balance': _uniform(rng, 0, 50000, size),
+        'is_cash_intensive': sample('is_cash_intensive'),
+        'tpr_threshold_exceeded': sample('tpr_threshold_exceeded'),
+        'transacts_hr_jurisdictions': sample('transacts_hr_jurisdictions'),
+        'preferred_channel': sample('preferred_channel'),
+        'interests': _interests(rng, size),
+        'occupation': pool.sample('job', size, rng),
+        'lifecycle_stage': sample('lifecycle_stage'),
+        'churn_risk_score': _uniform(rng, 0, 5, size),
+        'predicted_clv': _uniform(rng, 100, 10000, size),
+        'consent_marketing': sample('consent_marketing'),
+        'consent_data_share': sample('consent_data_share'),
+        # About 20% of customers have a data deletion date
+        'data_deletion_date': _nullable(pool.dates_this_decade(size, rng, as_of), rng.random(size) < 0.2),
+        'risk_profile': sample('risk_profile')
+    }
+    # Age, occupation and balance resampled from real rows instead
+    if source is not None:
+        columns.update(source.customer_columns(rng, size))
+    return columns
+
+def _dim_customer_shard(shard_index, first_customer_id, count, batch_size, seed, unique_count, today, source_path,
+                        pipeline, run, cache=None):
+    rng = shard_rng(seed, 'Dim_Customer', shard_index)
+    pool = faker_pool()
+    regions = branch_regions()
+    source = bank_customer_source(source_path) if source_path else None
+    names = None
+    if unique_count:
+        names = functools.partial(pool.unique_names, count=unique_count, seed=seed)
+
+    start, batch_index = 0, 0
+    checkpoint = run.progress.get(shard_index)
+    if checkpoint:
+        _restore_rng(rng, checkpoint['state'])
+        start, batch_index = checkpoint['rows'], checkpoint['batch'] + 1
+
+    with open_writer(pipeline, run.run_id) as writer:
+        for i in range(start, count, batch_size):
+            current_batch_size = min(batch_size, count - i)
+            columns = _dim_customer_batch(
+                rng, pool, regions, first_customer_id + i, current_batch_size, names, today, source
+            )
+            last_customer_id = first_customer_id + i + current_batch_size - 1
+            writer.write(
+                'Dim_Customer', columns,
+                on_commit=run.checkpoint(
+                    shard_index, batch_index, last_customer_id, last_customer_id + 1, i + current_batch_size, rng
+                )
+            )
+            batch_index += 1
+            print(f'Inserted {current_batch_size} customers (Shard {shard_index}: {i + current_batch_size}/{count})')
+
+    run.finish_shard(shard_index, batch_index, count)
+    print(writer.report(f'Dim_Customer shard {shard_index}'))
+    return count - start
+
+@measured_stage
+def generate_dim_customer(num_customers=5000, batch_size=100000, seed=None, workers=1, shard_size=DEFAULT_SHARD_SIZE,
+                          pipeline=None, unique_names=False, as_of=None, source=None, resume=False, append=False):
+    # Streams Dim_Customer in columnar batches of batch_size rows, so 10-50M
+    # customers never exist in memory at once. Like generate_fact_sales it runs
+    # customer_id shards on workers processes, with the same rows for any worker
+    # count, and supports resume/append. unique_names keeps names distinct
+    # across all shards (ids 1..first_id + num_customers - 1). source is a CSV
+    # like BankCustomerData.csv to resample age_group, occupation and average_balance from.
+    if resume:
+        run = StageRun.resume('Dim_Customer')
+    else:
+        run = StageRun.start(
+            'Dim_Customer', first_id=next_id('Dim_Customer', 'customer_id') if append else 1,
+            num_customers=num_customers, batch_size=batch_size, seed=resolve_seed(seed), shard_size=shard_size,
+            unique_names=unique_names, today=resolve_as_of(as_of).isoformat(), source=source
+        )
+    first_id, num_customers, batch_size, seed, shard_size, unique_names, today, source = run.get(
+        'first_id', 'num_customers', 'batch_size', 'seed', 'shard_size', 'unique_names', 'today', 'source'
+    )
+    unique_count = first_id + num_customers - 1 if unique_names else 0
+    pending = [
+        shard for shard in plan_shards(first_id, num_customers, shard_size) if run.progress.get(shard[0]) != 'done'
+    ]
 
-def generate_dimension_data():
-    # Generate Dim_Time
-    dim_time = []
-    start_date = datetime(2021, 1, 1)
-    end_date = datetime(2023, 12, 31)
-    current_date = start_date
-    date_id = 1
-    while current_date <= end_date:
-        dim_time.append({
-            'date_id': date_id,
-            'date': current_date.date(),
-            'month': current_date.month,
-            'year': current_date.year
-        })
-        current_date += timedelta(days=1)
-        date_id += 1
+    # Built (or read from disk) once here rather than by every worker
+    faker_pool()
+    if source:
+        bank_customer_source(source)
+    shards = [
+        (shard_index, first_customer_id, count, batch_size, seed, unique_count, today, source, pipeline, run)
+        for shard_index, first_customer_id, count in pending
+    ]
+    total = sum(run_shards(_dim_customer_shard, shards, workers))
+    print(f'Inserted {total} customers across {len(shards)} shards')
+
+@measured_stage
+def generate_dimension_data(unique_names=False, as_of=None, num_customers=5000, seed=None, customer_source=None):
+    # Generate Dim_Time: every day of 2021-2023
+    dates = np.arange(np.datetime64(DIM_TIME_START), np.datetime64(DIM_TIME_END))
+    dim_time = {
+        'date_id': np.arange(1, len(dates) + 1, dtype=np.int32),
+        'date': dates,
+        'month': (dates.astype('datetime64[M]').astype(np.int64) % 12 + 1).astype(np.int8),
+        'year': (dates.astype('datetime64[Y]').astype(np.int64) + 1970).astype(np.int16)
+    }
 
     # Generate Dim_Region
-    dim_regions = []
-    for region_id in range(1, 51):
-        dim_regions.append({
-            'region_id': region_id,
-            'region_name': fake.state(),
-            'country': fake.country(),
-            'sales_manager': fake.name()
-        })
+    pool = faker_pool()
+    rng = faker_rng()
+    region_ids = range(1, 51)
+    dim_regions = {
+        'region_id': list(region_ids),
+        'region_name': pool.sample('state', len(region_ids), rng).tolist(),
+        'country': pool.sample('country', len(region_ids), rng).tolist(),
+        'sales_manager': pool.names(len(region_ids), rng).tolist()
+    }
 
     # Generate Dim_Sales_Channel
     dim_sales_channels = [
@@ -209,10 +2220,9 @@ def generate_dimension_data():
     ]
 
     # Generate Dim_Product with loan products
-    categories = ['Auto Loan', 'Mortgage', 'Business Loan', 'Personal Loan', 'Credit Card']
     dim_products = []
     for product_id in range(1, 201):
-        category = random.choices(categories, weights=[0.3, 0.25, 0.2, 0.15, 0.1], k=1)[0]
+        category = distribution('product_category').draw()
         if category == 'Auto Loan':
             product_name = f"{random.choice(['New', 'Used'])} Auto Loan {random.choice(['Standard', 'Premium'])}"
             price = round(random.uniform(100.0, 500.0), 2)
@@ -237,352 +2247,1058 @@ def generate_dimension_data():
             'supplier_id': random.randint(1, 50)
         })
 
-    # Generate Dim_Customer with risk profiles
-    age_groups = ['18-24', '25-34', '35-44', '45-54', '55+']
-    dim_customers = []
-    for customer_id in range(1, 5001):
-        risk_profile = random.choices(['Low', 'Medium', 'High'], weights=[0.7, 0.2, 0.1])[0]
-        dim_customers.append({
-            'customer_id': customer_id,
-            'name': fake.name(),
-            'region_id': random.randint(1, 50),
-            'age_group': random.choice(age_groups),
-            'gender': random.choice(['M', 'F', 'O']),
-            'membership_status': random.choice(['Gold', 'Silver', 'Bronze', 'None']),
-            'average_balance': round(random.uniform(1000, 100000), 2),
-            'average_income': round(random.uniform(20000, 150000), 2),
-            'business_risk_class': random.choice(['High Risk', 'Medium Risk', 'Low Risk', 'Not Classified']),
-            'is_pep': random.choices([True, False], weights=[0.1, 0.9])[0],
-            'account_balance': round(random.uniform(0, 50000), 2),
-            'is_cash_intensive': random.choices([True, False], weights=[0.2, 0.8])[0],
-            'tpr_threshold_exceeded': random.choices([True, False], weights=[0.3, 0.7])[0],
-            'transacts_hr_jurisdictions': random.choices([True, False], weights=[0.1, 0.9])[0],
-            'preferred_channel': random.choice(['Email', 'SMS', 'App Notification', 'Post']),
-            'interests': random.sample(['Sports', 'Tech', 'Fashion', 'Books'], k=random.randint(1, 3)),
-            'occupation': fake.job(),
-            'lifecycle_stage': random.choice(['Prospect', 'First-Time', 'Regular', 'VIP']),
-            'churn_risk_score': round(random.uniform(0, 5), 2),
-            'predicted_clv': round(random.uniform(100, 10000), 2),
-            'consent_marketing': random.choice([True, False]),
-            'consent_data_share': random.choice([True, False]),
-            'data_deletion_date': fake.date_this_decade() if random.random() < 0.2 else None,
-            'risk_profile': risk_profile
-        })
-
     # Insert dimension data
-    ch_client.execute('INSERT INTO Dim_Time VALUES', dim_time)
-    ch_client.execute('INSERT INTO Dim_Region VALUES', dim_regions)
-    ch_client.execute('INSERT INTO Dim_Sales_Channel VALUES', dim_sales_channels)
-    ch_client.execute('INSERT INTO Dim_Product VALUES', dim_products)
-    ch_client.execute('INSERT INTO Dim_Customer VALUES', dim_customers)
+    insert_columns('Dim_Time', dim_time)
+    insert_columns('Dim_Region', dim_regions)
+    insert_rows('Dim_Sales_Channel', dim_sales_channels)
+    insert_rows('Dim_Product', dim_products)
+
+    # Dim_Customer with risk profiles, streamed in columnar batches
+    generate_dim_customer(
+        num_customers, seed=random.getrandbits(63) if seed is None else seed, unique_names=unique_names, as_of=as_of,
+        source=customer_source
+    )
     print("Dimension data inserted.")
 
-def generate_fact_sales(num_records=100000, batch_size=10000):
-    # Preload customer risk profiles
-    customer_risk = {row[0]: row[1] for row in ch_client.execute('SELECT customer_id, risk_profile FROM Dim_Customer')}
-
-    # Get dimension keys
-    date_ids = [row[0] for row in ch_client.execute('SELECT date_id FROM Dim_Time')]
-    product_ids = [row[0] for row in ch_client.execute('SELECT product_id FROM Dim_Product')]
-    customer_ids = list(customer_risk.keys())
-    region_ids = [row[0] for row in ch_client.execute('SELECT region_id FROM Dim_Region')]
-    channel_ids = [row[0] for row in ch_client.execute('SELECT channel_id FROM Dim_Sales_Channel')]
-
-    for i in range(0, num_records, batch_size):
-        batch = []
-        current_batch_size = min(batch_size, num_records - i)
-
-        for sale_id in range(i + 1, i + current_batch_size + 1):
-            customer_id = random.choice(customer_ids)
-            risk_profile = customer_risk[customer_id]
-
-            # Determine approval status
-            if risk_profile == 'High':
-                approved = random.choices([True, False], weights=[0.2, 0.8])[0]
-            elif risk_profile == 'Medium':
-                approved = random.choices([True, False], weights=[0.6, 0.4])[0]
-            else:
-                approved = random.choices([True, False], weights=[0.9, 0.1])[0]
-            status = 'Approved' if approved else 'Rejected'
-
-            product_id = random.choice(product_ids)
-            price = ch_client.execute(
-                'SELECT price FROM Dim_Product WHERE product_id = %(product_id)s',
-                {'product_id': product_id}
-            )[0][0]
-
-            units = 1
-            if status == 'Approved':
-                discount = round(random.uniform(0, price * 0.2), 2)
-                base_revenue = round(price - discount, 2)
-
-                # Additional fees and costs
-                processing_fees = round(base_revenue * random.uniform(0.01, 0.02), 2)
-                documentation_fees = round(random.uniform(500, 2000), 2)
-                insurance_fees = round(base_revenue * random.uniform(0.005, 0.015), 2)
-                customer_acquisition_cost = round(random.uniform(1000, 5000), 2)
-
-                # EMI bounce charges and NPA losses based on risk profile
-                if risk_profile == 'High':
-                    emi_bounce_charges = round(random.uniform(500, 2000), 2)
-                    npa_loss_amount = round(base_revenue * random.uniform(0.1, 0.3), 2) if random.random() < 0.2 else 0
-                elif risk_profile == 'Medium':
-                    emi_bounce_charges = round(random.uniform(200, 1000), 2)
-                    npa_loss_amount = round(base_revenue * random.uniform(0.05, 0.15), 2) if random.random() < 0.1 else 0
-                else:
-                    emi_bounce_charges = round(random.uniform(0, 500), 2)
-                    npa_loss_amount = round(base_revenue * random.uniform(0.02, 0.08), 2) if random.random() < 0.05 else 0
+# Per risk_profile sale parameters, shared by the python and numpy engines (approval is the 'sale_approval' distribution)
+EMI_BOUNCE_CHARGE_RANGES = {'Low': (0, 500), 'Medium': (200, 1000), 'High': (500, 2000)}
+# (probability of an NPA, loss fraction range of base revenue)
+NPA_LOSS_PARAMS = {'Low': (0.05, (0.02, 0.08)), 'Medium': (0.1, (0.05, 0.15)), 'High': (0.2, (0.1, 0.3))}
+
+FACT_SALES_COLUMNS = [
+    'sale_id', 'date_id', 'product_id', 'customer_id', 'region_id', 'channel_id', 'units_sold',
+    'revenue', 'discount_amount', 'processing_fees', 'documentation_fees', 'insurance_fees',
+    'customer_acquisition_cost', 'emi_bounce_charges', 'npa_loss_amount', 'total_revenue', 'status'
+]
+
+def risk_levels(cache, customer_ids):
+    # Map customers to an index into RISK_PROFILES; unknown profiles behave like 'Low'
+    customers = cache['Dim_Customer']
+    vocabulary = customers.vocabularies['risk_profile']
+    level_of_code = np.array(
+        [RISK_PROFILES.index(value) if value in RISK_PROFILES else 0 for value in vocabulary] + [0],
+        dtype=np.int8
+    )
+    return level_of_code[customers.codes('risk_profile', customer_ids)]
+
+# Share of customers and sales per region_name; the branches of a region split its share evenly
+REGION_WEIGHTS = {'Central': 0.5, 'East': 0.25, 'West': 0.15, 'North': 0.10}
+
+# List of regions and branches from the image with their coordinates
+BRANCH_REGIONS = [
+    {"region": "Central", "branch": "Main Branch", "latitude": 1.2789, "longitude": 103.8536},
+    {"region": "North", "branch": "Ang Mo Kio Ave 1 Branch", "latitude": 1.3700, "longitude": 103.8470},
+    {"region": "Central", "branch": "Balestier Branch", "latitude": 1.3275, "longitude": 103.8452},
+    {"region": "Central", "branch": "Balestier SME Centre", "latitude": 1.3276, "longitude": 103.8453},
+    {"region": "East", "branch": "Bedok Branch", "latitude": 1.3236, "longitude": 103.9273},
+    {"region": "East", "branch": "Bedok SME Centre", "latitude": 1.3237, "longitude": 103.9274},
+    {"region": "West", "branch": "Bukit Batok Central Branch", "latitude": 1.3490, "longitude": 103.7494},
+    {"region": "Central", "branch": "Bukit Merah Branch", "latitude": 1.2819, "longitude": 103.8239},
+    {"region": "Central", "branch": "Bukit Merah SME Centre", "latitude": 1.2820, "longitude": 103.8240},
+    {"region": "East", "branch": "City Plaza Branch", "latitude": 1.3142, "longitude": 103.8933},
+    {"region": "East", "branch": "City Plaza SME Centre", "latitude": 1.3143, "longitude": 103.8934},
+    {"region": "Central", "branch": "City Square Mall Branch", "latitude": 1.3115, "longitude": 103.8559},
+    {"region": "Central", "branch": "City Square Mall SME Centre", "latitude": 1.3116, "longitude": 103.8560},
+    {"region": "West", "branch": "Clementi West Branch", "latitude": 1.3150, "longitude": 103.7650},
+    {"region": "West", "branch": "Clementi West SME Centre", "latitude": 1.3151, "longitude": 103.7651},
+    {"region": "Central", "branch": "Ghim Moh Branch", "latitude": 1.3107, "longitude": 103.7890},
+    {"region": "Central", "branch": "Holland Drive Branch", "latitude": 1.3112, "longitude": 103.7914},
+    {"region": "Central", "branch": "Hong Lim Branch", "latitude": 1.2847, "longitude": 103.8470},
+    {"region": "Central", "branch": "Hong Lim SME Centre", "latitude": 1.2848, "longitude": 103.8471}
+]
+
+def _region_probabilities(names):
+    # Probabilities for regions with these region_names, or None if none of them is weighted
+    weights = np.array([REGION_WEIGHTS.get(name, 0.0) / names.count(name) for name in names])
+    if not weights.any():
+        return None
+    return weights / weights.sum()
+
+def region_weights(cache):
+    # Per region_id probabilities following REGION_WEIGHTS, so sales get their final
+    # region at generation time instead of through update_region_ids. None (uniform)
+    # while Dim_Region has none of those regions, i.e. before alter_regions has run.
+    regions = cache['Dim_Region']
+    # Decoded straight from the column so the report only counts the fact rows' lookups
+    vocabulary = regions.vocabularies['region_name']
+    return _region_probabilities([vocabulary[code] for code in regions.columns['region_name']])
+
+def branch_regions():
+    # Weighted choice over the region_ids alter_regions gives BRANCH_REGIONS. Customers
+    # are generated before that Dim_Region exists, so they draw from the list itself.
+    return Categorical(
+        range(1, len(BRANCH_REGIONS) + 1), _region_probabilities([branch['region'] for branch in BRANCH_REGIONS])
+    )
+
+def _fact_sales_batch_python(cache, keys, first_sale_id, size):
+    date_ids, product_ids, customer_ids, regions, channel_ids = keys
+    approval = distribution('sale_approval')
+    batch = []
+
+    for sale_id in range(first_sale_id, first_sale_id + size):
+        customer_id = random.choice(customer_ids)
+        risk_profile = cache.get('Dim_Customer', 'risk_profile', customer_id)
+        if risk_profile not in RISK_PROFILES:
+            risk_profile = 'Low'
+
+        # Determine approval status
+        approved = approval.draw(risk_profile)
+        status = 'Approved' if approved else 'Rejected'
+
+        product_id = random.choice(product_ids)
+        price = cache.get('Dim_Product', 'price', product_id)
+
+        units = 1
+        if status == 'Approved':
+            discount = round(random.uniform(0, price * 0.2), 2)
+            base_revenue = round(price - discount, 2)
+
+            # Additional fees and costs
+            processing_fees = round(base_revenue * random.uniform(0.01, 0.02), 2)
+            documentation_fees = round(random.uniform(500, 2000), 2)
+            insurance_fees = round(base_revenue * random.uniform(0.005, 0.015), 2)
+            customer_acquisition_cost = round(random.uniform(1000, 5000), 2)
+
+            # EMI bounce charges and NPA losses based on risk profile
+            emi_bounce_charges = round(random.uniform(*EMI_BOUNCE_CHARGE_RANGES[risk_profile]), 2)
+            npa_probability, npa_range = NPA_LOSS_PARAMS[risk_profile]
+            npa_loss_amount = round(base_revenue * random.uniform(*npa_range), 2) if random.random() < npa_probability else 0
+
+            total_revenue = base_revenue + processing_fees + documentation_fees + insurance_fees + emi_bounce_charges - npa_loss_amount
+        else:
+            base_revenue = discount = processing_fees = documentation_fees = insurance_fees = 0
+            customer_acquisition_cost = round(random.uniform(500, 2000), 2)  # Cost still incurred for rejected applications
+            emi_bounce_charges = npa_loss_amount = 0
+            total_revenue = 0
+
+        # Row tuples follow FACT_SALES_COLUMNS
+        batch.append((
+            sale_id, random.choice(date_ids), product_id, customer_id,
+            regions.draw(),
+            random.choice(channel_ids), units, base_revenue, discount, processing_fees, documentation_fees,
+            insurance_fees, customer_acquisition_cost, emi_bounce_charges, npa_loss_amount, total_revenue, status
+        ))
+
+    for table in ('Dim_Time', 'Dim_Product', 'Dim_Customer', 'Dim_Region', 'Dim_Sales_Channel'):
+        cache.count_picks(table, size)
+    return columns_from_rows(FACT_SALES_COLUMNS, batch)
+
+def _fact_sales_batch_numpy(rng, cache, regions, first_sale_id, size):
+    # Same per-risk distributions as the python engine, sampled a column at a time;
+    # regions is the shard's weighted Categorical over Dim_Region ids
+    def pick(table):
+        ids = cache[table].ids
+        cache.count_picks(table, size)
+        return ids[rng.integers(0, len(ids), size)]
+
+    customer_ids = pick('Dim_Customer')
+    risk = risk_levels(cache, customer_ids)
+    approval = distribution('sale_approval')
+    approved = approval.sample(rng, approval.condition_indices(RISK_PROFILES)[risk])
+
+    product_ids = pick('Dim_Product')
+    price = cache.take('Dim_Product', 'price', product_ids, 0.0)
+
+    discount = np.round(price * 0.2 * rng.random(size), 2)
+    base_revenue = np.round(price - discount, 2)
+    processing_fees = np.round(base_revenue * rng.uniform(0.01, 0.02, size), 2)
+    documentation_fees = _uniform(rng, 500, 2000, size)
+    insurance_fees = np.round(base_revenue * rng.uniform(0.005, 0.015, size), 2)
+
+    bounce_low = np.array([EMI_BOUNCE_CHARGE_RANGES[r][0] for r in RISK_PROFILES], dtype=np.float64)[risk]
+    bounce_high = np.array([EMI_BOUNCE_CHARGE_RANGES[r][1] for r in RISK_PROFILES], dtype=np.float64)[risk]
+    emi_bounce_charges = _uniform(rng, bounce_low, bounce_high, size)
+
+    npa_probability = np.array([NPA_LOSS_PARAMS[r][0] for r in RISK_PROFILES])[risk]
+    npa_low = np.array([NPA_LOSS_PARAMS[r][1][0] for r in RISK_PROFILES])[risk]
+    npa_high = np.array([NPA_LOSS_PARAMS[r][1][1] for r in RISK_PROFILES])[risk]
+    npa_loss_amount = np.where(
+        rng.random(size) < npa_probability,
+        np.round(base_revenue * rng.uniform(npa_low, npa_high), 2),
+        0.0
+    )
+
+    # Rejected applications still incur an acquisition cost but earn nothing
+    customer_acquisition_cost = np.where(approved, _uniform(rng, 1000, 5000, size), _uniform(rng, 500, 2000, size))
+    total_revenue = base_revenue + processing_fees + documentation_fees + insurance_fees + emi_bounce_charges - npa_loss_amount
+
+    def approved_only(values):
+        return np.where(approved, values, 0.0)
+
+    cache.count_picks('Dim_Region', size)  # drawn from its ids, like pick()
+    return {
+        'sale_id': np.arange(first_sale_id, first_sale_id + size, dtype=np.int32),
+        'date_id': pick('Dim_Time'),
+        'product_id': product_ids,
+        'customer_id': customer_ids,
+        'region_id': regions.sample(rng, size),
+        'channel_id': pick('Dim_Sales_Channel'),
+        'units_sold': np.ones(size, dtype=np.int32),
+        'revenue': approved_only(base_revenue),
+        'discount_amount': approved_only(discount),
+        'processing_fees': approved_only(processing_fees),
+        'documentation_fees': approved_only(documentation_fees),
+        'insurance_fees': approved_only(insurance_fees),
+        'customer_acquisition_cost': customer_acquisition_cost,
+        'emi_bounce_charges': approved_only(emi_bounce_charges),
+        'npa_loss_amount': approved_only(npa_loss_amount),
+        'total_revenue': approved_only(total_revenue),
+        'status': np.where(approved, 'Approved', 'Rejected').astype(object)
+    }
 
-                total_revenue = base_revenue + processing_fees + documentation_fees + insurance_fees + emi_bounce_charges - npa_loss_amount
+# Server engine: rows are generated inside ClickHouse by INSERT ... SELECT FROM numbers(N),
+# so nothing but the statement crosses the wire. Each draw hashes (seed, draw name, row id)
+# instead of calling rand(), which makes a seeded run repeatable and independent of shard size.
+def _sql_uniform(draw, row_id, low=0.0, high=1.0):
+    unit = f"(cityHash64(%(seed)s, '{draw}', {row_id}) / 18446744073709551616.)"
+    if (low, high) == (0.0, 1.0):
+        return unit
+    return f"({low} + ({high} - {low}) * {unit})"
+
+def _sql_pick(draw, row_id, values):
+    # values is an array expression: a literal or a WITH alias over a dimension's keys
+    return f"{values}[1 + cityHash64(%(seed)s, '{draw}', {row_id}) %% length({values})]"
+
+def _sql_choice(draw, row_id, values, weights):
+    # Weighted choice through the cumulative weights, like random.choices
+    unit = _sql_uniform(draw, row_id)
+    branches = []
+    cumulative = 0.0
+    total = sum(weights)
+    for value, weight in zip(values[:-1], weights[:-1]):
+        cumulative += weight / total
+        branches.append(f"{unit} < {cumulative:.6g}, '{value}'")
+    return f"multiIf({', '.join(branches)}, '{values[-1]}')"
+
+def _sql_weighted_pick(draw, row_id, values, weights):
+    # Weighted pick from a literal list: first cumulative weight above the draw
+    cumulative = np.cumsum(weights) / np.sum(weights)
+    bounds = ', '.join(f'{bound:.6g}' for bound in cumulative[:-1])
+    return f"{list(values)}[arrayFirstIndex(bound -> {_sql_uniform(draw, row_id)} < bound, [{bounds}, 2.])]"
+
+def _sql_by_risk(column, values, default):
+    # multiIf over RISK_PROFILES; profiles missing from values fall back to values[default]
+    branches = [f"{column} = '{risk}', {values[risk]}" for risk in RISK_PROFILES if risk != default]
+    return f"multiIf({', '.join(branches)}, {values[default]})"
+
+def _fact_sales_server_query(region_ids=None, region_p=None):
+    def u(draw, low=0.0, high=1.0):
+        return _sql_uniform(draw, 'sale_id', low, high)
+
+    bounce_low = _sql_by_risk('risk', {r: low for r, (low, high) in EMI_BOUNCE_CHARGE_RANGES.items()}, 'Low')
+    bounce_high = _sql_by_risk('risk', {r: high for r, (low, high) in EMI_BOUNCE_CHARGE_RANGES.items()}, 'Low')
+    npa_probability = _sql_by_risk('risk', {r: p for r, (p, _) in NPA_LOSS_PARAMS.items()}, 'Low')
+    npa_low = _sql_by_risk('risk', {r: loss[0] for r, (_, loss) in NPA_LOSS_PARAMS.items()}, 'Low')
+    npa_high = _sql_by_risk('risk', {r: loss[1] for r, (_, loss) in NPA_LOSS_PARAMS.items()}, 'Low')
+    approval_rate = _sql_by_risk('risk', {r: distribution('sale_approval')[r].probability(True) for r in RISK_PROFILES}, 'Low')
+    columns = ', '.join(FACT_SALES_COLUMNS)
+    risk_profiles = ', '.join(f"'{risk}'" for risk in RISK_PROFILES)
+    if region_p is None:
+        region_id = _sql_pick('region_id', 'sale_id', 'region_ids')
+    else:
+        region_id = _sql_weighted_pick('region_id', 'sale_id', region_ids, region_p)
+
+    return f'''
+        INSERT INTO Fact_Sales ({columns})
+        SELECT {columns}
+        FROM (
+            SELECT
+                s.sale_id AS sale_id, s.date_id AS date_id, s.product_id AS product_id,
+                s.customer_id AS customer_id, s.region_id AS region_id, s.channel_id AS channel_id,
+                toInt32(1) AS units_sold,
+                if(dc.risk_profile IN ({risk_profiles}), dc.risk_profile, 'Low') AS risk,
+                {u('approval')} < {approval_rate} AS approved,
+                round(dp.price * 0.2 * {u('discount')}, 2) AS discount,
+                round(dp.price - discount, 2) AS base_revenue,
+                round(base_revenue * {u('processing_fees', 0.01, 0.02)}, 2) AS processing,
+                round({u('documentation_fees', 500, 2000)}, 2) AS documentation,
+                round(base_revenue * {u('insurance_fees', 0.005, 0.015)}, 2) AS insurance,
+                round({u('emi_bounce_charges', bounce_low, bounce_high)}, 2) AS bounce,
+                if({u('npa')} < {npa_probability},
+                   round(base_revenue * {u('npa_loss', npa_low, npa_high)}, 2), 0.) AS npa_loss,
+                -- Rejected applications still incur an acquisition cost but earn nothing
+                round(if(approved, {u('acquisition_cost', 1000, 5000)}, {u('acquisition_cost', 500, 2000)}), 2)
+                    AS customer_acquisition_cost,
+                if(approved, base_revenue, 0.) AS revenue,
+                if(approved, discount, 0.) AS discount_amount,
+                if(approved, processing, 0.) AS processing_fees,
+                if(approved, documentation, 0.) AS documentation_fees,
+                if(approved, insurance, 0.) AS insurance_fees,
+                if(approved, bounce, 0.) AS emi_bounce_charges,
+                if(approved, npa_loss, 0.) AS npa_loss_amount,
+                if(approved, base_revenue + processing + documentation + insurance + bounce - npa_loss, 0.)
+                    AS total_revenue,
+                if(approved, 'Approved', 'Rejected') AS status
+            FROM (
+                WITH
+                    (SELECT arraySort(groupArray(date_id)) FROM Dim_Time) AS date_ids,
+                    (SELECT arraySort(groupArray(product_id)) FROM Dim_Product) AS product_ids,
+                    (SELECT arraySort(groupArray(customer_id)) FROM Dim_Customer) AS customer_ids,
+                    (SELECT arraySort(groupArray(region_id)) FROM Dim_Region) AS region_ids,
+                    (SELECT arraySort(groupArray(channel_id)) FROM Dim_Sales_Channel) AS channel_ids
+                SELECT
+                    toInt32(%(first_id)s + number) AS sale_id,
+                    {_sql_pick('date_id', 'sale_id', 'date_ids')} AS date_id,
+                    {_sql_pick('product_id', 'sale_id', 'product_ids')} AS product_id,
+                    {_sql_pick('customer_id', 'sale_id', 'customer_ids')} AS customer_id,
+                    {region_id} AS region_id,
+                    {_sql_pick('channel_id', 'sale_id', 'channel_ids')} AS channel_id
+                FROM numbers(%(count)s)
+            ) AS s
+            LEFT JOIN Dim_Customer AS dc ON s.customer_id = dc.customer_id
+            LEFT JOIN Dim_Product AS dp ON s.product_id = dp.product_id
+        )
+    '''
+
+def _fact_sales_server_shard(shard_index, first_sale_id, count, seed, region_ids, region_p, run, cache=None):
+    started = time.perf_counter()
+    if run.resumed:
+        # The shard may have been inserted in part before the run stopped
+        ch_pool.execute(
+            'DELETE FROM Fact_Sales WHERE sale_id BETWEEN %(first_id)s AND %(last_id)s',
+            {'first_id': first_sale_id, 'last_id': first_sale_id + count - 1}
+        )
+    ch_pool.execute(
+        _fact_sales_server_query(region_ids, region_p), {'first_id': first_sale_id, 'count': count, 'seed': seed}
+    )
+    metrics.add(rows=count)
+    run.finish_shard(shard_index, 0, count)
+    print(f'Inserted {count} sales records server-side (Shard {shard_index}) in {time.perf_counter() - started:.1f}s')
+    return count
+
+def _fact_sales_shard(shard_index, first_sale_id, count, batch_size, engine, seed, pipeline, run, cache=None):
+    cache = cache or worker_cache()
+    rng = shard_rng(seed, 'Fact_Sales', shard_index)
+
+    # Get dimension keys, and the region weights once per shard
+    region_p = region_weights(cache)
+    keys = (
+        cache.keys('Dim_Time'),
+        cache.keys('Dim_Product'),
+        cache.keys('Dim_Customer'),
+        Categorical(cache.keys('Dim_Region'), region_p),
+        cache.keys('Dim_Sales_Channel')
+    )
+    regions = Categorical(cache['Dim_Region'].ids, region_p)
+
+    # Continue after the last committed batch of an interrupted run
+    start, batch_index = 0, 0
+    checkpoint = run.progress.get(shard_index)
+    if checkpoint:
+        _restore_rng(rng, checkpoint['state'])
+        start, batch_index = checkpoint['rows'], checkpoint['batch'] + 1
+
+    with open_writer(pipeline, run.run_id) as writer:
+        for i in range(start, count, batch_size):
+            current_batch_size = min(batch_size, count - i)
+
+            if engine == 'numpy':
+                columns = _fact_sales_batch_numpy(rng, cache, regions, first_sale_id + i, current_batch_size)
             else:
-                base_revenue = discount = processing_fees = documentation_fees = insurance_fees = 0
-                customer_acquisition_cost = round(random.uniform(500, 2000), 2)  # Cost still incurred for rejected applications
-                emi_bounce_charges = npa_loss_amount = 0
-                total_revenue = 0
-
-            batch.append({
-                'sale_id': sale_id,
-                'date_id': random.choice(date_ids),
-                'product_id': product_id,
-                'customer_id': customer_id,
-                'region_id': random.choice(region_ids),
-                'channel_id': random.choice(channel_ids),
-                'units_sold': units,
-                'revenue': base_revenue,
-                'discount_amount': discount,
-                'processing_fees': processing_fees,
-                'documentation_fees': documentation_fees,
-                'insurance_fees': insurance_fees,
-                'customer_acquisition_cost': customer_acquisition_cost,
-                'emi_bounce_charges': emi_bounce_charges,
-                'npa_loss_amount': npa_loss_amount,
-                'total_revenue': total_revenue,
-                'status': status
-            })
-
-        ch_client.execute('INSERT INTO Fact_Sales VALUES', batch)
-        print(f'Inserted {len(batch)} sales records (Total: {i + len(batch)}/{num_records})')
-
-def generate_loan_repayments():
-    print("Generating loan repayment data...")
-
-    # Get all active and delinquent loans
-    loans = ch_client.execute('''
-        SELECT loan_id, customer_id, loan_amount, interest_rate, term_months, start_date, loan_status, risk_rating
-        FROM Dim_Loan
-        WHERE loan_status IN ('Active', 'Delinquent', 'Defaulted')
-    ''')
-
-    repayments = []
-    repayment_id = 1
-
-    payment_modes = ['UPI', 'NEFT', 'Auto-Debit', 'Cash', 'Cheque']
-    bounce_reasons = ['Insufficient Funds', 'Account Closed', 'Payment Stopped', 'Technical Error']
-
-    for loan in loans:
-        loan_id, customer_id, loan_amount, interest_rate, term_months, start_date, loan_status, risk_rating = loan
-
-        # Calculate EMI
-        monthly_rate = interest_rate / (12 * 100)
-        emi_amount = round((loan_amount * monthly_rate * (1 + monthly_rate)**term_months) / ((1 + monthly_rate)**term_months - 1), 2)
-
-        outstanding_principal = loan_amount
-
-        for emi_number in range(1, term_months + 1):
-            due_date = start_date + timedelta(days=30 * emi_number)
-
-            # Skip future EMIs
-            if due_date > datetime.now().date():
-                continue
-
-            interest_amount = round(outstanding_principal * monthly_rate, 2)
-            principal_amount = round(min(emi_amount - interest_amount, outstanding_principal), 2)
-
-            # Determine payment status and date based on loan status and risk
-            if loan_status == 'Active':
-                if risk_rating == 'High':
-                    payment_status = random.choices(['Paid', 'Bounced', 'Partial'], weights=[0.7, 0.2, 0.1])[0]
-                elif risk_rating == 'Medium':
-                    payment_status = random.choices(['Paid', 'Bounced', 'Partial'], weights=[0.8, 0.15, 0.05])[0]
-                else:
-                    payment_status = random.choices(['Paid', 'Bounced', 'Partial'], weights=[0.9, 0.08, 0.02])[0]
-            elif loan_status == 'Delinquent':
-                payment_status = random.choices(['Overdue', 'Partial'], weights=[0.7, 0.3])[0]
-            else:  # Defaulted
-                payment_status = 'Defaulted'
-
+                columns = _fact_sales_batch_python(cache, keys, first_sale_id + i, current_batch_size)
+            last_sale_id = first_sale_id + i + current_batch_size - 1
+            writer.write(
+                'Fact_Sales', columns, use_numpy=engine == 'numpy' and USE_NUMPY_INSERTS,
+                on_commit=run.checkpoint(
+                    shard_index, batch_index, last_sale_id, last_sale_id + 1, i + current_batch_size, rng
+                )
+            )
+            batch_index += 1
+            print(f'Inserted {current_batch_size} sales records (Shard {shard_index}: {i + current_batch_size}/{count})')
+
+    run.finish_shard(shard_index, batch_index, count)
+    print(writer.report(f'Fact_Sales shard {shard_index}'))
+    return count - start
+
+@measured_stage
+def generate_fact_sales(num_records=100000, batch_size=10000, cache=None, engine='python', seed=None,
+                        workers=1, shard_size=DEFAULT_SHARD_SIZE, pipeline=None, resume=False, append=False):
+    # engine='numpy' generates each batch column-wise with NumPy instead of row by row;
+    # engine='server' has ClickHouse generate each shard with a single INSERT ... SELECT.
+    # workers > 1 generates sale_id shards on a process pool; a fixed seed gives
+    # the same rows for any worker count. pipeline overlaps generation with inserts (see open_writer).
+    # resume=True continues the last Fact_Sales run with its own arguments; append=True adds
+    # num_records sales after the current max sale_id (use a different seed than earlier runs).
+    if engine not in ('python', 'numpy', 'server'):
+        raise ValueError(f"Unknown Fact_Sales engine: {engine}")
+    if engine == 'server' and not isinstance(sink, ClickHouseSink):
+        raise ValueError("engine='server' generates inside ClickHouse and needs the ClickHouse sink")
+
+    if resume:
+        run = StageRun.resume('Fact_Sales')
+    else:
+        run = StageRun.start(
+            'Fact_Sales', first_id=next_id('Fact_Sales', 'sale_id') if append else 1, num_records=num_records,
+            batch_size=batch_size, engine=engine, seed=resolve_seed(seed), shard_size=shard_size
+        )
+    first_id, num_records, batch_size, engine, seed, shard_size = run.get(
+        'first_id', 'num_records', 'batch_size', 'engine', 'seed', 'shard_size'
+    )
+    pending = [shard for shard in plan_shards(first_id, num_records, shard_size) if run.progress.get(shard[0]) != 'done']
+
+    if engine == 'server':
+        # Only the region weights are needed client-side
+        regions = DimensionCache(sink, tables=['Dim_Region']).load()
+        region_p = region_weights(regions)
+        region_p = None if region_p is None else region_p.tolist()
+        region_ids = regions.keys('Dim_Region')
+
+        total = sum(run_shards(
+            _fact_sales_server_shard, [shard + (seed, region_ids, region_p, run) for shard in pending], workers
+        ))
+        print(f'Inserted {total} sales records across {len(pending)} shards')
+        return
+
+    # Preload all dimensions (keys, prices, customer risk profiles) once
+    if workers <= 1:
+        cache = cache or DimensionCache(sink).load()
+
+    shards = [
+        (shard_index, first_sale_id, count, batch_size, engine, seed, pipeline, run)
+        for shard_index, first_sale_id, count in pending
+    ]
+    total = sum(run_shards(_fact_sales_shard, shards, workers, cache))
+    print(f'Inserted {total} sales records across {len(shards)} shards')
+
+    if cache is not None:
+        print(cache.report())
+
+# Penalty as a fraction of the EMI per payment status
+PAYMENT_PENALTY_RATES = {'Paid': 0, 'Bounced': 0.02, 'Partial': 0.01, 'Overdue': 0.05, 'Defaulted': 0.05}
+
+REPAYMENT_LOANS_QUERY = '''
+    SELECT loan_id, customer_id, loan_amount, interest_rate, term_months, start_date, loan_status, risk_rating
+    FROM Dim_Loan
+    WHERE loan_status IN ('Active', 'Delinquent', 'Defaulted')
+      AND loan_id BETWEEN %(first_id)s AND %(last_id)s
+    ORDER BY loan_id
+'''
+
+# Installments already due per loan_id shard, used to give every shard its first repayment_id
+REPAYMENT_SHARDS_QUERY = '''
+    SELECT intDiv(loan_id - 1, %(shard_size)s) AS shard,
+           sum(least(term_months, greatest(0, intDiv(dateDiff('day', start_date, toDate(%(today)s)), 30)))) AS installments
+    FROM Dim_Loan
+    WHERE loan_status IN ('Active', 'Delinquent', 'Defaulted')
+      AND loan_id >= %(first_id)s
+    GROUP BY shard
+    ORDER BY shard
+'''
+
+FACT_LOAN_REPAYMENT_COLUMNS = [
+    'repayment_id', 'loan_id', 'customer_id', 'emi_number', 'due_date', 'payment_date', 'emi_amount',
+    'principal_amount', 'interest_amount', 'penalties', 'payment_status', 'payment_mode',
+    'pending_principal', 'pending_interest', 'days_overdue', 'bounce_reason', 'collection_agent_id'
+]
+
+def payment_status_condition(loan_status, risk_rating):
+    # Key into the 'payment_status' distribution; Active loans depend on risk_rating ('Low' is the fallback)
+    if loan_status == 'Active':
+        return ('Active', risk_rating if ('Active', risk_rating) in distribution('payment_status').choices else 'Low')
+    if loan_status == 'Delinquent':
+        return ('Delinquent', None)
+    return ('Defaulted', None)
+
+def batched(rows, batch_size):
+    # Group any row iterable into lists of at most batch_size rows
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def stream_query(query, params=None, block_size=10000):
+    # execute_iter keeps its connection busy until exhausted, so streaming
+    # reads hold their own pooled connection while inserts use others
+    with ch_pool.connection() as reader:
+        yield from reader.execute_iter(query, params, settings={'max_block_size': block_size})
+
+def _loan_repayment_rows(loan, repayment_ids, today):
+    loan_id, customer_id, loan_amount, interest_rate, term_months, start_date, loan_status, risk_rating = loan
+
+    # Calculate EMI
+    monthly_rate = interest_rate / (12 * 100)
+    emi_amount = round((loan_amount * monthly_rate * (1 + monthly_rate)**term_months) / ((1 + monthly_rate)**term_months - 1), 2)
+
+    outstanding_principal = loan_amount
+    payment_statuses = distribution('payment_status')[payment_status_condition(loan_status, risk_rating)]
+
+    # Installments are due every 30 days; future EMIs are skipped. Due and payment
+    # dates are built as datetime64 day offsets once the loan's rows are drawn.
+    due_count = min(term_months, max(0, (today - start_date).days // 30))
+    due_dates = np.datetime64(start_date, 'D') + 30 * np.arange(1, due_count + 1)
+    payment_delays = []
+    rows = []
+
+    for emi_number in range(1, due_count + 1):
+        interest_amount = round(outstanding_principal * monthly_rate, 2)
+        principal_amount = round(min(emi_amount - interest_amount, outstanding_principal), 2)
+
+        # Determine payment status and date based on loan status and risk
+        payment_status = payment_statuses.draw()
+
+        payment_delay = 0
+        penalties = 0
+        days_overdue = 0
+        bounce_reason = None
+        collection_agent_id = None
+
+        if payment_status == 'Paid':
+            payment_delay = random.randint(-5, 2)
+            pending_principal = pending_interest = 0
+        elif payment_status == 'Bounced':
+            payment_delay = random.randint(1, 5)
+            bounce_reason = distribution('bounce_reason').draw()
+            penalties = round(emi_amount * 0.02, 2)  # 2% penalty
+            pending_principal = principal_amount
+            pending_interest = interest_amount
+        elif payment_status == 'Partial':
+            payment_delay = random.randint(1, 10)
+            partial_percent = random.uniform(0.4, 0.8)
+            pending_principal = round(principal_amount * (1 - partial_percent), 2)
+            pending_interest = round(interest_amount * (1 - partial_percent), 2)
+            penalties = round(emi_amount * 0.01, 2)  # 1% penalty
+        else:  # Overdue or Defaulted
+            days_overdue = random.randint(30, 180)
+            penalties = round(emi_amount * 0.05, 2)  # 5% penalty
+            pending_principal = principal_amount
+            pending_interest = interest_amount
+            collection_agent_id = random.randint(1, 50) if random.random() < 0.7 else None
+
+        # Ensure string fields are not None
+        payment_mode = distribution('payment_mode').draw() if payment_status in ['Paid', 'Partial'] else ''
+        bounce_reason = bounce_reason if bounce_reason is not None else ''
+
+        payment_delays.append(payment_delay)
+        rows.append((
+            emi_number, emi_amount, principal_amount, interest_amount, penalties, payment_status, payment_mode,
+            pending_principal, pending_interest, days_overdue, bounce_reason, collection_agent_id
+        ))
+
+        if payment_status in ['Paid', 'Partial']:
+            outstanding_principal -= (principal_amount - pending_principal)
+
+    payment_dates = (due_dates + np.array(payment_delays, dtype=np.int64)).astype(object).tolist()
+    for row, due_date, payment_date in zip(rows, due_dates.astype(object).tolist(), payment_dates):
+        # Row tuples follow FACT_LOAN_REPAYMENT_COLUMNS; overdue and defaulted EMIs have no payment date
+        emi_number, payment_status = row[0], row[5]
+        if payment_status not in ['Paid', 'Bounced', 'Partial']:
             payment_date = None
-            penalties = 0
-            days_overdue = 0
-            bounce_reason = None
-            collection_agent_id = None
-
-            if payment_status == 'Paid':
-                payment_date = due_date + timedelta(days=random.randint(-5, 2))
-                pending_principal = pending_interest = 0
-            elif payment_status == 'Bounced':
-                payment_date = due_date + timedelta(days=random.randint(1, 5))
-                bounce_reason = random.choice(bounce_reasons)
-                penalties = round(emi_amount * 0.02, 2)  # 2% penalty
-                pending_principal = principal_amount
-                pending_interest = interest_amount
-            elif payment_status == 'Partial':
-                payment_date = due_date + timedelta(days=random.randint(1, 10))
-                partial_percent = random.uniform(0.4, 0.8)
-                pending_principal = round(principal_amount * (1 - partial_percent), 2)
-                pending_interest = round(interest_amount * (1 - partial_percent), 2)
-                penalties = round(emi_amount * 0.01, 2)  # 1% penalty
-            else:  # Overdue or Defaulted
-                days_overdue = random.randint(30, 180)
-                penalties = round(emi_amount * 0.05, 2)  # 5% penalty
-                pending_principal = principal_amount
-                pending_interest = interest_amount
-                collection_agent_id = random.randint(1, 50) if random.random() < 0.7 else None
-
-            # Ensure string fields are not None
-            payment_mode = random.choice(payment_modes) if payment_status in ['Paid', 'Partial'] else ''
-            bounce_reason = bounce_reason if bounce_reason is not None else ''
-
-            repayments.append({
-                'repayment_id': repayment_id,
-                'loan_id': loan_id,
-                'customer_id': customer_id,
-                'emi_number': emi_number,
-                'due_date': due_date,
-                'payment_date': payment_date,
-                'emi_amount': emi_amount,
-                'principal_amount': principal_amount,
-                'interest_amount': interest_amount,
-                'penalties': penalties,
-                'payment_status': payment_status,
-                'payment_mode': payment_mode,
-                'pending_principal': pending_principal,
-                'pending_interest': pending_interest,
-                'days_overdue': days_overdue,
-                'bounce_reason': bounce_reason,
-                'collection_agent_id': collection_agent_id
-            })
-
-            repayment_id += 1
-            if payment_status in ['Paid', 'Partial']:
-                outstanding_principal -= (principal_amount - pending_principal)
-
-    # Insert repayments in batches
-    batch_size = 10000
-    for i in range(0, len(repayments), batch_size):
-        batch = repayments[i:i + batch_size]
-        ch_client.execute('INSERT INTO Fact_Loan_Repayment VALUES', batch)
-        print(f'Inserted {len(batch)} repayment records (Total: {i + len(batch)}/{len(repayments)})')
-
-def generate_dim_loan():
-    print("Generating Dim_Loan data...")
-
-    # Fetch all approved sales in one query
-    approved_sales = ch_client.execute('''
-        SELECT fs.sale_id, fs.customer_id, fs.product_id, fs.date_id, dc.risk_profile, fs.channel_id
-        FROM Fact_Sales fs
-        JOIN Dim_Customer dc ON fs.customer_id = dc.customer_id
-        WHERE fs.status = 'Approved'
-    ''')
-
-    # Fetch all product categories in one query
-    product_categories = ch_client.execute('SELECT product_id, category FROM Dim_Product')
-    product_category_map = {row[0]: row[1] for row in product_categories}
-
-    # Fetch all channel names in one query
-    channel_names = ch_client.execute('SELECT channel_id, channel_name FROM Dim_Sales_Channel')
-    channel_name_map = {row[0]: row[1] for row in channel_names}
-
-    dim_loans = []
-    total_sales = len(approved_sales)
-
-    for idx, sale in enumerate(approved_sales):
-        sale_id, customer_id, product_id, date_id, risk_profile, channel_id = sale
-
-        # Get application date
-        app_date = ch_client.execute(
-            'SELECT date FROM Dim_Time WHERE date_id = %(date_id)s',
-            {'date_id': date_id}
-        )[0][0]
+        yield (next(repayment_ids), loan_id, customer_id, emi_number, due_date, payment_date) + row[1:]
+
+def _amortize_term_group(rng, principal, monthly_rate, emi, status_conditions, due_count):
+    # Schedule for loans sharing one term: rows are loans, columns are installments.
+    # Payment outcomes are sampled for the whole matrix up front; the balance
+    # then advances one installment at a time across every loan in the group.
+    size = len(principal)
+    width = int(due_count.max())
+    payment_statuses = distribution('payment_status')
+    status = payment_statuses.indices(rng, status_conditions, (size, width))
+    partial_percent = rng.uniform(0.4, 0.8, (size, width))
+
+    is_paid = status == payment_statuses.values.index('Paid')
+    is_partial = status == payment_statuses.values.index('Partial')
+
+    interest = np.empty((size, width))
+    principal_due = np.empty((size, width))
+    pending_principal = np.empty((size, width))
+    outstanding = principal.copy()
+    for k in range(width):
+        interest[:, k] = np.round(outstanding * monthly_rate, 2)
+        principal_due[:, k] = np.round(np.minimum(emi - interest[:, k], outstanding), 2)
+        pending_principal[:, k] = np.where(
+            is_paid[:, k], 0.0,
+            np.where(is_partial[:, k], np.round(principal_due[:, k] * (1 - partial_percent[:, k]), 2), principal_due[:, k])
+        )
+        repaid = np.where(is_paid[:, k] | is_partial[:, k], principal_due[:, k] - pending_principal[:, k], 0.0)
+        outstanding = outstanding - repaid
+
+    pending_interest = np.where(
+        is_paid, 0.0,
+        np.where(is_partial, np.round(interest * (1 - partial_percent), 2), interest)
+    )
+    valid = np.arange(width)[None, :] < due_count[:, None]
+    return status, interest, principal_due, pending_principal, pending_interest, valid
+
+def _repayment_batch_numpy(rng, loans, first_repayment_id, today):
+    loan_ids, customer_ids, loan_amounts, interest_rates, terms, start_dates, loan_statuses, risk_ratings = zip(*loans)
+    loan_ids = np.array(loan_ids, dtype=np.int32)
+    customer_ids = np.array(customer_ids, dtype=np.int32)
+    principal = np.array(loan_amounts, dtype=np.float64)
+    terms = np.array(terms, dtype=np.int32)
+    start_dates = np.array(start_dates, dtype='datetime64[D]')
+
+    # EMI formula for every loan at once
+    monthly_rate = np.array(interest_rates, dtype=np.float64) / (12 * 100)
+    growth = (1 + monthly_rate) ** terms
+    emi = np.round(principal * monthly_rate * growth / (growth - 1), 2)
+
+    # Installments are due every 30 days; future EMIs are skipped
+    elapsed = (today - start_dates).astype(np.int64)
+    due_count = np.clip(elapsed // 30, 0, terms)
+    offsets = np.concatenate(([0], np.cumsum(due_count)[:-1]))
+    total = int(due_count.sum())
+
+    payment_statuses = distribution('payment_status')
+    status_conditions = payment_statuses.condition_indices(
+        [payment_status_condition(status, risk) for status, risk in zip(loan_statuses, risk_ratings)]
+    )
+
+    row_loan = np.empty(total, dtype=np.int64)
+    emi_number = np.empty(total, dtype=np.int32)
+    status = np.empty(total, dtype=np.int8)
+    interest = np.empty(total)
+    principal_due = np.empty(total)
+    pending_principal = np.empty(total)
+    pending_interest = np.empty(total)
+
+    for term in np.unique(terms[due_count > 0]):
+        group = np.flatnonzero((terms == term) & (due_count > 0))
+        group_status, group_interest, group_principal, group_pending_principal, group_pending_interest, valid = _amortize_term_group(
+            rng, principal[group], monthly_rate[group], emi[group], status_conditions[group], due_count[group]
+        )
+        rows, installments = np.nonzero(valid)
+        target = offsets[group][rows] + installments
+        row_loan[target] = group[rows]
+        emi_number[target] = installments + 1
+        status[target] = group_status[rows, installments]
+        interest[target] = group_interest[rows, installments]
+        principal_due[target] = group_principal[rows, installments]
+        pending_principal[target] = group_pending_principal[rows, installments]
+        pending_interest[target] = group_pending_interest[rows, installments]
+
+    # Dates, penalties and collection details as masked column operations
+    due_date = start_dates[row_loan] + (emi_number * 30).astype('timedelta64[D]')
+    is_paid = status == payment_statuses.values.index('Paid')
+    is_bounced = status == payment_statuses.values.index('Bounced')
+    is_partial = status == payment_statuses.values.index('Partial')
+    is_overdue = ~(is_paid | is_bounced | is_partial)
+
+    delay = np.select(
+        [is_paid, is_bounced, is_partial],
+        [rng.integers(-5, 3, total), rng.integers(1, 6, total), rng.integers(1, 11, total)],
+        0
+    )
+    payment_date = np.where(is_overdue, None, (due_date + delay.astype('timedelta64[D]')).astype(object))
+
+    emi_amount = emi[row_loan]
+    penalty_rates = np.array([PAYMENT_PENALTY_RATES[name] for name in payment_statuses.values])
+    penalties = np.round(emi_amount * penalty_rates[status], 2)
+    days_overdue = np.where(is_overdue, rng.integers(30, 181, total), 0)
+    has_agent = is_overdue & (rng.random(total) < 0.7)
+    collection_agent_id = np.where(has_agent, rng.integers(1, 51, total), None)
+
+    payment_mode = np.where(is_paid | is_partial, distribution('payment_mode').sample(rng, total), '')
+    bounce_reason = np.where(is_bounced, distribution('bounce_reason').sample(rng, total), '')
+
+    return {
+        'repayment_id': np.arange(first_repayment_id, first_repayment_id + total, dtype=np.int32),
+        'loan_id': loan_ids[row_loan],
+        'customer_id': customer_ids[row_loan],
+        'emi_number': emi_number,
+        'due_date': due_date,
+        'payment_date': payment_date,
+        'emi_amount': emi_amount,
+        'principal_amount': principal_due,
+        'interest_amount': interest,
+        'penalties': penalties,
+        'payment_status': payment_statuses.array[status],
+        'payment_mode': payment_mode,
+        'pending_principal': pending_principal,
+        'pending_interest': pending_interest,
+        'days_overdue': days_overdue,
+        'bounce_reason': bounce_reason,
+        'collection_agent_id': collection_agent_id
+    }
 
-        # Determine interest rate based on risk
-        if risk_profile == 'Low':
-            interest_rate = round(random.uniform(3.0, 5.0), 1)
-        elif risk_profile == 'Medium':
-            interest_rate = round(random.uniform(5.1, 8.0), 1)
+def _repayment_shard(shard_index, first_loan_id, last_loan_id, first_repayment_id, batch_size, engine, seed,
+                     loans_per_chunk, today, pipeline, run, cache=None):
+    rng = shard_rng(seed, 'Fact_Loan_Repayment', shard_index)
+
+    # Continue after the last loan of the last committed resume point
+    batch_index, total = 0, 0
+    checkpoint = run.progress.get(shard_index)
+    if checkpoint:
+        _restore_rng(rng, checkpoint['state'])
+        batch_index, total = checkpoint['batch'] + 1, checkpoint['rows']
+        first_loan_id = checkpoint['watermark'] + 1
+
+    # Stream this shard's loans and flush repayments as soon as a batch
+    # fills, so memory stays flat regardless of the size of Dim_Loan
+    loans = itertools.chain.from_iterable(sink.stream(
+        REPAYMENT_LOANS_QUERY, batch_size, {'first_id': first_loan_id, 'last_id': last_loan_id}
+    ))
+
+    with open_writer(pipeline, run.run_id) as writer:
+        if engine == 'numpy':
+            for chunk in batched(loans, loans_per_chunk):
+                columns = _repayment_batch_numpy(
+                    rng, chunk, first_repayment_id + total, np.datetime64(today, 'D')
+                )
+                chunk_rows = len(columns['repayment_id'])
+                # Only the chunk's last batch is a resume point: the RNG state is per chunk
+                for i in range(0, chunk_rows, batch_size):
+                    rows = min(batch_size, chunk_rows - i)
+                    last_batch = i + rows == chunk_rows
+                    writer.write(
+                        'Fact_Loan_Repayment',
+                        {name: values[i:i + batch_size] for name, values in columns.items()},
+                        use_numpy=USE_NUMPY_INSERTS,
+                        on_commit=run.checkpoint(
+                            shard_index, batch_index, chunk[-1][0], first_repayment_id + total + rows,
+                            total + rows, rng if last_batch else None
+                        )
+                    )
+                    batch_index += 1
+                    total += rows
+                    print(f'Inserted {rows} repayment records (Shard {shard_index}: {total})')
         else:
-            interest_rate = round(random.uniform(8.1, 15.0), 1)
-
-        # Loan details
-        loan_amount = round(random.uniform(1000, 500000), 2)
-        term = random.choice([12, 24, 36, 60, 84, 120, 180, 240, 360])
-        start_date = app_date
-        end_date = start_date + timedelta(days=term * 30)
-
-        # Loan status with realistic distribution
-        status = random.choices(
-            ['Active', 'Closed', 'Defaulted', 'Delinquent'],
-            weights=[0.7, 0.2, 0.05, 0.05]
-        )[0]
-
-        # Get product category for loan type
-        product_category = product_category_map.get(product_id, 'Personal Loan')
-
-        # Application channel
-        channel_name = channel_name_map.get(channel_id, 'Unknown')
-
-        # Calculate last_payment_date and next_payment_due_date
-        last_payment_date = None
-        next_payment_due_date = None
-
-        if status in ['Active', 'Delinquent']:
-            # Ensure end_date is in the future
-            if end_date > datetime.now().date():
-                last_payment_date = fake.date_between(start_date=start_date, end_date='today')
-                next_payment_due_date = fake.date_between(start_date='today', end_date=end_date)
-            else:
-                # If end_date is in the past, set status to 'Closed'
-                status = 'Closed'
-
-        dim_loans.append({
-            'loan_id': idx + 1,
-            'customer_id': customer_id,
-            'loan_amount': loan_amount,
-            'interest_rate': interest_rate,
-            'term_months': term,
-            'start_date': start_date,
-            'end_date': end_date,
-            'loan_status': status,
-            'loan_type': product_category,
-            'risk_rating': risk_profile,
-            'collateral_value': round(loan_amount * random.uniform(0.8, 1.5), 2) if product_category in ['Mortgage', 'Auto Loan'] else 0.0,
-            'application_channel': channel_name,
-            'application_date': start_date,
-            'last_payment_date': last_payment_date,
-            'next_payment_due_date': next_payment_due_date,
-            'outstanding_balance': 0.0 if status == 'Closed' else round(loan_amount * random.uniform(0.1, 0.9), 2)
-        })
-
-        # Print progress every 1000 records
-        if (idx + 1) % 1000 == 0:
-            print(f"Processed {idx + 1}/{total_sales} sales...")
+            repayment_ids = itertools.count(first_repayment_id + total)
+
+            # Batches end on loan boundaries, so each one is a resume point
+            batch = []
+            for loan in loans:
+                batch.extend(_loan_repayment_rows(loan, repayment_ids, today))
+                if len(batch) >= batch_size:
+                    total += len(batch)
+                    writer.write(
+                        'Fact_Loan_Repayment', columns_from_rows(FACT_LOAN_REPAYMENT_COLUMNS, batch),
+                        on_commit=run.checkpoint(
+                            shard_index, batch_index, loan[0], first_repayment_id + total, total, rng
+                        )
+                    )
+                    batch_index += 1
+                    print(f'Inserted {len(batch)} repayment records (Shard {shard_index}: {total})')
+                    batch = []
+            if batch:
+                writer.write('Fact_Loan_Repayment', columns_from_rows(FACT_LOAN_REPAYMENT_COLUMNS, batch))
+                total += len(batch)
+                print(f'Inserted {len(batch)} repayment records (Shard {shard_index}: {total})')
+
+    run.finish_shard(shard_index, batch_index, total)
+    print(writer.report(f'Fact_Loan_Repayment shard {shard_index}'))
+    return total - (checkpoint['rows'] if checkpoint else 0)
+
+@measured_stage
+def generate_loan_repayments(batch_size=10000, engine='python', seed=None, loans_per_chunk=1000,
+                             workers=1, shard_size=DEFAULT_SHARD_SIZE, pipeline=None, resume=False, append=False,
+                             as_of=None):
+    # engine='numpy' builds whole amortization schedules for loans_per_chunk loans at a time.
+    # workers > 1 generates loan_id shards on a process pool.
+    # resume=True continues the last run; append=True only covers loans after the last one with repayments.
+    # Installments are generated up to the as-of date (see resolve_as_of).
+    if engine not in ('python', 'numpy'):
+        raise ValueError(f"Unknown Fact_Loan_Repayment engine: {engine}")
 
-    # Insert loans in batches
-    batch_size = 10000
-    for i in range(0, len(dim_loans), batch_size):
-        batch = dim_loans[i:i + batch_size]
-        ch_client.execute('INSERT INTO Dim_Loan VALUES', batch)
-        print(f"Inserted {len(batch)} loan records (Total: {i + len(batch)}/{len(dim_loans)})")
+    print("Generating loan repayment data...")
+    if resume:
+        run = StageRun.resume('Fact_Loan_Repayment')
+    else:
+        run = StageRun.start(
+            'Fact_Loan_Repayment', batch_size=batch_size, engine=engine, seed=resolve_seed(seed),
+            loans_per_chunk=loans_per_chunk, shard_size=shard_size, today=resolve_as_of(as_of).isoformat(),
+            first_loan_id=next_id('Fact_Loan_Repayment', 'loan_id') if append else 1,
+            first_repayment_id=next_id('Fact_Loan_Repayment', 'repayment_id') if append else 1
+        )
+    batch_size, engine, seed, loans_per_chunk, shard_size, today, first_loan_id, first_repayment_id = run.get(
+        'batch_size', 'engine', 'seed', 'loans_per_chunk', 'shard_size', 'today', 'first_loan_id',
+        'first_repayment_id'
+    )
+    today = datetime.fromisoformat(today).date()
+
+    # The number of due installments per loan is known up front, so every
+    # shard can start at its final repayment_id without waiting for the others
+    shards = []
+    for shard_index, installments in sink.execute(
+        REPAYMENT_SHARDS_QUERY, {'shard_size': shard_size, 'today': today, 'first_id': first_loan_id}
+    ):
+        if run.progress.get(shard_index) != 'done':
+            shards.append((
+                shard_index, max(shard_index * shard_size + 1, first_loan_id), (shard_index + 1) * shard_size,
+                first_repayment_id, batch_size, engine, seed, loans_per_chunk, today, pipeline, run
+            ))
+        first_repayment_id += installments
+
+    total = sum(run_shards(_repayment_shard, shards, workers))
+    print(f'Inserted {total} repayment records across {len(shards)} shards')
+
+# Interest rate range per risk_profile; anything unrecognised is priced as 'High'
+INTEREST_RATE_RANGES = {'Low': (3.0, 5.0), 'Medium': (5.1, 8.0), 'High': (8.1, 15.0)}
+SECURED_LOAN_TYPES = ['Mortgage', 'Auto Loan']
+
+DIM_LOAN_COLUMNS = [
+    'loan_id', 'customer_id', 'loan_amount', 'interest_rate', 'term_months', 'start_date', 'end_date',
+    'loan_status', 'loan_type', 'risk_rating', 'collateral_value', 'application_channel',
+    'application_date', 'last_payment_date', 'next_payment_due_date', 'outstanding_balance'
+]
+
+APPROVED_SALES_QUERY = '''
+    SELECT fs.sale_id, fs.customer_id, fs.product_id, dt.date, dc.risk_profile, fs.channel_id
+    FROM Fact_Sales fs
+    JOIN Dim_Customer dc ON fs.customer_id = dc.customer_id
+    JOIN Dim_Time dt ON fs.date_id = dt.date_id
+    WHERE fs.status = 'Approved'
+      AND fs.sale_id BETWEEN %(first_id)s AND %(last_id)s
+    ORDER BY fs.sale_id
+'''
+
+# Approved sales per sale_id shard, used to give every shard its first loan_id
+APPROVED_SALES_SHARDS_QUERY = '''
+    SELECT intDiv(sale_id - 1, %(shard_size)s) AS shard, count() AS approved
+    FROM Fact_Sales
+    WHERE status = 'Approved'
+      AND sale_id >= %(first_id)s
+    GROUP BY shard
+    ORDER BY shard
+'''
+
+# sale_id of the approved sale behind the last existing loan (0 without loans), for append runs
+LOAN_SALES_WATERMARK_QUERY = '''
+    SELECT max(sale_id) FROM (
+        SELECT sale_id FROM Fact_Sales WHERE status = 'Approved' ORDER BY sale_id LIMIT %(loans)s
+    )
+'''
+
+def _random_days_between(rng, start, end):
+    # Uniform date in [start, end] (inclusive), like fake.date_between
+    span = (end - start).astype(np.int64)
+    return start + np.floor(rng.random(len(start)) * (np.maximum(span, 0) + 1)).astype('timedelta64[D]')
+
+def _dim_loan_batch(rng, cache, first_loan_id, sales, today):
+    sale_ids, customer_ids, product_ids, app_dates, risk_profiles, channel_ids = zip(*sales)
+    size = len(sale_ids)
+    customer_ids = np.array(customer_ids, dtype=np.int32)
+    risk_profiles = np.array(risk_profiles, dtype=object)
+    start_date = np.array(app_dates, dtype='datetime64[D]')
+    today = np.datetime64(today, 'D')
+
+    # Determine interest rate based on risk
+    rate_low = np.full(size, INTEREST_RATE_RANGES['High'][0])
+    rate_high = np.full(size, INTEREST_RATE_RANGES['High'][1])
+    for risk_profile in ('Low', 'Medium'):
+        mask = risk_profiles == risk_profile
+        rate_low[mask], rate_high[mask] = INTEREST_RATE_RANGES[risk_profile]
+    interest_rate = np.round(rng.uniform(rate_low, rate_high), 1)
+
+    # Loan details
+    loan_amount = np.round(rng.uniform(1000, 500000, size), 2)
+    term = distribution('loan_term').sample(rng, size).astype(np.int32)
+    end_date = start_date + (term * 30).astype('timedelta64[D]')
+
+    # Loan status with realistic distribution
+    status = distribution('loan_status').sample(rng, size)
+
+    loan_type = cache.take('Dim_Product', 'category', product_ids, 'Personal Loan')
+    channel_name = cache.take('Dim_Sales_Channel', 'channel_name', channel_ids, 'Unknown')
+
+    # Open loans get payment dates around today; open loans past their end date are closed
+    is_open = (status == 'Active') | (status == 'Delinquent')
+    has_schedule = is_open & (end_date > today)
+    status[is_open & ~has_schedule] = 'Closed'
+    last_payment_date = _random_days_between(rng, start_date, np.full(size, today))
+    next_payment_due_date = _random_days_between(rng, np.full(size, today), end_date)
+
+    is_secured = np.isin(loan_type, SECURED_LOAN_TYPES)
+    collateral_value = np.where(is_secured, np.round(loan_amount * rng.uniform(0.8, 1.5, size), 2), 0.0)
+    outstanding_balance = np.where(status == 'Closed', 0.0, np.round(loan_amount * rng.uniform(0.1, 0.9, size), 2))
+
+    return {
+        'loan_id': np.arange(first_loan_id, first_loan_id + size, dtype=np.int32),
+        'customer_id': customer_ids,
+        'loan_amount': loan_amount,
+        'interest_rate': interest_rate,
+        'term_months': term,
+        'start_date': start_date,
+        'end_date': end_date,
+        'loan_status': status,
+        'loan_type': loan_type,
+        'risk_rating': risk_profiles,
+        'collateral_value': collateral_value,
+        'application_channel': channel_name,
+        'application_date': start_date,
+        'last_payment_date': np.where(has_schedule, last_payment_date.astype(object), None),
+        'next_payment_due_date': np.where(has_schedule, next_payment_due_date.astype(object), None),
+        'outstanding_balance': outstanding_balance
+    }
 
-    print(f"Inserted {len(dim_loans)} loan records.")
+def _dim_loan_shard(shard_index, first_sale_id, last_sale_id, first_loan_id, batch_size, seed, today, pipeline,
+                    run, cache=None):
+    cache = cache or worker_cache()
+    rng = shard_rng(seed, 'Dim_Loan', shard_index)
+
+    # Continue after the last sale of the last committed batch
+    batch_index, total = 0, 0
+    checkpoint = run.progress.get(shard_index)
+    if checkpoint:
+        _restore_rng(rng, checkpoint['state'])
+        batch_index, total = checkpoint['batch'] + 1, checkpoint['rows']
+        first_sale_id = checkpoint['watermark'] + 1
+
+    # Approved sales arrive with their application date from the JOIN on
+    # Dim_Time; product categories and channel names come from the cache
+    approved_sales = itertools.chain.from_iterable(sink.stream(
+        APPROVED_SALES_QUERY, batch_size, {'first_id': first_sale_id, 'last_id': last_sale_id}
+    ))
+
+    with open_writer(pipeline, run.run_id) as writer:
+        for sales in batched(approved_sales, batch_size):
+            columns = _dim_loan_batch(rng, cache, first_loan_id + total, sales, today)
+            total += len(sales)
+            writer.write(
+                'Dim_Loan', columns, use_numpy=USE_NUMPY_INSERTS,
+                on_commit=run.checkpoint(shard_index, batch_index, sales[-1][0], first_loan_id + total, total, rng)
+            )
+            batch_index += 1
+            print(f"Inserted {len(sales)} loan records (Shard {shard_index}: {total})")
+
+    run.finish_shard(shard_index, batch_index, total)
+    print(writer.report(f'Dim_Loan shard {shard_index}'))
+    return total - (checkpoint['rows'] if checkpoint else 0)
+
+def _dim_loan_server_query():
+    def u(draw, low=0.0, high=1.0):
+        return _sql_uniform(draw, 'loan_id', low, high)
+
+    def days_between(draw, start, end):
+        # Uniform date in [start, end] (inclusive), like _random_days_between
+        return f"addDays({start}, toInt32(floor({u(draw)} * (greatest(dateDiff('day', {start}, {end}), 0) + 1))))"
+
+    rate_low = _sql_by_risk('risk_rating', {r: low for r, (low, high) in INTEREST_RATE_RANGES.items()}, 'High')
+    rate_high = _sql_by_risk('risk_rating', {r: high for r, (low, high) in INTEREST_RATE_RANGES.items()}, 'High')
+    terms, statuses = distribution('loan_term'), distribution('loan_status')
+    columns = ', '.join(DIM_LOAN_COLUMNS)
+    secured = ', '.join(f"'{loan_type}'" for loan_type in SECURED_LOAN_TYPES)
+
+    return f'''
+        INSERT INTO Dim_Loan ({columns})
+        SELECT {columns}
+        FROM (
+            SELECT
+                loan_id, customer_id, risk_rating, start_date,
+                start_date AS application_date,
+                round({u('loan_amount', 1000, 500000)}, 2) AS loan_amount,
+                round({u('interest_rate', rate_low, rate_high)}, 1) AS interest_rate,
+                toInt32({_sql_weighted_pick('term_months', 'loan_id', terms.values, terms.weights)}) AS term_months,
+                addDays(start_date, term_months * 30) AS end_date,
+                {_sql_choice('loan_status', 'loan_id', statuses.values, statuses.weights)} AS drawn_status,
+                -- Open loans get payment dates around today; open loans past their end date are closed
+                drawn_status IN ('Active', 'Delinquent') AND end_date > toDate(%(today)s) AS has_schedule,
+                if(drawn_status IN ('Active', 'Delinquent') AND NOT has_schedule, 'Closed', drawn_status)
+                    AS loan_status,
+                if(dp.category = '', 'Personal Loan', dp.category) AS loan_type,
+                if(sc.channel_name = '', 'Unknown', sc.channel_name) AS application_channel,
+                if(has_schedule, {days_between('last_payment_date', 'start_date', 'toDate(%(today)s)')}, NULL)
+                    AS last_payment_date,
+                if(has_schedule, {days_between('next_payment_due_date', 'toDate(%(today)s)', 'end_date')}, NULL)
+                    AS next_payment_due_date,
+                if(loan_type IN ({secured}), round(loan_amount * {u('collateral_value', 0.8, 1.5)}, 2), 0.)
+                    AS collateral_value,
+                if(loan_status = 'Closed', 0., round(loan_amount * {u('outstanding_balance', 0.1, 0.9)}, 2))
+                    AS outstanding_balance
+            FROM (
+                -- loan_id follows sale_id order, continuing from the shard's first loan_id
+                SELECT
+                    toInt32(%(first_loan_id)s - 1 + row_number() OVER (ORDER BY fs.sale_id)) AS loan_id,
+                    fs.customer_id AS customer_id, fs.product_id AS product_id, fs.channel_id AS channel_id,
+                    dt.date AS start_date, dc.risk_profile AS risk_rating
+                FROM Fact_Sales fs
+                JOIN Dim_Customer dc ON fs.customer_id = dc.customer_id
+                JOIN Dim_Time dt ON fs.date_id = dt.date_id
+                WHERE fs.status = 'Approved'
+                  AND fs.sale_id BETWEEN %(first_id)s AND %(last_id)s
+            ) AS loans
+            LEFT JOIN Dim_Product AS dp ON loans.product_id = dp.product_id
+            LEFT JOIN Dim_Sales_Channel AS sc ON loans.channel_id = sc.channel_id
+        )
+    '''
+
+def _dim_loan_server_shard(shard_index, first_sale_id, last_sale_id, first_loan_id, approved, seed, today, run,
+                           cache=None):
+    started = time.perf_counter()
+    if run.resumed:
+        # The shard may have been inserted in part before the run stopped
+        ch_pool.execute(
+            'DELETE FROM Dim_Loan WHERE loan_id BETWEEN %(first_id)s AND %(last_id)s',
+            {'first_id': first_loan_id, 'last_id': first_loan_id + approved - 1}
+        )
+    ch_pool.execute(_dim_loan_server_query(), {
+        'first_id': first_sale_id, 'last_id': last_sale_id, 'first_loan_id': first_loan_id,
+        'seed': seed, 'today': today
+    })
+    metrics.add(rows=approved)
+    run.finish_shard(shard_index, 0, approved)
+    print(f"Inserted loans for sales {first_sale_id}-{last_sale_id} server-side (Shard {shard_index}) "
+          f"in {time.perf_counter() - started:.1f}s")
+
+@measured_stage
+def generate_dim_loan(cache=None, batch_size=10000, seed=None, workers=1, shard_size=DEFAULT_SHARD_SIZE,
+                      pipeline=None, engine='numpy', resume=False, append=False, as_of=None):
+    # workers > 1 derives loans for sale_id shards on a process pool;
+    # engine='server' derives each shard inside ClickHouse with a single INSERT ... SELECT.
+    # resume=True continues the last run; append=True only covers approved sales without a loan yet.
+    # Loan statuses and payment dates are relative to the as-of date (see resolve_as_of).
+    if engine not in ('numpy', 'server'):
+        raise ValueError(f"Unknown Dim_Loan engine: {engine}")
+    if engine == 'server' and not isinstance(sink, ClickHouseSink):
+        raise ValueError("engine='server' generates inside ClickHouse and needs the ClickHouse sink")
 
+    print("Generating Dim_Loan data...")
+    if resume:
+        run = StageRun.resume('Dim_Loan')
+    else:
+        first_sale_id, first_loan_id = 1, 1
+        if append:
+            # Loans map one-to-one onto approved sales in sale_id order
+            first_loan_id = next_id('Dim_Loan', 'loan_id')
+            first_sale_id = sink.execute(LOAN_SALES_WATERMARK_QUERY, {'loans': first_loan_id - 1})[0][0] + 1
+        run = StageRun.start(
+            'Dim_Loan', batch_size=batch_size, engine=engine, seed=resolve_seed(seed), shard_size=shard_size,
+            today=resolve_as_of(as_of).isoformat(), first_sale_id=first_sale_id, first_loan_id=first_loan_id
+        )
+    batch_size, engine, seed, shard_size, today, first_sale_id, first_loan_id = run.get(
+        'batch_size', 'engine', 'seed', 'shard_size', 'today', 'first_sale_id', 'first_loan_id'
+    )
+    today = datetime.fromisoformat(today).date()
+
+    if workers <= 1 and engine != 'server':
+        cache = cache or DimensionCache(sink).load()
+
+    # loan_id follows sale_id order, so each shard starts after the approved sales of earlier shards
+    shards = []
+    for shard_index, approved in sink.execute(
+        APPROVED_SALES_SHARDS_QUERY, {'shard_size': shard_size, 'first_id': first_sale_id}
+    ):
+        if run.progress.get(shard_index) != 'done':
+            shards.append((
+                shard_index, max(shard_index * shard_size + 1, first_sale_id), (shard_index + 1) * shard_size,
+                first_loan_id, approved
+            ))
+        first_loan_id += approved
+
+    if engine == 'server':
+        run_shards(_dim_loan_server_shard, [shard + (seed, today, run) for shard in shards], workers)
+        print(f"Inserted {sum(shard[4] for shard in shards)} loan records across {len(shards)} shards.")
+        return
+
+    shards = [shard[:4] + (batch_size, seed, today, pipeline, run) for shard in shards]
+
+    total = sum(run_shards(_dim_loan_shard, shards, workers, cache))
+    print(f"Inserted {total} loan records.")
+
+    if cache is not None:
+        print(cache.report())
+
+@measured_stage
 def alter_regions():
     # Drop the table before inserting new data
-    ch_client.execute('DROP TABLE IF EXISTS Dim_Region')
+    ch_pool.execute('DROP TABLE IF EXISTS Dim_Region')
     print("Dropping tables")
 
     # Recreate the table with branch column
-    ch_client.execute('''
+    ch_pool.execute('''
         CREATE TABLE Dim_Region (
             region_id UInt32,
             region_name String,
@@ -595,32 +3311,11 @@ def alter_regions():
         ORDER BY region_id
     ''')
 
-    # List of regions and branches from the image with their coordinates
-    regions_data = [
-        {"region": "Central", "branch": "Main Branch", "latitude": 1.2789, "longitude": 103.8536},
-        {"region": "North", "branch": "Ang Mo Kio Ave 1 Branch", "latitude": 1.3700, "longitude": 103.8470},
-        {"region": "Central", "branch": "Balestier Branch", "latitude": 1.3275, "longitude": 103.8452},
-        {"region": "Central", "branch": "Balestier SME Centre", "latitude": 1.3276, "longitude": 103.8453},
-        {"region": "East", "branch": "Bedok Branch", "latitude": 1.3236, "longitude": 103.9273},
-        {"region": "East", "branch": "Bedok SME Centre", "latitude": 1.3237, "longitude": 103.9274},
-        {"region": "West", "branch": "Bukit Batok Central Branch", "latitude": 1.3490, "longitude": 103.7494},
-        {"region": "Central", "branch": "Bukit Merah Branch", "latitude": 1.2819, "longitude": 103.8239},
-        {"region": "Central", "branch": "Bukit Merah SME Centre", "latitude": 1.2820, "longitude": 103.8240},
-        {"region": "East", "branch": "City Plaza Branch", "latitude": 1.3142, "longitude": 103.8933},
-        {"region": "East", "branch": "City Plaza SME Centre", "latitude": 1.3143, "longitude": 103.8934},
-        {"region": "Central", "branch": "City Square Mall Branch", "latitude": 1.3115, "longitude": 103.8559},
-        {"region": "Central", "branch": "City Square Mall SME Centre", "latitude": 1.3116, "longitude": 103.8560},
-        {"region": "West", "branch": "Clementi West Branch", "latitude": 1.3150, "longitude": 103.7650},
-        {"region": "West", "branch": "Clementi West SME Centre", "latitude": 1.3151, "longitude": 103.7651},
-        {"region": "Central", "branch": "Ghim Moh Branch", "latitude": 1.3107, "longitude": 103.7890},
-        {"region": "Central", "branch": "Holland Drive Branch", "latitude": 1.3112, "longitude": 103.7914},
-        {"region": "Central", "branch": "Hong Lim Branch", "latitude": 1.2847, "longitude": 103.8470},
-        {"region": "Central", "branch": "Hong Lim SME Centre", "latitude": 1.2848, "longitude": 103.8471}
-    ]
 
     # Insert data with weighted distribution
+    sales_managers = faker_pool().names(len(BRANCH_REGIONS), faker_rng())
     dim_regions = []
-    for region_id, region in enumerate(regions_data, start=1):
+    for region_id, region in enumerate(BRANCH_REGIONS, start=1):
         dim_regions.append({
             'region_id': region_id,
             'region_name': region['region'],
@@ -628,12 +3323,12 @@ def alter_regions():
             'country': 'Singapore',
             'latitude': float(region['latitude']),
             'longitude': float(region['longitude']),
-            'sales_manager': fake.name()
+            'sales_manager': sales_managers[region_id - 1]
         })
 
     # Insert into ClickHouse
     print("Inserting into CH")
-    ch_client.execute('INSERT INTO Dim_Region VALUES', dim_regions)
+    ch_pool.execute('INSERT INTO Dim_Region VALUES', dim_regions)
 
 # Function to generate random account numbers
 def generate_account_number():
@@ -646,9 +3341,79 @@ def random_amount(min_val, max_val):
 def random_duration(min_years, max_years):
     return random.randint(min_years, max_years)
 
-def alter_customer():
+def rebuild_table(table, replacements):
+    # Rewrite whole columns without a mutation: copy the table into a shadow table
+    # with one INSERT ... SELECT * REPLACE (...), then swap it in with EXCHANGE TABLES.
+    # Unlike ALTER ... UPDATE this is done when it returns and never blocks merges.
+    # ALTER ... UPDATE evaluates every expression against the row as it was, but a
+    # REPLACE alias would stand in for its column inside the other expressions, so
+    # they read the replaced columns under another name from a subquery instead.
+    shadow = f'{table}_rebuild'
+    ch_pool.execute(f'DROP TABLE IF EXISTS {shadow}')
+    ch_pool.execute(f'CREATE TABLE {shadow} AS {table}')
+
+    original = {column: f'_original_{column}' for column in replacements}
+    reference = re.compile(r'\b(' + '|'.join(map(re.escape, replacements)) + r')\b')
+    replace = ',\n'.join(
+        f'{reference.sub(lambda match: original[match.group(1)], expression)} AS {column}'
+        for column, expression in replacements.items()
+    )
+    source = f"SELECT *, {', '.join(f'{column} AS {name}' for column, name in original.items())} FROM {table}"
+    started = time.perf_counter()
+    reported = started
+    with ch_pool.connection() as client:
+        progress = client.execute_with_progress(
+            f"INSERT INTO {shadow} SELECT * EXCEPT ({', '.join(original.values())}) REPLACE ({replace}) "
+            f"FROM ({source})"
+        )
+        for rows, total_rows in progress:
+            now = time.perf_counter()
+            if total_rows and now - reported >= 1:
+                print(f'Rebuilding {table}: {rows}/{total_rows} rows ({rows / total_rows * 100:.0f}%)')
+                reported = now
+        progress.get_result()
+
+    ch_pool.execute(f'EXCHANGE TABLES {table} AND {shadow}')
+    ch_pool.execute(f'DROP TABLE {shadow}')
+    print(f'Rebuilt {table} in {time.perf_counter() - started:.1f}s')
+
+def update_columns(table, assignments, mode='mutation'):
+    # mode='mutation' runs ALTER ... UPDATE and waits for it to finish;
+    # mode='rebuild' goes through rebuild_table instead
+    if mode == 'rebuild':
+        rebuild_table(table, assignments)
+    elif mode == 'mutation':
+        updates = ',\n'.join(f'{column} = {expression}' for column, expression in assignments.items())
+        ch_pool.execute(f'ALTER TABLE {table} UPDATE {updates} WHERE 1 = 1', settings={'mutations_sync': 2})
+    else:
+        raise ValueError(f"Unknown update mode: {mode}")
+
+# Products added to Dim_Customer by alter_customer: column -> value expression
+CUSTOMER_PRODUCT_UPDATES = {
+    'has_fixed_deposit': "IF(risk_profile IN ('Low', 'Medium') AND average_balance > 50000 AND age_group IN ('30-40', '40-50', '50+'), 1, has_fixed_deposit)",
+    'fd_account_number': "IF(has_fixed_deposit = 1, toString(generateUUIDv4()), fd_account_number)",
+    'fd_amount': "IF(has_fixed_deposit = 1, CAST((rand() % 200000 + 50000) AS Float64), fd_amount)",
+    'fd_duration': "IF(has_fixed_deposit = 1, rand() % 5 + 1, fd_duration)",
+    'has_savings_account': "IF(risk_profile IN ('Low', 'Medium', 'High') AND average_balance > 10000, 1, has_savings_account)",
+    'savings_account_number': "IF(has_savings_account = 1, toString(generateUUIDv4()), savings_account_number)",
+    'savings_balance': "IF(has_savings_account = 1, CAST((rand() % 50000 + 10000) AS Float64), savings_balance)",
+    'has_current_account': "IF(is_cash_intensive = 1 OR business_risk_class IN ('Medium', 'High'), 1, has_current_account)",
+    'current_account_number': "IF(has_current_account = 1, toString(generateUUIDv4()), current_account_number)",
+    'current_balance': "IF(has_current_account = 1, CAST((rand() % 100000 + 20000) AS Float64), current_balance)",
+    'has_life_insurance': "IF(risk_profile IN ('Low', 'Medium'), 1, has_life_insurance)",
+    'life_insurance_policy_number': "IF(has_life_insurance = 1, toString(generateUUIDv4()), life_insurance_policy_number)",
+    'life_insurance_amount': "IF(has_life_insurance = 1, CAST((rand() % 500000 + 100000) AS Float64), life_insurance_amount)",
+    'life_insurance_term': "IF(has_life_insurance = 1, rand() % 30 + 10, life_insurance_term)",
+    'has_general_insurance': "IF(business_risk_class IN ('Medium Risk', 'High Risk'), 1, has_general_insurance)",
+    'general_insurance_policy_number': "IF(has_general_insurance = 1, toString(generateUUIDv4()), general_insurance_policy_number)",
+    'general_insurance_coverage': "IF(has_general_insurance = 1, CAST((rand() % 100000 + 20000) AS Float64), general_insurance_coverage)",
+    'general_insurance_term': "IF(has_general_insurance = 1, rand() % 10 + 1, general_insurance_term)"
+}
+
+@measured_stage
+def alter_customer(mode='mutation'):
     print("Adding additional Columns")
-    ch_client.execute('''
+    ch_pool.execute('''
         ALTER TABLE Dim_Customer
         ADD COLUMN IF NOT EXISTS has_fixed_deposit Bool DEFAULT 0,
         ADD COLUMN IF NOT EXISTS fd_account_number Nullable(String),
@@ -669,35 +3434,14 @@ def alter_customer():
         ADD COLUMN IF NOT EXISTS general_insurance_coverage Nullable(Float64),
         ADD COLUMN IF NOT EXISTS general_insurance_term Nullable(Int32)
     ''')
-    print("Assigning values dynamically using ALTER TABLE UPDATE")
-    ch_client.execute('''
-        ALTER TABLE Dim_Customer UPDATE
-            has_fixed_deposit = IF(risk_profile IN ('Low', 'Medium') AND average_balance > 50000 AND age_group IN ('30-40', '40-50', '50+'), 1, has_fixed_deposit),
-            fd_account_number = IF(has_fixed_deposit = 1, toString(generateUUIDv4()), fd_account_number),
-            fd_amount = IF(has_fixed_deposit = 1, CAST((rand() % 200000 + 50000) AS Float64), fd_amount),
-            fd_duration = IF(has_fixed_deposit = 1, rand() % 5 + 1, fd_duration),
-            has_savings_account = IF(risk_profile IN ('Low', 'Medium', 'High') AND average_balance > 10000, 1, has_savings_account),
-            savings_account_number = IF(has_savings_account = 1, toString(generateUUIDv4()), savings_account_number),
-            savings_balance = IF(has_savings_account = 1, CAST((rand() % 50000 + 10000) AS Float64), savings_balance),
-            has_current_account = IF(is_cash_intensive = 1 OR business_risk_class IN ('Medium', 'High'), 1, has_current_account),
-            current_account_number = IF(has_current_account = 1, toString(generateUUIDv4()), current_account_number),
-            current_balance = IF(has_current_account = 1, CAST((rand() % 100000 + 20000) AS Float64), current_balance),
-            has_life_insurance = IF(risk_profile IN ('Low', 'Medium'), 1, has_life_insurance),
-            life_insurance_policy_number = IF(has_life_insurance = 1, toString(generateUUIDv4()), life_insurance_policy_number),
-            life_insurance_amount = IF(has_life_insurance = 1, CAST((rand() % 500000 + 100000) AS Float64), life_insurance_amount),
-            life_insurance_term = IF(has_life_insurance = 1, rand() % 30 + 10, life_insurance_term),
-            has_general_insurance = IF(business_risk_class IN ('Medium Risk', 'High Risk'), 1, has_general_insurance),
-            general_insurance_policy_number = IF(has_general_insurance = 1, toString(generateUUIDv4()), general_insurance_policy_number),
-            general_insurance_coverage = IF(has_general_insurance = 1, CAST((rand() % 100000 + 20000) AS Float64), general_insurance_coverage),
-            general_insurance_term = IF(has_general_insurance = 1, rand() % 10 + 1, general_insurance_term)
-        WHERE 1 = 1
-    ''')
+    print(f"Assigning values dynamically ({mode})")
+    update_columns('Dim_Customer', CUSTOMER_PRODUCT_UPDATES, mode)
     print("Finished altering columns")
 
-def update_region_ids():
-    # Get all regions and their weights
-    regions = ch_client.execute('SELECT region_id, region_name FROM Dim_Region')
-    
+def region_id_expression():
+    # multiIf picking a region_id per row with REGION_WEIGHTS, from the current Dim_Region
+    regions = ch_pool.execute('SELECT region_id, region_name FROM Dim_Region')
+
     # Group regions by region_name and collect their IDs
     region_groups = {}
     for region_id, region_name in regions:
@@ -705,19 +3449,11 @@ def update_region_ids():
             region_groups[region_name] = []
         region_groups[region_name].append(str(region_id))
 
-    # Create weighted distribution based on regions
-    weights = {
-        'Central': 0.5,
-        'East': 0.25,
-        'West': 0.15,
-        'North': 0.10
-    }
-
     # Build the CASE expression for random distribution
     case_parts = []
     cumulative_weight = 0
     
-    for region_name, weight in weights.items():
+    for region_name, weight in REGION_WEIGHTS.items():
         if region_name in region_groups:
             region_ids = region_groups[region_name]
             weight_threshold = int(weight * 1000)
@@ -725,32 +3461,315 @@ def update_region_ids():
             region_array = f"arrayElement([{','.join(region_ids)}], (rand() % {len(region_ids)}) + 1)"
             case_parts.append(f"rand() % 1000 < {cumulative_weight}, {region_array}")
 
-    case_expression = f"multiIf({', '.join(case_parts)}, {region_groups['Central'][0]})"  # default to first Central branch
+    return f"multiIf({', '.join(case_parts)}, {region_groups['Central'][0]})"  # default to first Central branch
 
-    # Update region_id in Dim_Customer
-    ch_client.execute(f'''
-        ALTER TABLE Dim_Customer UPDATE
-        region_id = {case_expression}
-        WHERE 1=1
-    ''')
+@measured_stage
+def update_region_ids(mode='mutation'):
+    # mode='rebuild' rewrites both tables through a shadow table and EXCHANGE TABLES
+    # (see rebuild_table). New customers and sales already get weighted regions as they
+    # are generated (see branch_regions and region_weights), so this only reassigns
+    # rows generated with the original 50 regions.
+    case_expression = region_id_expression()
 
-    # Update region_id in Fact_Sales
-    ch_client.execute(f'''
-        ALTER TABLE Fact_Sales UPDATE
-        region_id = {case_expression}
-        WHERE 1=1
-    ''')
+    # Update region_id in Dim_Customer and Fact_Sales
+    update_columns('Dim_Customer', {'region_id': case_expression}, mode)
+    update_columns('Fact_Sales', {'region_id': case_expression}, mode)
 
     print("Updated all region IDs in Dim_Customer and Fact_Sales with weighted distribution")
 
+# Queries compare_schema_profiles times: date ranges the partitioned layout can
+# prune, the customer and status filters its skip indexes target, and full scans.
+# date_id 366 is 2022-01-01 (see DIM_TIME_START).
+SCHEMA_BENCHMARK_QUERIES = {
+    'sales_by_month': '''
+        SELECT toStartOfMonth(t.date) AS month, sum(s.total_revenue)
+        FROM Fact_Sales AS s INNER JOIN Dim_Time AS t ON s.date_id = t.date_id
+        WHERE s.date_id BETWEEN 366 AND 455
+        GROUP BY month ORDER BY month
+    ''',
+    'sales_by_status': 'SELECT status, count(), sum(total_revenue) FROM Fact_Sales GROUP BY status',
+    'customer_sales': 'SELECT count(), sum(total_revenue) FROM Fact_Sales WHERE customer_id = 42',
+    'loans_started_in_quarter': '''
+        SELECT loan_status, count(), sum(loan_amount) FROM Dim_Loan
+        WHERE start_date >= '2022-01-01' AND start_date < '2022-04-01'
+        GROUP BY loan_status
+    ''',
+    'defaulted_loans': "SELECT count(), sum(outstanding_balance) FROM Dim_Loan WHERE loan_status = 'Defaulted'",
+    'repayments_due_in_year': '''
+        SELECT payment_status, count(), sum(penalties) FROM Fact_Loan_Repayment
+        WHERE due_date >= '2023-01-01' AND due_date < '2024-01-01'
+        GROUP BY payment_status
+    ''',
+    'customer_repayments': 'SELECT count(), sum(emi_amount) FROM Fact_Loan_Repayment WHERE customer_id = 42',
+    'high_risk_exposure': '''
+        SELECT sum(l.outstanding_balance)
+        FROM Dim_Loan AS l INNER JOIN Dim_Customer AS c ON l.customer_id = c.customer_id
+        WHERE c.risk_profile = 'High'
+    ''',
+}
+
+def table_sizes(tables):
+    # Active parts per table, after merging them so every layout is measured fully merged
+    for table in tables:
+        ch_pool.execute(f'OPTIMIZE TABLE {table} FINAL')
+    rows = ch_pool.execute('''
+        SELECT table, sum(rows), sum(bytes_on_disk), sum(data_compressed_bytes), sum(data_uncompressed_bytes), count()
+        FROM system.parts
+        WHERE active AND database = currentDatabase() AND table IN %(tables)s
+        GROUP BY table
+    ''', {'tables': list(tables)})
+    return {
+        table: {'rows': rows, 'bytes_on_disk': on_disk, 'compressed_bytes': compressed,
+                'uncompressed_bytes': uncompressed, 'parts': parts}
+        for table, rows, on_disk, compressed, uncompressed, parts in rows
+    }
+
+def time_query(query, repeats):
+    # Latencies of repeats runs after one warm-up run, with the rows and bytes the last one read
+    latencies = []
+    with ch_pool.connection() as client:
+        for attempt in range(repeats + 1):
+            started = time.perf_counter()
+            client.execute(query)
+            if attempt:
+                latencies.append(time.perf_counter() - started)
+        progress = client.last_query.progress
+    return {
+        'median_seconds': float(np.median(latencies)), 'min_seconds': min(latencies),
+        'read_rows': progress.rows, 'read_bytes': progress.bytes
+    }
+
+def compare_schema_profiles(load, profiles=SCHEMA_PROFILES, repeats=5, queries=SCHEMA_BENCHMARK_QUERIES):
+    # Recreates the schema under every profile, runs load() to fill it (the same
+    # seeded stages each time) and measures insert throughput from the batch
+    # timings, disk size from system.parts and query latency. Drops all tables.
+    if not isinstance(sink, ClickHouseSink):
+        raise ValueError("Comparing schema profiles needs the ClickHouse sink")
+    results = []
+    for profile in profiles:
+        create_tables(profile=profile)
+        first_batch = len(metrics.batch_timings)
+        started = time.perf_counter()
+        load()
+        load_seconds = time.perf_counter() - started
+
+        inserts = {}
+        for timing in metrics.batch_timings[first_batch:]:
+            table = inserts.setdefault(timing['table'], {'rows': 0, 'seconds': 0.0})
+            table['rows'] += timing['rows']
+            table['seconds'] += timing['serialize_seconds'] + timing['network_seconds']
+        for table in inserts.values():
+            table['rows_per_second'] = table['rows'] / table['seconds'] if table['seconds'] else 0.0
+
+        print(f"Timing {len(queries)} queries on the {profile} layout...")
+        results.append({
+            'profile': profile, 'load_seconds': load_seconds, 'inserts': inserts,
+            'tables': table_sizes([parse_table_schema(ddl)[0] for ddl in TABLE_DDL]),
+            'queries': {name: time_query(query, repeats) for name, query in queries.items()}
+        })
+    return results
+
+def format_schema_comparison(results):
+    lines = [f"{'profile':<12} {'load s':>8} {'insert rows/s':>14} {'disk MiB':>9} {'ratio':>6} {'parts':>6}"]
+    for result in results:
+        rows = sum(table['rows'] for table in result['inserts'].values())
+        seconds = sum(table['seconds'] for table in result['inserts'].values())
+        tables = result['tables'].values()
+        on_disk = sum(table['bytes_on_disk'] for table in tables)
+        compressed = sum(table['compressed_bytes'] for table in tables)
+        ratio = sum(table['uncompressed_bytes'] for table in tables) / compressed if compressed else 0.0
+        lines.append(
+            f"{result['profile']:<12} {result['load_seconds']:>8.1f} {rows / seconds if seconds else 0:>14.0f} "
+            f"{on_disk / 2**20:>9.1f} {ratio:>6.1f} {sum(table['parts'] for table in tables):>6}"
+        )
+    lines.append('')
+    lines.append(f"{'query (median ms / rows read)':<30}" + ''.join(f"{result['profile']:>24}" for result in results))
+    for name in results[0]['queries'] if results else []:
+        cells = [result['queries'][name] for result in results]
+        lines.append(f'{name:<30}' + ''.join(
+            f"{cell['median_seconds'] * 1000:>11.1f} / {cell['read_rows']:>10}" for cell in cells
+        ))
+    return '\n'.join(lines)
+
+def load_settings(dotenv=True):
+    # Reads .env (unless dotenv=False) and the environment: PASSWORD, AS_OF_DATE,
+    # FAKER_POOL_CACHE_DIR and the METRICS_* exports
+    global AS_OF_DATE, FAKER_POOL_CACHE_DIR
+    if dotenv:
+        from dotenv import load_dotenv
+        load_dotenv()
+    CLICKHOUSE_CONFIG['password'] = os.getenv('PASSWORD')
+    AS_OF_DATE = os.getenv('AS_OF_DATE')
+    FAKER_POOL_CACHE_DIR = os.getenv('FAKER_POOL_CACHE_DIR', FAKER_POOL_CACHE_DIR)
+    # e.g. METRICS_PROMETHEUS_FILE=/var/lib/node_exporter/textfile/bank_loan_generator.prom in .env for nightly runs
+    metrics.configure(
+        json_path=os.getenv('METRICS_JSON_FILE'), prometheus_path=os.getenv('METRICS_PROMETHEUS_FILE'),
+        profiler=os.getenv('METRICS_PROFILE_DIR')
+    )
+
+def enrich(mode='mutation'):
+    # The post-generation ALTERs: customer products
+    alter_customer(mode)
+
+# Command line stages: name -> (upstream stages, description, call with the parsed arguments)
+STAGES = {
+    'tables': ([], 'drop and create every table', lambda args: create_tables(
+        drop_existing=not args.keep_tables, profile=args.schema, rollups=args.rollups
+    )),
+    'dimensions': (['tables'], 'time, region, channel, product and customer tables', lambda args: generate_dimension_data(
+        unique_names=args.unique_names, as_of=args.as_of, num_customers=args.customers, seed=args.seed,
+        customer_source=args.customer_source
+    )),
+    # Customers already carry the branch region ids (see branch_regions), and sales,
+    # generated after this stage, draw theirs from it with REGION_WEIGHTS
+    'regions': (['dimensions'], 'branch regions', lambda args: alter_regions()),
+    'sales': (['regions'], 'Fact_Sales', lambda args: generate_fact_sales(
+        num_records=args.scale, batch_size=args.batch_size, engine=args.engine, seed=args.seed,
+        workers=args.workers, shard_size=args.shard_size, pipeline=args.pipeline
+    )),
+    'loans': (['sales'], 'Dim_Loan, from the approved sales', lambda args: generate_dim_loan(
+        batch_size=args.batch_size, seed=args.seed, workers=args.workers, shard_size=args.shard_size,
+        pipeline=args.pipeline, engine='server' if args.engine == 'server' else 'numpy', as_of=args.as_of
+    )),
+    'repayments': (['loans'], 'Fact_Loan_Repayment', lambda args: generate_loan_repayments(
+        batch_size=args.batch_size, engine='python' if args.engine == 'python' else 'numpy', seed=args.seed,
+        workers=args.workers, shard_size=args.shard_size, pipeline=args.pipeline, as_of=args.as_of
+    )),
+    'enrichments': (['dimensions'], 'customer products', lambda args: enrich(args.mode)),
+}
+
+# Commands that work on tables in the ClickHouse server rather than through
+# the sink (ALTERs, DROPs, materialized views), so they can't target --output files
+SERVER_ONLY_COMMANDS = ['regions', 'enrichments', 'compare-schemas', 'backfill-rollups', 'portfolio']
+
+def plan_stages(requested, upstream=False):
+    # Requested stages in dependency order, plus everything upstream of them if asked
+    selected = set()
+
+    def visit(stage):
+        if stage not in selected:
+            selected.add(stage)
+            for dependency in STAGES[stage][0] if upstream else []:
+                visit(dependency)
+
+    for stage in requested:
+        visit(stage)
+    return [stage for stage in STAGES if stage in selected]
+
+def build_parser():
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument('--scale', type=int, default=20000, help='Fact_Sales rows (loans and repayments follow)')
+    options.add_argument('--customers', type=int, default=5000, help='Dim_Customer rows')
+    options.add_argument('--seed', type=int, help='master seed; the same seed gives the same rows')
+    options.add_argument('--engine', choices=['python', 'numpy', 'server'], default='numpy',
+                         help="'server' generates sales and loans inside ClickHouse")
+    options.add_argument('--workers', type=int, default=1, help='worker processes per stage')
+    options.add_argument('--batch-size', type=int, default=10000)
+    options.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE)
+    options.add_argument('--writers', type=int, default=0, help='insert threads overlapping generation (0: inline)')
+    options.add_argument('--writer-backend', choices=WRITER_BACKENDS, default='threads',
+                         help="'asyncio' keeps --writers inserts in flight and commits checkpoints in order")
+    options.add_argument('--as-of', help='date the data is generated as of (default: AS_OF_DATE or today)')
+    options.add_argument('--unique-names', action='store_true', help='distinct customer names')
+    options.add_argument('--customer-source', metavar='CSV',
+                         help='resample customer age, job and balance from a CSV such as BankCustomerData.csv')
+    options.add_argument('--keep-tables', action='store_true', help="don't drop existing tables")
+    options.add_argument('--schema', choices=SCHEMA_PROFILES, default='baseline', help='physical table layout')
+    options.add_argument('--rollups', action='store_true', help='also create the materialized monthly rollups')
+    options.add_argument('--mode', choices=['mutation', 'rebuild'], default='mutation',
+                         help='how the enrichments stage rewrites tables')
+    options.add_argument('--output', help='write files under this directory instead of inserting into ClickHouse')
+    options.add_argument('--format', choices=['native', 'parquet'], default='native', help='file format for --output')
+    options.add_argument('--upstream', action='store_true', help='also run the stages the requested ones depend on')
+    options.add_argument('--dry-run', action='store_true', help='print the stages that would run and exit')
+
+    parser = argparse.ArgumentParser(description='Generate the bank loan dataset into ClickHouse')
+    commands = parser.add_subparsers(dest='stage', required=True, metavar='stage')
+    commands.add_parser('all', parents=[options], help='run every stage in order')
+    for stage, (dependencies, description, _) in STAGES.items():
+        after = f" (after {', '.join(dependencies)})" if dependencies else ''
+        commands.add_parser(stage, parents=[options], help=description + after)
+
+    compare = commands.add_parser(
+        'compare-schemas', parents=[options],
+        help='load the same data under each schema profile and compare inserts, disk size and queries'
+    )
+    compare.add_argument('--profiles', default=','.join(SCHEMA_PROFILES), help='comma-separated schema profiles')
+    compare.add_argument('--repeats', type=int, default=5, help='timed runs per query')
+    compare.add_argument('--report', help='also write the results as JSON to this file')
+
+    commands.add_parser(
+        'backfill-rollups', parents=[options], help='recompute the rollups from their source tables'
+    )
+    portfolio = commands.add_parser('portfolio', parents=[options], help='print a dashboard query over the rollups')
+    portfolio.add_argument('query', choices=PORTFOLIO_QUERIES)
+    portfolio.add_argument('--since', help='first month, YYYY-MM-DD')
+    portfolio.add_argument('--until', help='last month, YYYY-MM-DD')
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.stage == 'compare-schemas':
+        unknown = set(args.profiles.split(',')) - set(SCHEMA_PROFILES)
+        if unknown:
+            build_parser().error(f"unknown schema profiles: {', '.join(sorted(unknown))}")
+        stages = ['dimensions', 'sales', 'loans', 'repayments']
+    elif args.stage in ('backfill-rollups', 'portfolio'):
+        stages = [args.stage]
+    elif args.stage == 'all':
+        stages = list(STAGES)
+    else:
+        stages = plan_stages([args.stage], args.upstream)
+    if args.output:
+        if args.stage in SERVER_ONLY_COMMANDS:
+            build_parser().error(f"{args.stage} changes tables on the ClickHouse server and can't write to --output")
+        if args.rollups or args.engine == 'server':
+            build_parser().error("--rollups and --engine server need ClickHouse and can't be used with --output")
+        skipped = [stage for stage in stages if stage in SERVER_ONLY_COMMANDS]
+        if skipped:
+            print(f"Skipping {', '.join(skipped)}: they change tables on the ClickHouse server, not the --output files")
+            stages = [stage for stage in stages if stage not in skipped]
+    if args.dry_run:
+        print(' -> '.join(stages))
+        return
+
+    load_settings()
+    args.pipeline = {'writers': args.writers, 'backend': args.writer_backend} if args.writers else None
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.output:
+        set_sink(NativeSink(args.output) if args.format == 'native' else ParquetSink(args.output))
+
+    if args.stage == 'compare-schemas':
+        # Every profile gets the same rows
+        args.seed = resolve_seed(args.seed)
+
+        def load():
+            random.seed(args.seed)
+            for stage in stages:
+                STAGES[stage][2](args)
+
+        results = compare_schema_profiles(load, args.profiles.split(','), args.repeats)
+        print(format_schema_comparison(results))
+        if args.report:
+            with open(args.report, 'w') as report:
+                json.dump(results, report, indent=2)
+        return
+    if args.stage == 'backfill-rollups':
+        backfill_rollups()
+        return
+    if args.stage == 'portfolio':
+        rows = portfolio_query(args.query, args.since, args.until)
+        if rows:
+            print('\t'.join(rows[0]))
+        for row in rows:
+            print('\t'.join(str(value) for value in row.values()))
+        return
+
+    print(f"Starting data generation: {' -> '.join(stages)}")
+    for stage in stages:
+        STAGES[stage][2](args)
+    print("Data generation complete!")
+
 if __name__ == '__main__':
-    print("Starting data generation...")
-    # create_tables()
-    # generate_dimension_data()
-    # generate_fact_sales(num_records=20000)
-    # generate_dim_loan()
-    # generate_loan_repayments()
-    # print("Data generation complete!")
-    # alter_regions()
-    update_region_ids()
-    # alter_customer()
+    main()
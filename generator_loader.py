@@ -0,0 +1,14 @@
+import importlib.util
+import os
+
+# data-generator.py can't be imported by name, so the scripts next to it
+# (benchmark-generators.py, workload-driver.py) load it from its path.
+
+GENERATOR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data-generator.py')
+
+def load_generator():
+    # A fresh module on every call, so one caller patching it (e.g. its client) doesn't affect another
+    spec = importlib.util.spec_from_file_location('data_generator', GENERATOR_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
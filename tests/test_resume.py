@@ -0,0 +1,177 @@
+import contextlib
+import datetime
+import io
+import os
+import re
+import sqlite3
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generator_loader import load_generator
+
+# Interrupts Fact_Sales runs part-way and resumes them from Generation_Checkpoints
+# (StageRun), against a SQLite stand-in for ClickHouse that honours
+# insert_deduplication_token like the server's deduplication window does.
+
+NUM_SALES = 5000
+BATCH_SIZE = 500
+SHARD_SIZE = 2000
+SEED = 7
+
+
+class Interrupted(Exception):
+    pass
+
+
+class FakeServer:
+    # Tables shared by every FakeClient the connection pool opens
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        self.tokens = set()
+        self.fail_on = None  # (table, n): the n-th insert into table raises
+
+    def insert(self, table, names, data, columnar, token):
+        if columnar:
+            rows = list(zip(*[values.tolist() if hasattr(values, 'tolist') else values for values in data]))
+        elif data and isinstance(data[0], dict):
+            names = list(data[0])
+            rows = [tuple(row[name] for name in names) for row in data]
+        else:
+            rows = [tuple(row) for row in data]
+        with self.lock:
+            if self.fail_on and self.fail_on[0] == table:
+                self.fail_on = (table, self.fail_on[1] - 1)
+                if self.fail_on[1] == 0:
+                    raise Interrupted(f"insert into {table} failed")
+            if token is not None and (table, token) in self.tokens:
+                return 0
+            self.tokens.add((table, token))
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(names)})")
+            self.db.executemany(
+                f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                [tuple(_sqlite_value(value) for value in row) for row in rows]
+            )
+        return len(rows)
+
+    def select(self, query, params):
+        for name, value in (params or {}).items():
+            query = query.replace(f'%({name})s', repr(_sqlite_value(value)))
+        with self.lock:
+            return self.db.execute(query).fetchall()
+
+    def rows(self, table, key):
+        return self.select(f'SELECT * FROM {table} ORDER BY {key}', None)
+
+
+def _sqlite_value(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return repr(value)
+    return value
+
+
+class FakeClient:
+    # The parts of clickhouse_driver.Client the generators use
+    def __init__(self, server):
+        self.server = server
+
+    def execute(self, query, params=None, columnar=False, settings=None, **kwargs):
+        statement = ' '.join(query.split())
+        insert = re.match(r'INSERT INTO (\w+) (?:\(([^)]*)\) )?VALUES', statement)
+        if insert:
+            names = [name.strip() for name in (insert.group(2) or '').split(',')]
+            token = (settings or {}).get('insert_deduplication_token')
+            return self.server.insert(insert.group(1), names, params, columnar, token)
+        if statement.startswith('SELECT'):
+            return self.server.select(statement, params)
+        return []
+
+    def execute_iter(self, query, params=None, settings=None, **kwargs):
+        return iter(self.execute(query, params))
+
+    def disconnect(self):
+        pass
+
+    class connection:
+        @staticmethod
+        def ping():
+            return True
+
+
+@pytest.fixture
+def generator():
+    generator = load_generator()
+    server = FakeServer()
+    generator.metered_client = lambda **config: FakeClient(server)
+    generator.ch_pool = generator.ClickHousePool(generator.CLICKHOUSE_CONFIG)
+    generator.server = server
+    quietly(generator.generate_dimension_data, num_customers=500, seed=SEED)
+    return generator
+
+
+def quietly(function, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args, **kwargs)
+
+
+def generate_sales(generator, **kwargs):
+    return quietly(
+        generator.generate_fact_sales, num_records=NUM_SALES, batch_size=BATCH_SIZE, shard_size=SHARD_SIZE,
+        seed=SEED, **kwargs
+    )
+
+
+@pytest.mark.parametrize('engine', ['numpy', 'python'])
+@pytest.mark.parametrize('pipeline', [None, {'writers': 2}, {'writers': 2, 'backend': 'asyncio'}])
+def test_resumed_run_matches_uninterrupted_run(generator, engine, pipeline):
+    server = generator.server
+    generate_sales(generator, engine=engine)
+    expected = server.rows('Fact_Sales', 'sale_id')
+    server.db.execute('DELETE FROM Fact_Sales')
+
+    # The 6th batch is the second one of shard 1
+    server.fail_on = ('Fact_Sales', 6)
+    with pytest.raises(Interrupted):
+        generate_sales(generator, engine=engine, pipeline=pipeline)
+    assert 0 < len(server.rows('Fact_Sales', 'sale_id')) < NUM_SALES
+
+    quietly(generator.generate_fact_sales, resume=True, pipeline=pipeline)
+    assert server.rows('Fact_Sales', 'sale_id') == expected
+
+
+def test_resume_skips_finished_shards(generator):
+    server = generator.server
+    server.fail_on = ('Fact_Sales', 6)
+    with pytest.raises(Interrupted):
+        generate_sales(generator, engine='numpy')
+    inserted = len(server.rows('Fact_Sales', 'sale_id'))
+
+    # Shard 0 (4 batches) and the first batch of shard 1 are checkpointed; nothing of them is redone
+    resumed = []
+    insert = server.insert
+    server.insert = lambda table, *args: resumed.append(table) or insert(table, *args)
+    quietly(generator.generate_fact_sales, resume=True)
+    assert inserted == 5 * BATCH_SIZE
+    assert resumed.count('Fact_Sales') == (NUM_SALES - inserted) // BATCH_SIZE
+
+
+def test_resume_without_a_run_fails(generator):
+    with pytest.raises(ValueError, match='No Fact_Sales run to resume'):
+        quietly(generator.generate_fact_sales, resume=True)
+
+
+def test_append_continues_after_the_last_sale_id(generator):
+    server = generator.server
+    generate_sales(generator, engine='numpy')
+    quietly(generator.generate_fact_sales, num_records=1200, batch_size=BATCH_SIZE, seed=SEED + 1, append=True)
+    sale_ids = [row[0] for row in server.select('SELECT sale_id FROM Fact_Sales ORDER BY sale_id', None)]
+    assert sale_ids == list(range(1, NUM_SALES + 1200 + 1))
@@ -0,0 +1,326 @@
+import argparse
+import asyncio
+import datetime
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from generator_loader import load_generator
+
+# Runs a catalog of dashboard-style queries against the tables data-generator.py
+# creates, from many concurrent clients, and reports client-side latency
+# percentiles and throughput per query alongside what the server read for them
+# (from system.query_log). Run it against datasets of different --scale to see
+# how latency and scanned data grow before sizing a cluster.
+#
+# Two ways to generate load:
+#   threads  closed loop: each of --concurrency workers sends its next query as
+#            soon as the previous one returns, so QPS is whatever the server sustains.
+#   asyncio  open loop: queries start at --rate per second whether or not earlier
+#            ones finished, at most --concurrency at a time. Latency is measured
+#            from the scheduled start, so a backed-up server shows up as queueing
+#            time instead of a quietly lower request rate.
+
+# Seconds a run lasts when neither --duration nor --requests is given
+DEFAULT_DURATION = 30.0
+
+# name -> (query, parameters drawn per run from the rng and the dataset bounds, or None).
+# delinquency_by_branch needs the regions stage (Dim_Region.branch_name).
+QUERY_CATALOG = {
+    'delinquency_by_branch': ('''
+        SELECT r.branch_name, count() AS loans,
+               countIf(l.loan_status IN ('Delinquent', 'Defaulted')) / count() AS delinquency_rate,
+               sumIf(l.outstanding_balance, l.loan_status IN ('Delinquent', 'Defaulted')) AS overdue_exposure
+        FROM Dim_Loan AS l
+        INNER JOIN Dim_Customer AS c ON l.customer_id = c.customer_id
+        INNER JOIN Dim_Region AS r ON c.region_id = r.region_id
+        GROUP BY r.branch_name
+        ORDER BY delinquency_rate DESC
+    ''', None),
+    'clv_by_lifecycle_stage': ('''
+        SELECT c.lifecycle_stage, count() AS customers, avg(c.predicted_clv) AS predicted_clv,
+               avg(s.realized_revenue) AS realized_revenue, avg(c.churn_risk_score) AS churn_risk
+        FROM Dim_Customer AS c
+        LEFT JOIN (
+            SELECT customer_id, sum(total_revenue) AS realized_revenue
+            FROM Fact_Sales WHERE status = 'Approved' GROUP BY customer_id
+        ) AS s ON c.customer_id = s.customer_id
+        GROUP BY c.lifecycle_stage
+        ORDER BY c.lifecycle_stage
+    ''', None),
+    'emi_bounce_trend': ('''
+        SELECT toStartOfMonth(due_date) AS month, count() AS installments,
+               countIf(payment_status = 'Bounced') / count() AS bounce_rate, sum(penalties) AS penalties
+        FROM Fact_Loan_Repayment
+        WHERE due_date >= %(since)s
+        GROUP BY month
+        ORDER BY month
+    ''', lambda rng, bounds: {'since': bounds['first_due_date'] + datetime.timedelta(int(rng.integers(0, 365)))}),
+    'npa_by_product_category': ('''
+        SELECT p.category, countIf(s.npa_loss_amount > 0) AS npa_sales, sum(s.npa_loss_amount) AS npa_loss,
+               sum(s.emi_bounce_charges) AS bounce_charges
+        FROM Fact_Sales AS s
+        INNER JOIN Dim_Product AS p ON s.product_id = p.product_id
+        WHERE s.status = 'Approved'
+        GROUP BY p.category
+        ORDER BY npa_loss DESC
+    ''', None),
+    'monthly_revenue_by_channel': ('''
+        SELECT t.year, t.month, s.channel_id, sum(s.total_revenue) AS revenue, count() AS sales
+        FROM Fact_Sales AS s
+        INNER JOIN Dim_Time AS t ON s.date_id = t.date_id
+        WHERE t.year = %(year)s
+        GROUP BY t.year, t.month, s.channel_id
+        ORDER BY t.month, s.channel_id
+    ''', lambda rng, bounds: {'year': int(rng.choice(bounds['years']))}),
+    'exposure_by_risk_rating': ('''
+        SELECT risk_rating, loan_type, count() AS loans, sum(loan_amount) AS disbursed,
+               sum(outstanding_balance) AS outstanding, avg(interest_rate) AS interest_rate
+        FROM Dim_Loan
+        GROUP BY risk_rating, loan_type
+        ORDER BY risk_rating, loan_type
+    ''', None),
+    'overdue_aging': ('''
+        SELECT multiIf(days_overdue = 0, 'current', days_overdue <= 30, '1-30', days_overdue <= 90, '31-90',
+                       '90+') AS bucket,
+               count() AS installments, sum(pending_principal) AS pending_principal
+        FROM Fact_Loan_Repayment
+        GROUP BY bucket
+        ORDER BY bucket
+    ''', None),
+    'customer_repayment_history': ('''
+        SELECT loan_id, emi_number, due_date, payment_date, emi_amount, payment_status, days_overdue
+        FROM Fact_Loan_Repayment
+        WHERE customer_id = %(customer_id)s
+        ORDER BY loan_id, emi_number
+    ''', lambda rng, bounds: {'customer_id': int(rng.integers(1, bounds['max_customer_id'] + 1))}),
+}
+
+# What the query parameters are drawn from: name -> (query, value when the table is missing or empty).
+# The queries return NULL, 0 or [] for an empty table (min() would return the epoch).
+DATASET_BOUNDS = {
+    'max_customer_id': ('SELECT max(customer_id) FROM Dim_Customer', 1),
+    'first_due_date': ('SELECT minOrNull(due_date) FROM Fact_Loan_Repayment', datetime.date(2021, 1, 1)),
+    'years': ('SELECT groupUniqArray(year) FROM Dim_Time', [2021]),
+}
+
+QUERY_LOG_QUERY = '''
+    SELECT query_id, read_rows, read_bytes, query_duration_ms, memory_usage
+    FROM system.query_log
+    WHERE type = 'QueryFinish' AND event_date >= yesterday() AND startsWith(query_id, %(prefix)s)
+'''
+
+def dataset_bounds(pool):
+    bounds = {}
+    for name, (query, default) in DATASET_BOUNDS.items():
+        try:
+            value = pool.execute(query)[0][0]
+        except Exception:
+            value = None
+        bounds[name] = value or default
+    return bounds
+
+class Workload:
+    # The queries of one run, each tagged with a query_id under the run's prefix
+    # so system.query_log can be matched back to the catalog entry that sent it
+    def __init__(self, pool, names, bounds, seed):
+        self.pool = pool
+        self.names = names
+        self.bounds = bounds
+        self.seed = seed
+        self.prefix = f'workload-{uuid.uuid4().hex[:12]}-'
+        self.samples = []
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def client_rng(self, client):
+        return np.random.default_rng([self.seed, client])
+
+    def next_query(self, rng):
+        name = self.names[rng.integers(len(self.names))]
+        query, parameters = QUERY_CATALOG[name]
+        with self._lock:
+            self._count += 1
+            query_id = f'{self.prefix}{name}-{self._count}'
+        return name, query, parameters(rng, self.bounds) if parameters else None, query_id
+
+    def run(self, name, query, params, query_id, scheduled=None):
+        # Latency from the scheduled start when there is one (asyncio), else from the send
+        started = time.perf_counter()
+        error = None
+        try:
+            self.pool.execute(query, params, query_id=query_id)
+        except Exception as exception:
+            error = f'{type(exception).__name__}: {exception}'
+        finished = time.perf_counter()
+        with self._lock:
+            self.samples.append({
+                'name': name, 'query_id': query_id, 'seconds': finished - (scheduled or started),
+                'finished': finished, 'error': error
+            })
+
+def check_catalog(pool, names, bounds, seed):
+    # One warm-up run per query; queries the dataset can't answer (e.g. a stage
+    # that hasn't run) are reported and left out of the load
+    rng = np.random.default_rng(seed)
+    usable = []
+    for name in names:
+        query, parameters = QUERY_CATALOG[name]
+        try:
+            pool.execute(query, parameters(rng, bounds) if parameters else None)
+            usable.append(name)
+        except Exception as error:
+            print(f"Skipping {name}: {type(error).__name__}: {str(error).splitlines()[0]}")
+    return usable
+
+def run_threads(workload, concurrency, duration, requests):
+    # Stops at whichever of duration (seconds) and requests is set and reached first
+    deadline = time.perf_counter() + duration if duration is not None else float('inf')
+    remaining = [requests]
+
+    def take():
+        with workload._lock:
+            if remaining[0] is not None:
+                if remaining[0] <= 0:
+                    return False
+                remaining[0] -= 1
+        return time.perf_counter() < deadline
+
+    def client(index):
+        rng = workload.client_rng(index)
+        while take():
+            workload.run(*workload.next_query(rng))
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(client, index) for index in range(concurrency)]:
+            future.result()
+
+async def run_asyncio(workload, concurrency, duration, requests, rate):
+    # clickhouse_driver is blocking, so each query runs on an executor thread;
+    # the event loop only schedules arrivals and bounds how many are in flight
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(concurrency)
+    rng = workload.client_rng(0)
+    total = min(
+        requests if requests is not None else float('inf'),
+        int(duration * rate) if duration is not None else float('inf')
+    )
+    started = time.perf_counter()
+
+    async def send(scheduled):
+        async with slots:
+            await loop.run_in_executor(executor, workload.run, *workload.next_query(rng), scheduled)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        tasks = []
+        for index in range(total):
+            scheduled = started + index / rate
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            tasks.append(asyncio.ensure_future(send(scheduled)))
+        await asyncio.gather(*tasks)
+
+def server_stats(pool, prefix):
+    # Per-query server counters; query_log is flushed every few seconds, so force it
+    try:
+        pool.execute('SYSTEM FLUSH LOGS')
+        rows = pool.execute(QUERY_LOG_QUERY, {'prefix': prefix})
+    except Exception as error:
+        print(f"No server statistics: {type(error).__name__}: {str(error).splitlines()[0]}")
+        return {}
+    return {
+        query_id: {'read_rows': read_rows, 'read_bytes': read_bytes, 'server_ms': duration_ms, 'memory': memory}
+        for query_id, read_rows, read_bytes, duration_ms, memory in rows
+    }
+
+def summarize(name, samples, stats, elapsed):
+    # Client latency percentiles over the successful runs; server counters are per-run averages
+    succeeded = [sample for sample in samples if sample['error'] is None]
+    latencies = np.array([sample['seconds'] for sample in succeeded])
+    logged = [stats[sample['query_id']] for sample in succeeded if sample['query_id'] in stats]
+    percentiles = (np.percentile(latencies, [50, 95, 99]) * 1000).tolist() if len(latencies) else [None] * 3
+    return {
+        'query': name, 'requests': len(samples), 'errors': len(samples) - len(succeeded),
+        'qps': len(succeeded) / elapsed if elapsed else 0.0,
+        'p50_ms': percentiles[0], 'p95_ms': percentiles[1], 'p99_ms': percentiles[2],
+        'read_rows': int(np.mean([stat['read_rows'] for stat in logged])) if logged else None,
+        'read_bytes': int(np.mean([stat['read_bytes'] for stat in logged])) if logged else None,
+        'server_ms': float(np.mean([stat['server_ms'] for stat in logged])) if logged else None,
+        'memory_bytes': int(np.max([stat['memory'] for stat in logged])) if logged else None,
+    }
+
+def run_workload(names=None, mode='threads', concurrency=8, duration=None, requests=None, rate=10.0, seed=0):
+    # Returns one summary per catalog query plus an 'all' row, as dicts. The run
+    # stops at duration seconds or after requests queries, whichever is set and
+    # comes first; DEFAULT_DURATION without either.
+    if duration is None and requests is None:
+        duration = DEFAULT_DURATION
+    generator = load_generator()
+    generator.load_settings()
+    pool = generator.ClickHousePool(generator.CLICKHOUSE_CONFIG, max_idle=concurrency + 1)
+    bounds = dataset_bounds(pool)
+    names = check_catalog(pool, names or list(QUERY_CATALOG), bounds, seed)
+    if not names:
+        raise ValueError("None of the catalog queries run against this dataset")
+
+    workload = Workload(pool, names, bounds, seed)
+    print(f"Running {', '.join(names)} with {concurrency} clients ({mode})")
+    started = time.perf_counter()
+    if mode == 'threads':
+        run_threads(workload, concurrency, duration, requests)
+    else:
+        asyncio.run(run_asyncio(workload, concurrency, duration, requests, rate))
+    elapsed = max(sample['finished'] for sample in workload.samples) - started if workload.samples else 0.0
+
+    stats = server_stats(pool, workload.prefix)
+    pool.close()
+    results = [
+        summarize(name, [sample for sample in workload.samples if sample['name'] == name], stats, elapsed)
+        for name in names
+    ]
+    results.append(summarize('all', workload.samples, stats, elapsed))
+    for result in results:
+        result.update(mode=mode, concurrency=concurrency)
+    return results
+
+def format_result(result):
+    def number(value, spec):
+        return '-' if value is None else format(value, spec)
+
+    read_mib = None if result['read_bytes'] is None else result['read_bytes'] / 2**20
+    return (
+        f"{result['query']:<28} {result['requests']:>8} {result['errors']:>6} {result['qps']:>8.1f} "
+        f"{number(result['p50_ms'], '.1f'):>9} {number(result['p95_ms'], '.1f'):>9} "
+        f"{number(result['p99_ms'], '.1f'):>9} {number(result['read_rows'], 'd'):>12} {number(read_mib, '.1f'):>9}"
+    )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a concurrent query workload against the generated dataset')
+    parser.add_argument('--queries', default=','.join(QUERY_CATALOG), help='comma-separated catalog queries')
+    parser.add_argument('--mode', choices=['threads', 'asyncio'], default='threads',
+                        help="'threads': closed loop; 'asyncio': open loop at --rate")
+    parser.add_argument('--concurrency', type=int, default=8, help='clients (threads) or queries in flight (asyncio)')
+    parser.add_argument('--duration', type=float,
+                        help=f'seconds to run (default {DEFAULT_DURATION:.0f} unless --requests is given)')
+    parser.add_argument('--requests', type=int, help='queries to run; with --duration, whichever limit comes first')
+    parser.add_argument('--rate', type=float, default=10.0, help='queries per second to start (asyncio)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the query mix and parameters')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    unknown = set(args.queries.split(',')) - set(QUERY_CATALOG)
+    if unknown:
+        parser.error(f"unknown queries: {', '.join(sorted(unknown))}")
+    results = run_workload(
+        args.queries.split(','), args.mode, args.concurrency, args.duration, args.requests, args.rate, args.seed
+    )
+    print(f"{'query':<28} {'requests':>8} {'errors':>6} {'qps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'read rows':>12} {'read MiB':>9}")
+    for result in results:
+        print(format_result(result))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)